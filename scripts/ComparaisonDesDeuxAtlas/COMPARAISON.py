@@ -1,22 +1,38 @@
-import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-import re
 import sys
 from scipy.spatial.distance import directed_hausdorff
 from collections import defaultdict
 import concurrent.futures
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from volume_cache import load_volume
+from label_histogram import axis_histograms, label_regions
+from subject_index import SubjectIndex
+
 
 def calculate_metrics_for_pair(atlas1, atlas2, labels):
     """
     Calculer les métriques (Dice, IoU, Hausdorff) pour une paire d'images.
+    Chaque label est comparé dans l'union de ses boîtes englobantes dans les deux
+    atlas (calculées en une passe par atlas) au lieu du volume entier.
     """
+    regions1 = label_regions(axis_histograms(atlas1))
+    regions2 = label_regions(axis_histograms(atlas2))
     results = {}
     for label in labels:
-        binary1 = (atlas1 == label)
-        binary2 = (atlas2 == label)
+        boxes = [r[label] for r in (regions1, regions2) if label in r]
+        if not boxes:
+            # Label absent des deux atlas
+            results[label] = {"Dice": 0.0, "IoU": 0.0, "Hausdorff": np.nan}
+            continue
+        crop = tuple(
+            slice(min(b["bbox_min"][axis] for b in boxes), max(b["bbox_max"][axis] for b in boxes) + 1)
+            for axis in range(3)
+        )
+        binary1 = (atlas1[crop] == label)
+        binary2 = (atlas2[crop] == label)
 
         # Intersection et union
         intersection = np.logical_and(binary1, binary2).sum()
@@ -44,36 +60,29 @@ def calculate_metrics_for_pair(atlas1, atlas2, labels):
 
 
 def load_atlas(path):
-    """Charger un fichier atlas au format NIfTI et le convertir en tableau NumPy."""
+    """
+    Charger un fichier atlas au format NIfTI et le convertir en tableau NumPy d'entiers.
+    Le volume est lu depuis le cache partagé ($SIR_VOLUME_CACHE) s'il est activé.
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Fichier introuvable: {path}")
-    nii = nib.load(path)
-    return nii.get_fdata().astype(int)
+    return load_volume(path, integer=True)
 
 
 def find_matching_files(directory1, directory2):
     """
     Trouver les fichiers correspondants entre deux répertoires avec "majority" et "corrected"/"Corrected" dans leurs noms.
-    Correspondance basée sur un identifiant unique commun dans les noms de fichiers.
+    Correspondance basée sur le sujet (base de données et identifiant) des noms de fichiers,
+    par un index de chaque répertoire au lieu de comparer toutes les paires.
     """
-    files1 = [f for f in os.listdir(directory1) if f.endswith(".nii.gz") and "majority" in f.lower() and "corrected" in f.lower()]
-    files2 = [f for f in os.listdir(directory2) if f.endswith(".nii.gz") and "majority" in f.lower() and "corrected" in f.lower()]
+    is_majority = lambda f: "majority" in f.lower() and "corrected" in f.lower()
+    index1 = SubjectIndex.scan(directory1, (".nii.gz",), recursive=False, name_filter=is_majority)
+    index2 = SubjectIndex.scan(directory2, (".nii.gz",), recursive=False, name_filter=is_majority)
 
     matching_files = []
-    for file1 in files1:
-        id1_match = re.search(r"(OAS1_\d+|IXI\d+|KKI2009-\d+|[A-Za-z0-9]+)", file1)
-        if not id1_match:
-            continue
-        id1 = id1_match.group(1)
-
-        for file2 in files2:
-            id2_match = re.search(r"(OAS1_\d+|IXI\d+|KKI2009-\d+|[A-Za-z0-9]+)", file2)
-            if not id2_match:
-                continue
-            id2 = id2_match.group(1)
-
-            if id1 == id2:
-                matching_files.append((os.path.join(directory1, file1), os.path.join(directory2, file2)))
+    for entry1 in index1.entries:
+        for entry2 in index2.find(entry1.database, entry1.subject_id):
+            matching_files.append((entry1.path, entry2.path))
 
     return matching_files
 
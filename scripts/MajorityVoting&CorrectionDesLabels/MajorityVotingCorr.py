@@ -5,6 +5,28 @@ import os
 import glob
 from scipy.ndimage import distance_transform_edt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from volume_cache import load_volume, get_cache_dir
+
+# Lecture d'une segmentation en sitkUInt32
+def read_label_image(file_path):
+    # Sans cache partagé ($SIR_VOLUME_CACHE), lecture directe par SimpleITK
+    if get_cache_dir() is None:
+        return sitk.ReadImage(file_path, sitk.sitkUInt32)
+
+    # Géométrie lue dans l'en-tête seulement, voxels mappés depuis le cache
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_path)
+    reader.ReadImageInformation()
+    array = load_volume(file_path, integer=True)
+
+    # nibabel indexe (x, y, z), SimpleITK attend un tableau (z, y, x)
+    img = sitk.GetImageFromArray(np.ascontiguousarray(array.T, dtype=np.uint32))
+    img.SetSpacing(reader.GetSpacing())
+    img.SetOrigin(reader.GetOrigin())
+    img.SetDirection(reader.GetDirection())
+    return img
+
 # Fonction de correction des labels maximum
 def correct_max_labels_3d(image, max_label):
     
@@ -76,7 +98,7 @@ for filename in all_files:
 for prefix, files in file_groups.items():
     images = []
     for file_path in files:
-        img = sitk.ReadImage(file_path, sitk.sitkUInt32)
+        img = read_label_image(file_path)
         images.append(img)
 
     # Appliquer le majority voting
@@ -6,6 +6,10 @@ from collections import defaultdict
 import statistics
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from label_store import iter_subject_rows
+from subject_index import parse_subject, DATABASE_PATTERNS
+
 ##### Example of excution the programme:  python .\statistiques_cerveux.py <input_folder>
 ##### Need to change line 164,165,174 to modify to the correct path.
 
@@ -184,15 +188,12 @@ grouped_volumes["Overall"] = []
 group_total_volumes = {group: [] for group in categories}
 group_total_volumes["Overall"] = []
 
-# Distinguish between single-name databases and multi-name in the inputfolder
+# Distinguish between single-name databases and multi-name: the subject of a file is
+# its tag of the last database of the folder name (e.g. the Kirby subject in IBSR_Kirby)
 database_name = os.path.basename(os.path.dirname(input_folder)) 
-if "_" in database_name:  
-    primary_db, secondary_db = database_name.split("_")  
-    is_composite_db = True
-else:
-    primary_db = database_name
-    secondary_db = None
-    is_composite_db = False
+subject_database = database_name.split("_")[-1]
+if subject_database not in DATABASE_PATTERNS:
+    subject_database = None  # Unknown folder name: last database tag of each file name
 
 # Create the mapping info concerned the correspandence of label numbers
 id_mapping = {
@@ -238,65 +239,40 @@ id_mapping = {
     "74": 22   # "73, 74" -> Thin cerebral white matter
 }
 
-# Process each CSV file in the input folder
-for csv_file in os.listdir(input_folder):
-    if csv_file.endswith(".csv"):
-        file_path = os.path.join(input_folder, csv_file)
-
-        if not is_composite_db:
-            file_id = int(csv_file.split("_")[1].lstrip('0')) if csv_file.startswith(("OAS", "IBSR")) else \
-                        int(csv_file.split("-")[1].lstrip('0')) if csv_file.startswith("KKI") else \
-                        int(csv_file.split("-")[0].lstrip("IXI"))
-        else:  # Need to change to a smarter way to get the ID of the file. A vous de jouer ==-== .
-            if primary_db == "IBSR" and secondary_db == "Kirby":
-                file_id = int(csv_file.split("-")[1].lstrip('0'))  
-            elif primary_db == "IBSR" and secondary_db == "IXI":
-                first_part = csv_file.split("-")[0]
-                file_id = int(first_part.split("_")[-1].lstrip("IXI"))
-            elif primary_db == "IBSR" and secondary_db == "OASIS":
-                file_id = int(csv_file.split("_")[5].lstrip('0'))  
-            elif primary_db == "OASIS" and secondary_db == "IBSR":
-                first_part = csv_file.split("_")[9]
-                file_id = int(first_part.split(".")[0].lstrip('0')) 
-            elif primary_db == "OASIS" and secondary_db == "Kirby":
-                file_id = int(csv_file.split("-")[2].lstrip('0'))
-            elif primary_db == "Kirby" and secondary_db == "IXI":
-                first_part = csv_file.split("_")[3]
-                file_id = int(first_part.split("-")[0].lstrip("IXI"))
-            elif primary_db == "Kirby" and secondary_db == "OASIS":
-                file_id = int(csv_file.split("_")[4].lstrip('0'))
-            else:
-                raise ValueError(f"Unknown: {secondary_db}")
-
-        file_data = {}
-        with open(file_path, mode="r", encoding="ISO-8859-1") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                csv_id = (row["ID"])
-                if csv_id in id_mapping:
-                    label_id = int(id_mapping[csv_id])
-                else:
-                    continue
-
-                volume_mm3 = float(row.get("Voxel Volume (mm³)", row.get("Voxel Volume 3", "0")))
-                volume_ratio = float(row["Volume Ratio (%)"])
-
-                if volume_mm3 == 0 and volume_ratio == 0:
-                    continue
-
-                file_data[label_id] = {
-                    "voxel_count": int(row["Voxel Count"]),
-                    "volume_mm3": float(row.get("Voxel Volume (mm³)", row.get("Voxel Volume 3", "0"))),
-                    "volume_ratio": float(row["Volume Ratio (%)"]),
-                }
+# Process each CSV file in the input folder (or the label_volumes.npz store when present)
+for subject_name, rows in iter_subject_rows(input_folder):
+    tag = parse_subject(subject_name, subject_database)
+    if tag is None:
+        raise ValueError(f"Unknown subject: {subject_name}")
+    file_id = tag.subject_id
+
+    file_data = {}
+    for row in rows:
+        csv_id = (row["ID"])
+        if csv_id in id_mapping:
+            label_id = int(id_mapping[csv_id])
+        else:
+            continue
+
+        volume_mm3 = float(row.get("Voxel Volume (mm³)", row.get("Voxel Volume 3", "0")))
+        volume_ratio = float(row["Volume Ratio (%)"])
+
+        if volume_mm3 == 0 and volume_ratio == 0:
+            continue
+
+        file_data[label_id] = {
+            "voxel_count": int(row["Voxel Count"]),
+            "volume_mm3": float(row.get("Voxel Volume (mm³)", row.get("Voxel Volume 3", "0"))),
+            "volume_ratio": float(row["Volume Ratio (%)"]),
+        }
 
-        
-        subject_total = sum(d["volume_mm3"] for lid, d in file_data.items() if lid != 0)
+    
+    subject_total = sum(d["volume_mm3"] for lid, d in file_data.items() if lid != 0)
 
-        for group, ids in categories.items():
-            if file_id in ids:
-                grouped_volumes[group].extend([(lid, d["volume_mm3"], d["volume_ratio"]) for lid, d in file_data.items()])
-                group_total_volumes[group].append(subject_total)
+    for group, ids in categories.items():
+        if file_id in ids:
+            grouped_volumes[group].extend([(lid, d["volume_mm3"], d["volume_ratio"]) for lid, d in file_data.items()])
+            group_total_volumes[group].append(subject_total)
     
     grouped_volumes["Overall"].extend([(lid, d["volume_mm3"], d["volume_ratio"]) for lid, d in file_data.items()])
     group_total_volumes["Overall"].append(subject_total)
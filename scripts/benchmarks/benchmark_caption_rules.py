@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+from datetime import datetime, timezone
+
+from benchmark_pipeline import git_revision
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_shards import iter_caption_folder, is_sharded
+from caption_rewrite import LiteralRule, ConnectorRule, apply_rules, compile_rules
+
+# Benchmark of the caption fix rules on a generated corpus (a captions_3d folder).
+# All the captions are loaded in memory first, so that only the text processing is
+# timed: the current approach (one pass per rule: str.replace for the modality
+# fixes as in modalite*.py, the connector alternation regex of delete_connectors.py)
+# against the single-scan multi-pattern matcher of caption_rewrite.compile_rules.
+# Both must give the same captions; the number of differences is reported.
+
+
+def default_rules(extra_rules=0):
+    """Fix rules of the scripts (modality placeholders, units, connectors), plus extra_rules whole-word renames."""
+    rules = [
+        LiteralRule("None scan", "T1 scan"),
+        LiteralRule("None image", "T1 image"),
+        LiteralRule("mm3", "mm³", whole_word=True),
+        LiteralRule("cm3", "cm³", whole_word=True),
+        ConnectorRule(),
+    ]
+    # Renames of structure names, as the rule list grows (most of them never match)
+    rules += [LiteralRule(f"structure{i}", f"region{i}", whole_word=True) for i in range(extra_rules)]
+    return rules
+
+
+def load_corpus(folder):
+    """Captions of every caption folder under folder (per-file or sharded layout)."""
+    captions = []
+    for root, dirs, files in os.walk(folder):
+        if is_sharded(root) or any(name.endswith("_captions.json") for name in files):
+            for _, image_captions in iter_caption_folder(root):
+                captions.extend(image_captions)
+    return captions
+
+
+def time_rules(captions, rules, repeat):
+    times, output = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = [apply_rules(caption, rules) for caption in captions]
+        times.append(time.perf_counter() - start)
+    return times, output
+
+
+def summary(times, n_captions):
+    return {
+        "time_s": [round(t, 4) for t in times],
+        "time_min_s": round(min(times), 4),
+        "time_median_s": round(statistics.median(times), 4),
+        "captions_per_s": round(n_captions / min(times)) if min(times) > 0 else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the caption fix rules: one pass per rule against a single scan")
+    parser.add_argument("folder", type=str, help="Caption corpus (captions_3d folder, searched recursively)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each approach (default: 3)")
+    parser.add_argument("--extra-rules", type=int, nargs="+", default=[0, 50],
+                        help="Numbers of additional whole-word rules to measure (default: 0 50)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON results file (default: benchmark_caption_rules_<date>.json)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    captions = load_corpus(args.folder)
+    print(f"{len(captions)} captions loaded from {args.folder} in {time.perf_counter() - start:.1f} s")
+    if not captions:
+        sys.exit("No caption found")
+
+    results = []
+    for extra_rules in args.extra_rules:
+        rules = default_rules(extra_rules)
+        sequential_times, sequential_output = time_rules(captions, rules, args.repeat)
+        single_times, single_output = time_rules(captions, compile_rules(rules), args.repeat)
+        differences = sum(a != b for a, b in zip(sequential_output, single_output))
+        result = {
+            "rules": len(rules),
+            "sequential": summary(sequential_times, len(captions)),
+            "single_scan": summary(single_times, len(captions)),
+            "speedup": round(min(sequential_times) / min(single_times), 2),
+            "differences": differences,
+        }
+        print(f"{len(rules):4d} rules  sequential {min(sequential_times):8.3f} s  single scan {min(single_times):8.3f} s"
+              f"  x{result['speedup']:.2f}  {differences} difference(s)")
+        results.append(result)
+
+    started = datetime.now(timezone.utc)
+    report = {
+        "date": started.isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": os.path.abspath(args.folder),
+        "captions": len(captions),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    output = args.output or f"benchmark_caption_rules_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from datetime import datetime, timezone
+
+from benchmark_pipeline import git_revision
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_dataset import scan_corpus, PairedCaptionDataset, PREFETCH_THREADS, check_worker_shards
+
+# Throughput of the paired volume+caption dataset (scripts/common/caption_dataset.py)
+# on a real SIR tree: one pass over the first --limit items for every number of
+# prefetch threads, in samples/s and MB/s of voxels delivered. With one thread the
+# reads are sequential, as in the hand-written training loops; the ratio shows how
+# much the prefetch threads hide the NIfTI decompression. The shards of --workers
+# DataLoader workers are checked first (disjoint, covering the epoch), with torch
+# through a real DataLoader.
+
+
+def check_dataloader(items, num_workers, options):
+    """Keys delivered by a DataLoader with num_workers workers: each item exactly once."""
+    from torch.utils.data import DataLoader
+    dataset = PairedCaptionDataset(items, with_keys=True, threads=1, **options)
+    keys = [key for key, _, _ in DataLoader(dataset, batch_size=None, num_workers=num_workers)]
+    if sorted(keys) != sorted(item.key for item in items):
+        raise ValueError(f"A DataLoader with {num_workers} workers did not deliver every item exactly once")
+
+
+def time_epoch(items, threads, options):
+    dataset = PairedCaptionDataset(items, threads=threads, **options)
+    start, samples, voxel_bytes = time.perf_counter(), 0, 0
+    for volume, _ in dataset:
+        samples += 1
+        voxel_bytes += sum(v.nbytes for v in volume) if isinstance(volume, tuple) else volume.nbytes
+    elapsed = time.perf_counter() - start
+    return {
+        "threads": threads,
+        "samples": samples,
+        "time_s": round(elapsed, 3),
+        "samples_per_s": round(samples / elapsed, 2) if elapsed > 0 else None,
+        "mb_per_s": round(voxel_bytes / 1024 ** 2 / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the paired volume+caption dataset")
+    parser.add_argument("root", type=str, help="SIR folder (<modality>/<db>/{seg,brain,captions_3d})")
+    parser.add_argument("--volumes", nargs="+", default=["brain"], help="Volumes of every sample (brain, seg)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, PREFETCH_THREADS],
+                        help=f"Numbers of prefetch threads to measure (default: 1 {PREFETCH_THREADS})")
+    parser.add_argument("--crop", type=int, nargs=3, default=None, help="Centered crop (x y z)")
+    parser.add_argument("--downsample", type=int, default=1, help="Downsampling stride (default: 1)")
+    parser.add_argument("--limit", type=int, default=64, help="Number of items read per pass (default: 64)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 8],
+                        help="Numbers of DataLoader workers whose shards are checked (default: 2 8)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON results file (default: benchmark_dataset_<date>.json)")
+    args = parser.parse_args()
+
+    items = scan_corpus(args.root, volumes=tuple(args.volumes))[:args.limit]
+    if not items:
+        sys.exit("No item found")
+    print(f"{len(items)} items from {args.root}")
+    # Same order for every pass; the OS file cache favours the later passes, so run
+    # the benchmark twice or on a tree larger than the memory for cold reads
+    options = {"crop": args.crop, "downsample": args.downsample, "seed": 0}
+
+    for num_workers in args.workers:
+        check_worker_shards(PairedCaptionDataset(items, **options), num_workers)
+        try:
+            check_dataloader(items, num_workers, options)
+        except ImportError:
+            pass
+    print(f"Worker shards checked: {', '.join(map(str, args.workers))} workers")
+
+    results = []
+    for threads in args.threads:
+        result = time_epoch(items, threads, options)
+        print(f"{threads:3d} threads  {result['time_s']:8.2f} s  {result['samples_per_s']:8.2f} samples/s"
+              f"  {result['mb_per_s']:8.1f} MB/s")
+        results.append(result)
+
+    started = datetime.now(timezone.utc)
+    report = {
+        "date": started.isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "root": os.path.abspath(args.root),
+        "items": len(items),
+        "volumes": args.volumes,
+        "crop": args.crop,
+        "downsample": args.downsample,
+        "results": results,
+    }
+    output = args.output or f"benchmark_dataset_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
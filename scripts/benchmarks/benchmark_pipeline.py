@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+import nibabel as nib
+
+from synthetic_data import (ANATOMIE_CSV, SIMPLIFIED_CSV, DATASET_GEOMETRY, load_label_ids, scaled_shape,
+                            synthetic_label_volume, perturb_labels, save_nifti, write_metadata_csv)
+
+try:
+    import resource  # Peak memory of the child processes (Unix only)
+except ImportError:
+    resource = None
+
+# Benchmark of the pipeline stages on synthetic data.
+# Every stage is run as a separate process (as it is run by hand), timed, and its
+# peak resident memory (including its worker processes) is recorded. The results
+# are written as JSON, so that runs can be compared over time.
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATABASE = "OASIS"
+N_ATLASES = 3  # Registered atlases per subject for the majority voting
+
+
+def subject_name(index):
+    return f"OAS1_{index:04d}_MR1_mpr_n4_anon_sbj_111"
+
+
+def prepare_workspace(work, n_subjects, scale, seed):
+    """
+    Generate the synthetic database in work/ with the folder layout expected by each
+    stage (several scripts use paths relative to their working directory):
+      Keywords/                   label CSVs and fake metadata (OASIS_info.csv, Oasis_info.csv)
+      OASIS/seg/                  one label volume per subject
+      OASIS/reg/                  registered volumes for slice_json2.py (fixed images in data/T1/IBSR/seg)
+      OASIS/atlases/              N_ATLASES perturbed atlases per subject for MajorityVotingCorr.py
+      OASIS/compare_a, compare_b  "corrected majority" pairs for COMPARAISON.py
+    """
+    rng = np.random.default_rng(seed)
+    label_ids = load_label_ids()
+    shape, voxel_size = DATASET_GEOMETRY[DATABASE]
+    shape = scaled_shape(shape, scale)
+    root = os.path.join(work, DATABASE)
+    for folder in ("seg", "reg", "atlases", "compare_a", "compare_b", "majority"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    keywords = os.path.join(work, "Keywords")
+    os.makedirs(keywords, exist_ok=True)
+    shutil.copy(ANATOMIE_CSV, keywords)
+    shutil.copy(SIMPLIFIED_CSV, keywords)
+    ids = list(range(1, n_subjects + 1))
+    write_metadata_csv(os.path.join(keywords, "OASIS_info.csv"), ids, np.random.default_rng(seed), "{:04d}")
+    # caption_generator_speed.py looks for <dataset>_info.csv with the dataset name "Oasis"
+    write_metadata_csv(os.path.join(keywords, "Oasis_info.csv"), ids, np.random.default_rng(seed), "{:04d}")
+
+    for index in ids:
+        name = subject_name(index)
+        volume = synthetic_label_volume(shape, label_ids, rng)
+        save_nifti(volume, os.path.join(root, "seg", f"{name}.nii.gz"), voxel_size)
+        save_nifti(volume, os.path.join(root, "reg", f"OAS1_{index:04d}_MR1_reg_IBSR_01.nii.gz"), voxel_size)
+        for atlas in range(N_ATLASES):
+            atlas_volume = perturb_labels(volume, rng)
+            save_nifti(atlas_volume, os.path.join(root, "atlases", f"atlas{atlas}_reg_to_mni_{name}.nii.gz"), voxel_size)
+        save_nifti(volume, os.path.join(root, "compare_a", f"OAS1_{index:04d}_corrected_majority.nii.gz"), voxel_size)
+        save_nifti(perturb_labels(volume, rng), os.path.join(root, "compare_b", f"OAS1_{index:04d}_corrected_majority.nii.gz"),
+                   voxel_size)
+
+    # Fixed image of the registrations (slice_json2.py reads ../data/T1/IBSR/seg from its working directory)
+    fixed_folder = os.path.join(work, "data", "T1", "IBSR", "seg")
+    os.makedirs(fixed_folder, exist_ok=True)
+    ibsr_shape, ibsr_voxel_size = DATASET_GEOMETRY["IBSR"]
+    save_nifti(synthetic_label_volume(scaled_shape(ibsr_shape, scale), label_ids, rng),
+               os.path.join(fixed_folder, "IBSR_01_seg_ana.nii.gz"), ibsr_voxel_size)
+
+    return {"database": DATABASE, "subjects": n_subjects, "shape": list(shape), "voxel_size": list(voxel_size),
+            "labels": len(label_ids), "seed": seed, "scale": scale}
+
+
+def copy_descriptions(work):
+    """simple_descriptions.py reads description_3d_oasis/ and simplified_IBSR.csv from its working directory."""
+    root = os.path.join(work, DATABASE)
+    target = os.path.join(root, "description_3d_oasis")
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    source = os.path.join(root, "descriptions")
+    for name in os.listdir(source):
+        if name.endswith("_description3D.csv"):
+            shutil.copy(os.path.join(source, name), target)
+    shutil.copy(SIMPLIFIED_CSV, root)
+
+
+def define_stages(work):
+    """(name, working directory, command, setup function or None) of every stage, in pipeline order."""
+    py = sys.executable
+    root = os.path.join(work, DATABASE)
+    captions = os.path.join(SCRIPTS_DIR, "captions")
+    stats = os.path.join(SCRIPTS_DIR, "analyse_statistique")
+    caption_speed = (
+        "import sys; sys.path.insert(0, sys.argv[1]); import caption_generator_speed as m; "
+        "ids = m.calculate_top_variance_structures(sys.argv[3], 10); "
+        "m.process_folder(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], ids)"
+    )
+    return [
+        ("description_generator", work,
+         [py, os.path.join(captions, "description_generator.py"), "Keywords/Anatomie_IBSR.csv",
+          f"{DATABASE}/seg", f"{DATABASE}/descriptions", "--force"], None),
+        ("description_generator_simple", work,
+         [py, os.path.join(captions, "description_generator.py"), "Keywords/Anatomie_IBSR.csv",
+          f"{DATABASE}/seg", f"{DATABASE}/descriptions_fused", "--force",
+          "--simple-groupings", "Keywords/simplified_IBSR.csv",
+          "--simple-output-folder", f"{DATABASE}/descriptions_simple"], None),
+        ("simple_descriptions", root,
+         [py, os.path.join(captions, "simple_descriptions.py"), "--force"], copy_descriptions),
+        ("caption_generator_speed", work,
+         [py, "-c", caption_speed, captions, f"{DATABASE}/seg", f"{DATABASE}/descriptions", "Keywords",
+          f"{DATABASE}/captions_3d"], None),
+        ("slice_json2", root,
+         [py, os.path.join(SCRIPTS_DIR, "test_json", "slice_json2.py"), os.path.join(root, "reg")], None),
+        ("MajorityVotingCorr", work,
+         [py, os.path.join(SCRIPTS_DIR, "MajorityVoting&CorrectionDesLabels", "MajorityVotingCorr.py"),
+          f"{DATABASE}/atlases", f"{DATABASE}/majority"], None),
+        ("COMPARAISON", root,
+         [py, os.path.join(SCRIPTS_DIR, "ComparaisonDesDeuxAtlas", "COMPARAISON.py"), "compare_a", "compare_b"], None),
+        ("statistiques_cerveux", work,
+         [py, os.path.join(stats, "statistiques_cerveux.py"), f"{DATABASE}/descriptions"], None),
+        ("statistiques_cerveux_simplified", work,
+         [py, os.path.join(stats, "statistiques_cerveux_simplified.py"), f"{DATABASE}/descriptions_simple"], None),
+    ]
+
+
+def run_measured(command, cwd, env):
+    """Run a command, return (return code, wall time in s, peak RSS in MB or None, stderr tail)."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    peak_rss_mb = None
+    if resource is not None and hasattr(os, "wait4"):
+        stderr = process.stderr.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss covers the process and its waited-for children (worker pools);
+        # it is in kB on Linux and in bytes on macOS
+        divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+        peak_rss_mb = round(usage.ru_maxrss / divisor, 1)
+    else:
+        _, stderr = process.communicate()
+    wall_time = time.perf_counter() - start
+    tail = stderr.decode("utf-8", errors="replace").strip().splitlines()[-5:]
+    return process.returncode, wall_time, peak_rss_mb, tail
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPTS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(work, stage_names=None, repeat=1, cache=False):
+    env = {k: v for k, v in os.environ.items() if k != "SIR_VOLUME_CACHE"}
+    env["MPLBACKEND"] = "Agg"  # Plots are saved, never shown
+    if cache:
+        env["SIR_VOLUME_CACHE"] = os.path.join(work, "volume_cache")
+
+    results = []
+    for name, cwd, command, setup in define_stages(work):
+        if stage_names and name not in stage_names:
+            continue
+        if setup is not None:
+            setup(work)
+        times, peaks, returncode, tail = [], [], 0, []
+        for _ in range(repeat):
+            returncode, wall_time, peak_rss_mb, tail = run_measured(command, cwd, env)
+            if returncode != 0:
+                break
+            times.append(wall_time)
+            peaks.append(peak_rss_mb)
+        result = {"stage": name, "status": "ok" if returncode == 0 else "failed", "returncode": returncode}
+        if times:
+            result.update({
+                "wall_time_s": [round(t, 3) for t in times],
+                "wall_time_min_s": round(min(times), 3),
+                "wall_time_median_s": round(statistics.median(times), 3),
+                "peak_rss_mb": max(peaks) if None not in peaks else None,
+            })
+        if returncode != 0:
+            result["stderr_tail"] = tail
+        status = f"{result['wall_time_min_s']:.2f} s, {result['peak_rss_mb']} MB" if times else "FAILED: " + " | ".join(tail[-1:])
+        print(f"{name:32s} {status}")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages on synthetic NIfTI label volumes")
+    parser.add_argument("--subjects", type=int, default=4, help="Number of synthetic subjects (default: 4)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Scale of the volume shape (1.0 = real OASIS size, 0.5 for a quick run)")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each stage (default: 1)")
+    parser.add_argument("--stages", nargs="+", default=None, help="Stages to run (default: all)")
+    parser.add_argument("--cache", action="store_true", help="Enable the shared volume cache ($SIR_VOLUME_CACHE)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Folder of the synthetic data (default: temporary folder, deleted at the end)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON results file (default: benchmark_<date>.json)")
+    args = parser.parse_args()
+
+    work = args.workdir or tempfile.mkdtemp(prefix="sir_benchmark_")
+    os.makedirs(work, exist_ok=True)
+    work = os.path.abspath(work)
+    try:
+        print(f"Generating {args.subjects} synthetic subjects in {work}...")
+        start = time.perf_counter()
+        dataset = prepare_workspace(work, args.subjects, args.scale, args.seed)
+        print(f"Synthetic data ready in {time.perf_counter() - start:.1f} s, shape {dataset['shape']}")
+        stages = run_benchmark(work, args.stages, args.repeat, args.cache)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    started = datetime.now(timezone.utc)
+    report = {
+        "date": started.isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "nibabel": nib.__version__,
+        "volume_cache": args.cache,
+        "repeat": args.repeat,
+        "dataset": dataset,
+        "stages": stages,
+    }
+    output = args.output or f"benchmark_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
@@ -0,0 +1,76 @@
+import os
+import csv
+import numpy as np
+import nibabel as nib
+
+# Synthetic data for the benchmarks: labelled NIfTI volumes with the IBSR label
+# set (scripts/metafolder/Anatomie_IBSR.csv) and fake metadata CSVs, with the
+# sizes and voxel spacings of the real databases.
+METAFOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "metafolder")
+ANATOMIE_CSV = os.path.join(METAFOLDER, "Anatomie_IBSR.csv")
+SIMPLIFIED_CSV = os.path.join(METAFOLDER, "simplified_IBSR.csv")
+
+# Shape and voxel size (mm) of the segmentations of each database
+DATASET_GEOMETRY = {
+    "OASIS": ((176, 208, 176), (1.0, 1.0, 1.0)),
+    "IBSR": ((256, 128, 256), (0.9375, 1.5, 0.9375)),
+    "Kirby": ((256, 256, 180), (0.9375, 0.9375, 1.0)),
+    "IXI": ((256, 256, 150), (0.9375, 0.9375, 1.2)),
+}
+
+
+def load_label_ids(anatomie_csv=ANATOMIE_CSV):
+    """IDs of the IBSR labels (without the background 0)."""
+    with open(anatomie_csv, mode="r", encoding="ISO-8859-1") as file:
+        return [int(row["ID"]) for row in csv.DictReader(file) if int(row["ID"]) != 0]
+
+
+def scaled_shape(shape, scale):
+    return tuple(max(int(round(n * scale)), 8) for n in shape)
+
+
+def synthetic_label_volume(shape, label_ids, rng, block=8):
+    """
+    Label volume made of block x block x block patches of random IBSR labels inside
+    an ellipsoid "brain", background 0 outside. Every label gets a few patches, so
+    the volume has the label count of a real segmentation.
+    """
+    coarse_shape = tuple(-(-n // block) for n in shape)
+    coarse = rng.choice(np.array(label_ids, dtype=np.uint8), size=coarse_shape)
+    volume = coarse.repeat(block, axis=0).repeat(block, axis=1).repeat(block, axis=2)
+    volume = volume[:shape[0], :shape[1], :shape[2]]
+
+    x, y, z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    cx, cy, cz = [(n - 1) / 2 for n in shape]
+    brain = ((x - cx) / (0.45 * shape[0])) ** 2 + ((y - cy) / (0.45 * shape[1])) ** 2 \
+        + ((z - cz) / (0.45 * shape[2])) ** 2 <= 1
+    volume[~brain] = 0
+    return np.ascontiguousarray(volume)
+
+
+def perturb_labels(volume, rng, fraction=0.05, block=4):
+    """Copy of a label volume where a fraction of the blocks take another label (a second rater/atlas)."""
+    perturbed = volume.copy()
+    labels = np.unique(volume)
+    n_blocks = int(fraction * volume.size / block ** 3)
+    corners = [rng.integers(0, max(n - block, 1), size=n_blocks) for n in volume.shape]
+    for i, j, k in zip(*corners):
+        perturbed[i:i + block, j:j + block, k:k + block] = rng.choice(labels)
+    return perturbed
+
+
+def save_nifti(volume, path, voxel_size):
+    affine = np.diag(list(voxel_size) + [1.0])
+    img = nib.Nifti1Image(volume, affine)
+    img.header.set_zooms(voxel_size)
+    nib.save(img, path)
+
+
+def write_metadata_csv(path, ids, rng, id_format="{}"):
+    """Fake <database>_info.csv (ID, AGE, GENDER, HAND) for the given subject IDs."""
+    with open(path, mode="w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["ID", "AGE", "GENDER", "HAND"])
+        for subject_id in ids:
+            writer.writerow([id_format.format(subject_id), int(rng.integers(8, 95)),
+                             rng.choice(["M", "F"]), rng.choice(["R", "L"])])
@@ -1,37 +1,35 @@
 import pandas as pd
-import re
+import numpy as np
 import json
 import nibabel as nib  # To read NIfTI files
 import os
 import argparse
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from subject_index import parse_subject
+from description_index import description_index, report_missing
+from caption_options import DATASET_MODALITIES
+from caption_shards import remove_shards
+
+# Dataset des légendes -> base de l'index des sujets (tags des noms de fichiers)
+DATASET_DATABASES = {"Kirby": "Kirby", "Oasis": "OASIS", "IBSR": "IBSR", "IXI": "IXI"}
 
 
 ##############################################################################################################################
 # exemple de faire: python caption_generator.py dossier_images_3D dossier_3D_desciption dossier_avec_info_data output
 # exemple de faire: python caption_generator.py OASIS description_3d_oasis metafolder captions_oasis
 def generate_human_like_caption(image_filename, structures_file, metadata_file, output_file, image_type):
-    # Extract ID and type from image filename using regex
-    match = None
-    if image_type == "Kirby":
-        match = re.search(r'KKI2009-(\d+)-([A-Z]+)', image_filename)
-        scan_type = "FLAIR"
-    elif image_type == "Oasis":
-        # Updated regex to match OAS1_0026_majority.nii.gz format
-        match = re.search(r'OAS1_(\d+)_([A-Za-z0-9\-]+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IBSR":
-        match = re.search(r'IBSR_(\d+)-([A-Z]+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IXI":
-        match = re.search(r'IXI(\d+)-IOP-\d+-[A-Za-z0-9\-]+_majority', image_filename)
-        scan_type = "T2"
-
-    if not match:
+    # Extract ID (and, for Kirby, the scan type) from the subject tag of the image filename
+    tag = parse_subject(image_filename, DATASET_DATABASES[image_type]) if image_type in DATASET_DATABASES else None
+    scan_type = DATASET_MODALITIES.get(image_type)
+
+    if tag is None:
         raise ValueError(f"Invalid image filename format for file: {image_filename}")
 
-    image_id = int(match.group(1))
+    image_id = tag.subject_id
     if image_type == "Kirby":
-        image_type = match.group(2)  # For Kirby, use the second match group as the type
+        image_type = tag.modality  # For Kirby, use the modality of the tag as the type
     # Load CSV files
     structures_df = pd.read_csv(structures_file, encoding='latin1')
     metadata_df = pd.read_csv(metadata_file, encoding='latin1')
@@ -47,8 +45,7 @@ def generate_human_like_caption(image_filename, structures_file, metadata_file,
 
     # Load the 3D image to get dimensions
     img = nib.load(image_filename)  # Load the NIfTI image
-    image_data = img.get_fdata().astype(int)  # Convert the image data to integers for processing
-    total_voxels = image_data.size  # Total number of voxels in the image
+    total_voxels = int(np.prod(img.shape))  # Total number of voxels in the image (from the header)
 
     # Filter out unknown structures
     filtered_structures = structures_df[structures_df['Label'] != "Unknown"]
@@ -110,39 +107,32 @@ def generate_human_like_caption(image_filename, structures_file, metadata_file,
 def process_folder(folder_path, csv_folder, metadata_folder, output_folder):
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
+    # Sharded captions of a previous run would be preferred by the readers
+    remove_shards(output_folder)
+
+    # Index the description folder once and report the images without a description
+    descriptions = description_index(csv_folder)
+    report_missing(descriptions, [f for f in os.listdir(folder_path) if f.endswith(".nii.gz")])
 
     # Loop through all files in the folder
     for file_name in os.listdir(folder_path):
         if file_name.endswith(".nii.gz"):  # Check for NIfTI files
             image_path = os.path.join(folder_path, file_name)
 
-            # Determine the dataset type based on the filename pattern
-            if "KKI2009" in file_name:
-                image_type = "Kirby"
-                metadata_file = os.path.join(metadata_folder, "Kirby_info.csv")
-            elif "OAS1" in file_name:
-                image_type = "Oasis"
-                metadata_file = os.path.join(metadata_folder, "OASIS_info.csv")
-            elif "IBSR" in file_name:
-                image_type = "IBSR"
-                metadata_file = os.path.join(metadata_folder, "IBSR_info.csv")
-            elif "IXIID-IOP" in file_name:
-                image_type = "IXI"
-                metadata_file = os.path.join(metadata_folder, "IXI_info.csv")
-            else:
+            # Determine the dataset type from the subject tag of the filename
+            tag = parse_subject(file_name)
+            if tag is None:
                 print(f"Unknown dataset type for image: {file_name}")
                 continue
+            image_type = next(d for d, database in DATASET_DATABASES.items() if database == tag.database)
+            metadata_file = os.path.join(metadata_folder, f"{tag.database}_info.csv")
 
             # Find the corresponding CSV file for this image
             base_name = os.path.splitext(file_name)[0]  # Remove extension
-            corresponding_csv = None
-            for csv_file in os.listdir(csv_folder):
-                if csv_file.startswith(base_name):
-                    corresponding_csv = os.path.join(csv_folder, csv_file)
-                    break
+            corresponding_csv = descriptions.find(base_name)
 
             if not corresponding_csv:
-                print(f"No corresponding CSV found for image: {file_name}")
+                # Already reported by report_missing
                 continue
 
             output_file = os.path.join(output_folder, f"{base_name}_captions.json")
@@ -1,160 +1,212 @@
 import pandas as pd
-import re
+import numpy as np
+import io
 import json
 import nibabel as nib  # Pour lire les fichiers NIfTI
 import os
+import sys
 import random
+import argparse
+import functools
+from collections import namedtuple
 from multiprocessing import Pool
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from variance_ranking import top_variance_structures
+from subject_index import parse_subject
+from description_index import description_index, report_missing
+from metadata_table import load_metadata_table, load_metadata_tables, lookup_subject
+from structure_table import known_structures, structure_table, sort_by_volume, filter_structures, caption_structures
+from caption_shards import OUTPUT_FORMATS, CaptionShardWriter, remove_shards
+from caption_augmentation import CaptionAugmenter, caption_seed
+from caption_options import modality_map, CONNECTORS
+from io_pipeline import run_pipeline
+
+# Dataset des légendes -> base de l'index des sujets (tags des noms de fichiers)
+DATASET_DATABASES = {"Kirby": "Kirby", "Oasis": "OASIS", "IBSR": "IBSR", "IXI": "IXI"}
+
+# Tables de métadonnées (chemin du _info.csv -> {ID: âge, genre}) préchargées par le
+# processus principal et transmises aux processus du Pool par init_worker
+METADATA_TABLES = {}
+# Paramètres du rendu (variantes, nombre de légendes, graine), transmis de la même façon
+RENDER_SETTINGS = {}
+
+def init_worker(metadata_tables, render_settings=None):
+    """Initialisation d'un processus du Pool avec les tables de métadonnées déjà chargées."""
+    METADATA_TABLES.update(metadata_tables)
+    RENDER_SETTINGS.update(render_settings or {})
+
 # Entrées (définies directement dans le code, pas via la ligne de commande)
 INPUT_FOLDER = r"E:\SIR\FL\Kirby_OASIS\seg"          # Dossier des images
 CSV_FOLDER = r"E:\SIR\FL\Kirby_OASIS\descriptions"     # Dossier des CSV de description
 METADATA_FOLDER = r"E:\SIR\Keywords"                   # Dossier des métadonnées
 OUTPUT_BASE_FOLDER = r"E:\SIR\FL\Kirby_OASIS\captions_3d"  # Dossier de sortie
+# Format de sortie : "json" (un fichier <image>_captions.json par image et par variante),
+# "jsonl" ou "jsonl.gz" (quelques gros fichiers JSON Lines par variante et un index.json)
+OUTPUT_FORMAT = "json"
+# Augmentation : nombre de légendes distinctes par image et par variante, tirées avec une
+# graine propre à chaque image (reproductibles avec le Pool). None : les 9 modèles, une fois chacun
+CAPTIONS_PER_IMAGE = None
+CAPTION_SEED = 0
+# Rendu : modalité écrite par dataset (seulement les changements, ex. {"Kirby": "T1"} ;
+# par défaut Kirby : FLAIR, Oasis : T1, IBSR : T1, IXI : T2) et phrases des structures
+# reliées par des connecteurs (False : sans connecteurs, à la place de delete_connectors.py)
+MODALITIES = {}
+USE_CONNECTORS = True
+# Pipeline : threads de lecture (CSV de description et en-têtes NIfTI lus d'avance),
+# processus de rendu, et images au plus entre leur lecture et la fin de leur écriture
+READER_THREADS = 4
+RENDER_PROCESSES = 8
+MAX_IN_FLIGHT = 64
+
+# Modèles de phrase ; une variante peut choisir un jeu par son nom ou donner sa propre liste
+TEMPLATES = [
+    "This {scan_type} scan shows a {gender} subject aged {age} with dimensions {dimensions}. Brain volume is {brain_volume} cm3. The most prominent structures are {structures}",
+    "A {scan_type} scan of a {gender} subject, {age} years old, with image dimensions {dimensions}. The total brain volume is {brain_volume} cm3, including major structures like {structures}",
+    "Here we see a {scan_type} scan of a {gender} subject aged {age}. The image dimensions are {dimensions}, and the brain volume is {brain_volume} cm3. Visible structures include {structures}",
+    "In this {scan_type} scan of a {age}-year-old {gender} subject, the image has dimensions {dimensions} and displays structures such as {structures} The brain volume is {brain_volume} cm3.",
+    "This {scan_type} scan captures the brain of a {gender} subject aged {age} with image dimensions {dimensions}. The brain volume is {brain_volume} cm3. Key structures include {structures}",
+    "This {scan_type} scan shows the brain of a {gender} subject aged {age}, with dimensions {dimensions}. The total brain volume is {brain_volume} cm3, and visible structures include {structures}",
+    "Here is a {scan_type} scan of a {gender} subject aged {age}, with image dimensions {dimensions}. The brain volume is {brain_volume} cm3 and the visible structures include {structures}",
+    "This {scan_type} scan provides a view of the brain of a {gender} subject, aged {age}, with dimensions of {dimensions}. Brain volume is {brain_volume} cm3, and visible structures include {structures}",
+    "This is a {scan_type} scan of a {age}-year-old {gender}, with dimensions {dimensions}. The brain volume is {brain_volume} cm3, displaying structures like {structures}",
+]
+TEMPLATE_SETS = {"default": TEMPLATES}
+
+# Variantes de légendes produites pour chaque image : nom, sous-dossier de sortie, filtres
+# (selection : IDs, size : n plus grandes structures, var : n structures de plus grande
+# variance ou liste d'IDs) et modèles de phrase. Un fichier de configuration JSON
+# (--config) peut en définir d'autres ; toutes sont produites à partir du même contexte.
+CaptionVariant = namedtuple("CaptionVariant", ["name", "folder", "selection", "size", "var", "templates"])
+VARIANT_KEYS = set(CaptionVariant._fields)
+DEFAULT_VARIANTS = [
+    {"name": "captions_exhaustive"},
+    {"name": "captions_selection", "selection": [2,41,3,42,4,43,10,48,49,17,53,18,54,11,50,12,51,13,52,14,16,26,58]},
+    {"name": "captions_size_10", "size": 10},
+    {"name": "captions_var_10", "var": 10},
+]
+# Clés d'un fichier de configuration (les autres que variants sont les arguments de process_folder)
+CONFIG_KEYS = {"input_folder", "csv_folder", "metadata_folder", "output_folder", "output_format",
+               "captions_per_image", "seed", "modalities", "connectors", "variants"}
 
 ###############################################
 def calculate_top_variance_structures(csv_folder, n):
     """Calcule les n structures avec la plus grande variance et retourne leurs IDs."""
-    structure_variances = {}
-    # Associer chaque label à son ID
-    label_to_id = {}
-    # Parcourir les CSV pour collecter les volumes
-    for csv_file in os.listdir(csv_folder):
-        if csv_file.endswith(".csv"):
-            file_path = os.path.join(csv_folder, csv_file)
-            df = pd.read_csv(file_path, encoding='latin1')
-            for _, row in df.iterrows():
-                label = row['Label']
-                if label == "Unknown":
-                    continue
-                volume = row['Voxel Volume (mm³)']
-                structure_id = row['ID']  # On suppose que le CSV contient une colonne "ID"
-                if label not in structure_variances:
-                    structure_variances[label] = []
-                    label_to_id[label] = structure_id
-                structure_variances[label].append(volume)
-    # Calculer la variance de chaque structure
-    variance_results = {label: pd.Series(volumes).var() for label, volumes in structure_variances.items()}
-    # Trier par variance décroissante et prendre les n premiers
-    top_structures = sorted(variance_results.items(), key=lambda x: x[1], reverse=True)[:n]
-    top_ids = [label_to_id[label] for label, _ in top_structures]
-    return top_ids
-
-def generate_human_like_caption(image_filename, csv_folder, structures_file, metadata_file, output_file, a, image_type, selection=None, size=None, var=None):
-    # Extraire l'ID et le type à partir du nom de fichier
-    match = None
-    if image_type == "Kirby":
-        match = re.search(r'KKI2009-(\d+)-([A-Z]+)', image_filename)
-        scan_type = "FLAIR"
-    elif image_type == "Oasis":
-        match = re.search(r'OAS1_(\d+)_([A-Za-z0-9\-]+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IBSR":
-        match = re.search(r'IBSR_(\d+)_(.+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IXI":
-        match = re.search(r'IXI(\d+)-IOP-\d+-([A-Z]+)', image_filename)
-        scan_type = "T2"
-    scan_type = a
-
-    if not match:
+    # Classement mis en cache dans le dossier (variance_ranking.json), calculé une fois par processus
+    return top_variance_structures(csv_folder, n)
+
+def resolve_variants(variants, csv_folder):
+    """Variantes de la configuration (dicts) -> CaptionVariant, avec les IDs de variance calculés une fois."""
+    resolved = []
+    for variant in variants:
+        unknown = set(variant) - VARIANT_KEYS
+        if unknown or "name" not in variant:
+            raise ValueError(f"Variante invalide : {variant} (clés possibles : {', '.join(sorted(VARIANT_KEYS))})")
+        templates = variant.get("templates")
+        if isinstance(templates, str):
+            if templates not in TEMPLATE_SETS:
+                raise ValueError(f"Jeu de modèles inconnu : {templates} (connus : {', '.join(TEMPLATE_SETS)})")
+            templates = TEMPLATE_SETS[templates]
+        var = variant.get("var")
+        if isinstance(var, int):
+            var = calculate_top_variance_structures(csv_folder, var)
+        resolved.append(CaptionVariant(variant["name"], variant.get("folder", variant["name"]),
+                                       variant.get("selection"), variant.get("size"), var, templates))
+    folders = [v.folder for v in resolved]
+    if len(set(folders)) != len(folders):
+        raise ValueError(f"Plusieurs variantes écrivent dans le même dossier : {folders}")
+    return resolved
+
+def load_run_config(config_path):
+    """Fichier de configuration JSON d'une exécution : dossiers, format de sortie et variantes."""
+    with open(config_path, mode="r", encoding="utf-8") as file:
+        config = json.load(file)
+    unknown = set(config) - CONFIG_KEYS
+    if unknown:
+        raise ValueError(f"Clés inconnues dans {config_path} : {', '.join(sorted(unknown))}")
+    missing = {"input_folder", "csv_folder", "metadata_folder", "output_folder"} - set(config)
+    if missing:
+        raise ValueError(f"Clés manquantes dans {config_path} : {', '.join(sorted(missing))}")
+    return config
+
+def load_caption_context(image_filename, structures_file, metadata_file, image_type):
+    """
+    Informations d'une image communes à toutes les variantes de légendes : sujet,
+    métadonnées, dimensions (lues dans l'en-tête NIfTI seulement, sans décoder les
+    voxels) et structures du CSV de description. Construit une seule fois par image.
+    """
+    # Extraire l'ID (et, pour Kirby, le type) à partir du tag du sujet dans le nom de fichier
+    tag = parse_subject(image_filename, DATASET_DATABASES[image_type]) if image_type in DATASET_DATABASES else None
+
+    if tag is None:
         raise ValueError(f"Format de nom de fichier invalide : {image_filename}")
 
-    image_id = int(match.group(1))
-    if image_type == "Kirby":
-        image_type = match.group(2)
-
-    # Charger les fichiers CSV
+    # Charger le CSV de description ; dimensions de l'image 3D : en-tête seulement, les voxels ne sont pas lus
     structures_df = pd.read_csv(structures_file, encoding='latin1')
-    metadata_df = pd.read_csv(metadata_file, encoding='latin1')
+    shape = nib.load(image_filename).shape
+    return build_caption_context(tag, structures_df, shape, metadata_file)
 
-    # Rechercher les métadonnées correspondant à l'image
-    metadata = metadata_df[metadata_df['ID'] == image_id]
-    if metadata.empty:
-        age = "unknown"
-        gender = "human"
-    else:
-        if image_type == "IXI":
-            age = metadata.iloc[0]['AGE']
-            age = int(float(age.replace(",", "."))) if pd.notna(age) else "unknown"
-        else:
-            age = metadata.iloc[0]['AGE']
-            age = age if pd.notna(age) else "unknown"
-        gender = metadata.iloc[0]['GENDER']
-        gender = gender if pd.notna(gender) else "human"
+def build_caption_context(tag, structures_df, shape, metadata_file):
+    """Contexte d'une image à partir du CSV de description et des dimensions déjà lus."""
+    image_id = tag.subject_id
+
+    # Rechercher les métadonnées de l'image : table indexée par ID, préchargée pour
+    # le Pool (init_worker) ou lue une seule fois par processus
+    table = METADATA_TABLES.get(metadata_file)
+    if table is None:
+        table = load_metadata_table(metadata_file)
+    age, gender = lookup_subject(table, image_id)
 
-    # Charger l'image 3D et obtenir ses dimensions
-    img = nib.load(image_filename)
-    image_data = img.get_fdata().astype(int)
-    total_voxels = image_data.size
+    total_voxels = int(np.prod(shape))
 
     # Filtrer les structures inconnues
-    filtered_structures = structures_df[structures_df['Label'] != "Unknown"]
+    filtered_structures = known_structures(structures_df)
     # Calculer le volume du cerveau
     brain_volume = round(filtered_structures['Voxel Volume (mm³)'].sum() / 1000)
 
-    # Générer la liste des structures avec volume et pourcentage
-    structures_with_volumes = []
-    for _, row in filtered_structures.iterrows():
-        structure_id = row['ID']
-        label = row['Label']
-        structure_volume = row['Voxel Volume (mm³)'] / 1000
-        percentage = round((row['Voxel Count'] / total_voxels) * 100, 2)
-        structures_with_volumes.append({
-            "id": structure_id,
-            "label": label,
-            "volume": structure_volume,
-            "percentage": percentage
-        })
-
-    # Trier par volume décroissant
-    sorted_structures = sorted(structures_with_volumes, key=lambda x: x['volume'], reverse=True)
-
-    # Filtrer selon le paramètre size
-    if size is not None:
-        sorted_structures = sorted_structures[:size]
-
-    # Filtrer selon selection
-    if selection is not None:
-        selected_structures = [s for s in sorted_structures if int(s['id']) in selection]
-        sorted_structures = selected_structures
+    # Table des structures (id, description, volume, pourcentage), triée par volume décroissant
+    structures = sort_by_volume(structure_table(filtered_structures, total_voxels))
+
+    return {
+        "age": age,
+        "gender": gender,
+        "shape": shape,
+        "brain_volume": brain_volume,
+        "structures": structures,
+    }
+
+def save_captions(captions, output_file):
+    # Sans output_file (sortie en JSON Lines), les légendes sont seulement renvoyées
+    if output_file is not None:
+        with open(output_file, 'w', encoding='utf-8') as json_file:
+            json.dump({"captions": captions}, json_file, ensure_ascii=False, indent=4)
+    return captions
+
+def generate_human_like_caption(image_filename, csv_folder, structures_file, metadata_file, output_file, a, image_type, selection=None, size=None, var=None, context=None, n_captions=None, seed=None, templates=None, use_connectors=True):
+    scan_type = a
+    # Contexte de l'image, partagé par les variantes (construit ici s'il n'est pas fourni)
+    if context is None:
+        context = load_caption_context(image_filename, structures_file, metadata_file, image_type)
+    age = context["age"]
+    gender = context["gender"]
+    brain_volume = context["brain_volume"]
 
     # Filtrer selon var (si c'est une liste, l'utiliser directement)
+    variance_ids = None
     if var is not None:
-        if isinstance(var, list):
-            variance_ids = var
-        else:
-            variance_ids = calculate_top_variance_structures(csv_folder, var)
-        selected_structures = [s for s in sorted_structures if int(s['id']) in variance_ids]
-        sorted_structures = selected_structures
+        variance_ids = var if isinstance(var, list) else calculate_top_variance_structures(csv_folder, var)
+
+    # Structures triées par volume décroissant, filtrées selon size, selection et var
+    structures = filter_structures(context["structures"], size=size, selection=selection, variance_ids=variance_ids)
 
     # Définir les modèles de phrase
-    templates = [
-        "This {scan_type} scan shows a {gender} subject aged {age} with dimensions {dimensions}. Brain volume is {brain_volume} cm3. The most prominent structures are {structures}",
-        "A {scan_type} scan of a {gender} subject, {age} years old, with image dimensions {dimensions}. The total brain volume is {brain_volume} cm3, including major structures like {structures}",
-        "Here we see a {scan_type} scan of a {gender} subject aged {age}. The image dimensions are {dimensions}, and the brain volume is {brain_volume} cm3. Visible structures include {structures}",
-        "In this {scan_type} scan of a {age}-year-old {gender} subject, the image has dimensions {dimensions} and displays structures such as {structures} The brain volume is {brain_volume} cm3.",
-        "This {scan_type} scan captures the brain of a {gender} subject aged {age} with image dimensions {dimensions}. The brain volume is {brain_volume} cm3. Key structures include {structures}",
-        "This {scan_type} scan shows the brain of a {gender} subject aged {age}, with dimensions {dimensions}. The total brain volume is {brain_volume} cm3, and visible structures include {structures}",
-        "Here is a {scan_type} scan of a {gender} subject aged {age}, with image dimensions {dimensions}. The brain volume is {brain_volume} cm3 and the visible structures include {structures}",
-        "This {scan_type} scan provides a view of the brain of a {gender} subject, aged {age}, with dimensions of {dimensions}. Brain volume is {brain_volume} cm3, and visible structures include {structures}",
-        "This is a {scan_type} scan of a {age}-year-old {gender}, with dimensions {dimensions}. The brain volume is {brain_volume} cm3, displaying structures like {structures}",
-    ]
+    templates = TEMPLATE_SETS["default"] if templates is None else templates
     
-    # Construire le texte de description des structures
-    unique_structures = {}
-    for struct in sorted_structures:
-        key = struct["label"].lower()
-        if key not in unique_structures or struct["volume"] > unique_structures[key]["volume"]:
-            unique_structures[key] = {**struct, "description": key}
-    sorted_structures = sorted(unique_structures.values(), key=lambda x: x['volume'], reverse=True)
-    sorted_structures = [s for s in sorted_structures if s["volume"] > 1]
-
-    connectors = [
-        "and", "additionally", "furthermore", "also", "moreover", "next", 
-        "in addition", "besides", "as well as", "then", "subsequently", "in particular", 
-        "alternatively", "on the other hand"
-    ]
+    # Construire le texte de description des structures (une par nom en minuscules, la plus grande)
+    sorted_structures = caption_structures(structures)
+
+    # Connecteurs : la liste de caption_options, qui sert aussi à les supprimer
+    connectors = CONNECTORS
 
     structures_sentences = []
     volume_phrases = [
@@ -167,13 +219,28 @@ def generate_human_like_caption(image_filename, csv_folder, structures_file, met
         "features a volume of", "includes a volume of"
     ]
 
+    # Augmentation : n_captions légendes distinctes, tirées avec la graine de l'image
+    if n_captions is not None:
+        fields = {
+            "scan_type": scan_type,
+            "gender": "male" if gender == "M" else "female",
+            "age": age,
+            "dimensions": f"{context['shape'][0]} x {context['shape'][1]} x {context['shape'][2]}",
+            "brain_volume": brain_volume,
+        }
+        augmenter = CaptionAugmenter(templates, volume_phrases, connectors if use_connectors else [])
+        return save_captions(augmenter.generate(fields, sorted_structures, n_captions, seed), output_file)
+
+    # Formulations et connecteurs tirés avec la graine de l'image et de la variante
+    # (render_image), jamais avec le générateur global partagé par le Pool
+    rng = random.Random(caption_seed(CAPTION_SEED, os.path.basename(image_filename)) if seed is None else seed)
     for i, s in enumerate(sorted_structures):
         volume = round(s["volume"] * 1000) if s["volume"] < 100 else round(s["volume"])
         unit = "mm3" if s["volume"] < 100 else "cm3"
-        volume_phrase = random.choice(volume_phrases)
+        volume_phrase = rng.choice(volume_phrases)
         sentence = f"the {s['description']} {volume_phrase} {volume} {unit}"
-        if i > 0:
-            sentence = random.choice(connectors) + " " + sentence
+        if i > 0 and use_connectors:
+            sentence = rng.choice(connectors) + " " + sentence
         structures_sentences.append(sentence)
 
     if structures_sentences:
@@ -191,100 +258,163 @@ def generate_human_like_caption(image_filename, csv_folder, structures_file, met
             scan_type=scan_type,
             gender="male" if gender == "M" else "female",
             age=age,
-            dimensions=f"{img.shape[0]} x {img.shape[1]} x {img.shape[2]}",
+            dimensions=f"{context['shape'][0]} x {context['shape'][1]} x {context['shape'][2]}",
             brain_volume=brain_volume,
             structures=structures_text
         )
         captions.append(caption)
 
-    with open(output_file, 'w', encoding='utf-8') as json_file:
-        json.dump({"captions": captions}, json_file, ensure_ascii=False, indent=4)
+    return save_captions(captions, output_file)
 
-    return captions
-
-def process_single_file(file_name, folder_path, csv_folder, metadata_folder, output_folder, dataset_keywords, dataset_keywords_modalite, variance_ids):
+def read_image(file_name, folder_path, csv_folder, metadata_folder, dataset_keywords, modalities):
+    """
+    Étape de lecture (threads du processus principal) : sujet, CSV de description
+    et en-tête NIfTI d'une image, lus d'avance pour les processus de rendu. None si
+    l'image n'est pas à traiter.
+    """
     # Traiter uniquement les fichiers .nii.gz
     if not file_name.endswith(".nii.gz"):
-        return
+        return None
     image_path = os.path.join(folder_path, file_name)
 
     # Déterminer le type de dataset
-    last_dataset = None
-    last_index = -1
-    for keyword, dataset in dataset_keywords.items():
-        index = file_name.rfind(keyword)
-        if index != -1 and index > last_index:
-            last_dataset = dataset
-            last_index = index
+    tag = parse_subject(file_name)
+    last_dataset = dataset_keywords.get(tag.database) if tag else None
     if not last_dataset:
-        return
-
-    # Définir la modalité selon le dataset
-    a = dataset_keywords_modalite.get(last_dataset, "T1")
-    metadata_file = os.path.join(metadata_folder, f"{last_dataset}_info.csv")
+        return None
 
     base_name = os.path.splitext(file_name)[0]
-    corresponding_csv = None
-    for csv_file in os.listdir(csv_folder):
-        if csv_file.startswith(base_name):
-            corresponding_csv = os.path.join(csv_folder, csv_file)
-            break
+    # Index du dossier des descriptions construit une fois par processus
+    corresponding_csv = description_index(csv_folder).find(base_name)
     if not corresponding_csv:
-        return
-
-    # Générer les légendes sans filtre
-    output_file_exhaustive = os.path.join(output_folder, "captions_exhaustive", f"{base_name}_captions.json")
-    generate_human_like_caption(image_path, csv_folder, corresponding_csv, metadata_file, output_file_exhaustive, a, last_dataset, selection=None, size=None, var=None)
-
-    # Générer les légendes avec filtre de sélection fixe
-    output_file_selection = os.path.join(output_folder, "captions_selection", f"{base_name}_captions.json")
-    generate_human_like_caption(image_path, csv_folder, corresponding_csv, metadata_file, output_file_selection, a, last_dataset, selection=[2,41,3,42,4,43,10,48,49,17,53,18,54,11,50,12,51,13,52,14,16,26,58], size=None, var=None)
-
-    # Générer les légendes en conservant les 10 premières structures
-    output_file_size_10 = os.path.join(output_folder, "captions_size_10", f"{base_name}_captions.json")
-    generate_human_like_caption(image_path, csv_folder, corresponding_csv, metadata_file, output_file_size_10, a, last_dataset, selection=None, size=10, var=None)
+        return None
+
+    with open(corresponding_csv, mode="r", encoding="latin1") as file:
+        csv_text = file.read()
+    return {
+        "file_name": file_name,
+        "base_name": base_name,
+        "image_path": image_path,
+        "csv_path": corresponding_csv,
+        "csv_text": csv_text,
+        # Dimensions : en-tête seulement, les voxels ne sont pas lus
+        "shape": nib.load(image_path).shape,
+        "dataset": last_dataset,
+        # Définir la modalité selon le dataset
+        "modality": modalities[last_dataset],
+        "metadata_file": os.path.join(metadata_folder, f"{last_dataset}_info.csv"),
+    }
 
-    # Générer les légendes avec filtrage par variance pré-calculée
-    output_file_var_10 = os.path.join(output_folder, "captions_var_10", f"{base_name}_captions.json")
-    generate_human_like_caption(image_path, csv_folder, corresponding_csv, metadata_file, output_file_var_10, a, last_dataset, selection=None, size=None, var=variance_ids)
+def render_image(task):
+    """
+    Étape de rendu (processus du Pool) : légendes de toutes les variantes d'une image,
+    à partir du contexte construit une seule fois. Renvoie (base_name, {dossier: légendes}).
+    """
+    variants = RENDER_SETTINGS["variants"]
+    n_captions = RENDER_SETTINGS.get("n_captions")
+    seed = RENDER_SETTINGS.get("seed", CAPTION_SEED)
+    use_connectors = RENDER_SETTINGS.get("connectors", USE_CONNECTORS)
+    base_name = task["base_name"]
+
+    # Contexte de l'image (description, métadonnées, dimensions) construit une seule fois pour toutes les variantes
+    tag = parse_subject(task["file_name"], DATASET_DATABASES[task["dataset"]])
+    if tag is None:
+        raise ValueError(f"Format de nom de fichier invalide : {task['file_name']}")
+    structures_df = pd.read_csv(io.StringIO(task["csv_text"]))
+    context = build_caption_context(tag, structures_df, task["shape"], task["metadata_file"])
+
+    captions = {}
+    for variant in variants:
+        # Sans fichier de sortie : les légendes sont écrites par l'étape d'écriture
+        captions[variant.folder] = generate_human_like_caption(
+            task["image_path"], os.path.dirname(task["csv_path"]), task["csv_path"], task["metadata_file"], None,
+            task["modality"], task["dataset"], selection=variant.selection, size=variant.size, var=variant.var,
+            context=context, n_captions=n_captions, seed=caption_seed(seed, base_name, variant.folder),
+            templates=variant.templates, use_connectors=use_connectors)
 
     # Afficher un message après traitement du fichier
-    print(f"Processed: {file_name}")
+    print(f"Processed: {task['file_name']}")
+    return base_name, captions
+
+def process_folder(folder_path, csv_folder, metadata_folder, output_folder, variance_ids=None, output_format=OUTPUT_FORMAT,
+                   captions_per_image=CAPTIONS_PER_IMAGE, seed=CAPTION_SEED, variants=None, modalities=None,
+                   connectors=USE_CONNECTORS):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Format de sortie inconnu : {output_format} (attendu : {', '.join(OUTPUT_FORMATS)})")
+    # Variantes par défaut : les 4 historiques, avec variance_ids pré-calculés s'ils sont fournis
+    if variants is None:
+        variants = [dict(v, var=variance_ids) if "var" in v and variance_ids is not None else v for v in DEFAULT_VARIANTS]
+    variants = resolve_variants(variants, csv_folder)
+    modalities = modality_map(MODALITIES if modalities is None else modalities)
 
-def process_folder(folder_path, csv_folder, metadata_folder, output_folder, variance_ids):
     # Créer le dossier de sortie et ses sous-dossiers
     os.makedirs(output_folder, exist_ok=True)
-    subfolders = ['captions_exhaustive', 'captions_selection', 'captions_size_10', 'captions_var_10']
+    subfolders = [v.folder for v in variants]
     for sub in subfolders:
         os.makedirs(os.path.join(output_folder, sub), exist_ok=True)
+        # Sortie JSON dans un dossier découpé auparavant : index et fichiers JSON Lines supprimés
+        if output_format == "json":
+            remove_shards(os.path.join(output_folder, sub))
 
     dataset_keywords = {
-        "KKI2009": "Kirby",
-        "OAS1": "Oasis",
+        "Kirby": "Kirby",
+        "OASIS": "Oasis",
         "IBSR": "IBSR",
         "IXI": "IXI"
     }
-    dataset_keywords_modalite = {
-        "KKI2009": "FLAIR",
-        "OAS1": "T1",
-        "IBSR": "T1",
-        "IXI": "T2"
-    }
 
     files = os.listdir(folder_path)
     nii_files = [f for f in files if f.endswith(".nii.gz")]
 
-    # Préparer les arguments pour le traitement en parallèle
-    args_list = [
-        (f, folder_path, csv_folder, metadata_folder, output_folder, dataset_keywords, dataset_keywords_modalite, variance_ids)
-        for f in nii_files
-    ]
-    with Pool(processes=8) as pool:
-        pool.starmap(process_single_file, args_list)
+    # Images sans description signalées une fois, et non envoyées aux processus du Pool
+    missing = set(report_missing(description_index(csv_folder), nii_files))
+    nii_files = [f for f in nii_files if f not in missing]
+
+    # Étape de lecture : CSV et en-têtes lus d'avance par des threads du processus principal
+    read = functools.partial(read_image, folder_path=folder_path, csv_folder=csv_folder, metadata_folder=metadata_folder,
+                             dataset_keywords=dataset_keywords, modalities=modalities)
+
+    # Étape d'écriture : un seul thread, dans l'ordre des images (fichiers JSON, ou
+    # fichiers JSON Lines de chaque variante avec un seul écrivain par fichier)
+    writers = {}
+    if output_format != "json":
+        writers = {sub: CaptionShardWriter(os.path.join(output_folder, sub), compress=output_format == "jsonl.gz")
+                   for sub in subfolders}
+
+    def write(result):
+        base_name, captions = result
+        for sub, variant_captions in captions.items():
+            if writers:
+                writers[sub].write(base_name, variant_captions)
+            else:
+                save_captions(variant_captions, os.path.join(output_folder, sub, f"{base_name}_captions.json"))
+
+    # Métadonnées lues une seule fois pour tout le traitement
+    metadata_tables = load_metadata_tables(metadata_folder)
+    render_settings = {"variants": variants, "n_captions": captions_per_image, "seed": seed, "connectors": connectors}
+    try:
+        with Pool(processes=RENDER_PROCESSES, initializer=init_worker, initargs=(metadata_tables, render_settings)) as pool:
+            run_pipeline(nii_files, read, render_image, write, pool, readers=READER_THREADS, max_in_flight=MAX_IN_FLIGHT)
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 if __name__ == "__main__":
-    # Calculer une fois la variance (ex: 10 premiers IDs)
-    variance_ids = calculate_top_variance_structures(CSV_FOLDER, 10)
-    # Traiter tous les fichiers en parallèle en passant variance_ids
-    process_folder(INPUT_FOLDER, CSV_FOLDER, METADATA_FOLDER, OUTPUT_BASE_FOLDER, variance_ids)
+    parser = argparse.ArgumentParser(description="Génération rapide des légendes de toutes les variantes")
+    parser.add_argument("--config", help="Fichier de configuration JSON (dossiers, format de sortie, variantes) ; "
+                                         "sans ce fichier, les chemins et les 4 variantes définis dans le code")
+    args = parser.parse_args()
+
+    if args.config:
+        config = load_run_config(args.config)
+        process_folder(config["input_folder"], config["csv_folder"], config["metadata_folder"], config["output_folder"],
+                       output_format=config.get("output_format", OUTPUT_FORMAT),
+                       captions_per_image=config.get("captions_per_image", CAPTIONS_PER_IMAGE),
+                       seed=config.get("seed", CAPTION_SEED), variants=config.get("variants"),
+                       modalities=config.get("modalities"), connectors=config.get("connectors", USE_CONNECTORS))
+    else:
+        # Calculer une fois la variance (ex: 10 premiers IDs)
+        variance_ids = calculate_top_variance_structures(CSV_FOLDER, 10)
+        # Traiter tous les fichiers en parallèle en passant variance_ids
+        process_folder(INPUT_FOLDER, CSV_FOLDER, METADATA_FOLDER, OUTPUT_BASE_FOLDER, variance_ids)
 
@@ -0,0 +1,78 @@
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_rewrite import LiteralRule, RegexRule, ConnectorRule, rewrite_folders
+
+# Correction des légendes déjà générées : les règles sont appliquées dans l'ordre de la
+# ligne de commande, en une seule lecture et une seule écriture par fichier, les fichiers
+# étant répartis entre plusieurs processus. Les règles indépendantes sont réunies en un
+# seul parcours de chaque légende ; une règle qui porte sur le texte écrit par une règle
+# précédente reste dans un parcours à part, pour garder le résultat des passages dans
+# l'ordre (--sequential : un parcours par règle). Seuls les fichiers dont une légende change sont réécrits ; --dry-run
+# n'écrit rien et affiche le nombre de correspondances de chaque règle et quelques différences.
+#exemple : python caption_rewriter.py E:\SIR\FL\Kirby_OASIS\captions_3d\captions_exhaustive E:\SIR\FL\Kirby_OASIS\captions_3d\captions_var_10 --replace T1 FLAIR --remove-connectors
+#python caption_rewriter.py captions_3d --subfolders --replace None T1 --workers 8
+
+
+class RuleAction(argparse.Action):
+    """Ajoute la règle à la liste commune, pour garder l'ordre des options."""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        rules = list(getattr(namespace, "rules", None) or [])
+        rules.append((option_string, values))
+        setattr(namespace, "rules", rules)
+
+
+def build_rule(option, values, ignore_case=False):
+    """Option de la ligne de commande -> règle (--ignore-case s'applique aux remplacements littéraux)."""
+    if option in ("--replace", "--replace-word"):
+        return LiteralRule(*values, whole_word=option == "--replace-word", ignore_case=ignore_case)
+    if option in ("--regex", "--iregex"):
+        return RegexRule(*values, ignore_case=option == "--iregex")
+    return ConnectorRule()
+
+
+def caption_folders(folders, subfolders=False):
+    """Dossiers à traiter : ceux donnés, ou (--subfolders) leurs sous-dossiers de variantes."""
+    if not subfolders:
+        return folders
+    return [os.path.join(folder, name) for folder in folders for name in sorted(os.listdir(folder))
+            if os.path.isdir(os.path.join(folder, name))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply ordered fixes to generated caption JSON files.")
+    parser.add_argument("folders", nargs="+", help="Folders containing the _captions.json files")
+    parser.add_argument("--subfolders", action="store_true",
+                        help="Process the subfolders of the given folders (captions_exhaustive, captions_var_10, ...)")
+    parser.add_argument("--replace", nargs=2, metavar=("OLD", "NEW"), action=RuleAction, dest="rules",
+                        help="Replace a literal text (repeatable)")
+    parser.add_argument("--replace-word", nargs=2, metavar=("OLD", "NEW"), action=RuleAction, dest="rules",
+                        help="Replace a literal text, whole words only (repeatable)")
+    parser.add_argument("--ignore-case", action="store_true", help="Ignore case in --replace and --replace-word")
+    parser.add_argument("--regex", nargs=2, metavar=("PATTERN", "REPLACEMENT"), action=RuleAction, dest="rules",
+                        help="Replace the matches of a regular expression (repeatable)")
+    parser.add_argument("--iregex", nargs=2, metavar=("PATTERN", "REPLACEMENT"), action=RuleAction, dest="rules",
+                        help="Same as --regex, ignoring case")
+    parser.add_argument("--remove-connectors", nargs=0, action=RuleAction, dest="rules",
+                        help="Remove the connectors (and, furthermore, ...) as delete_connectors.py does")
+    parser.add_argument("--sequential", action="store_true",
+                        help="One pass per rule, each rule seeing the result of the previous ones (default: single scan)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Write nothing: report the files that would change, the hits of every rule and sample diffs")
+    parser.add_argument("--samples", type=int, default=10, help="Number of sample diffs to display (default: 10)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if not args.rules:
+        parser.error("no rule given (--replace, --replace-word, --regex, --iregex or --remove-connectors)")
+    rules = [build_rule(option, values, args.ignore_case) for option, values in args.rules]
+
+    folders = caption_folders(args.folders, args.subfolders)
+    print("Règles :", ", ".join(repr(rule) for rule in rules))
+    report = rewrite_folders(folders, rules, workers=args.workers, sequential=args.sequential,
+                             dry_run=args.dry_run, max_samples=args.samples)
+    print("\n".join(report.lines(args.dry_run)))
+    sys.exit(1 if report.errors else 0)
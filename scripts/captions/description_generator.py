@@ -3,87 +3,393 @@ import numpy as np
 import nibabel as nib  # To handle 3D medical image formats (e.g., NIfTI)
 import re
 import os
+import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from manifest import load_manifest, save_manifest, plan_run, remove_orphans, remove_stale_outputs, record_outputs
+from simple_descriptions import load_groupings, aggregate_groups, write_simple_csv, simple_store_rows
 
-# Configure argument parser
-parser = argparse.ArgumentParser(description="3D Image Description Generator")
-parser.add_argument("input_csv_path", type=str, help="Path to the input CSV file")
-parser.add_argument("input_images_folder", type=str, help="Folder containing 3D image files")
-parser.add_argument("output_folder", type=str, help="Folder where CSV files will be saved")
-args = parser.parse_args()
-
-# Get arguments from the command line
-input_csv_path = args.input_csv_path
-input_images_folder = args.input_images_folder
-output_folder = args.output_folder
-
-# Create the results folder if it doesn't exist
-os.makedirs(output_folder, exist_ok=True)
-
-# Step 1: Parse the input CSV file to create a dictionary
-label_dict = {}
-with open(input_csv_path, mode="r") as csv_file:
-    csv_reader = csv.DictReader(csv_file)
-    for row in csv_reader:
-        label_id = int(row["ID"])
-        label_name = row["Labels"]
-        # Use regex to extract only numeric values from the RGB field
-        rgb = list(map(int, re.findall(r'\d+', row["RGB"])))
-        label_dict[label_id] = {"label_name": label_name, "rgb": rgb}
-
-# Step 2: Process each image in the input folder
-for image_filename in os.listdir(input_images_folder):
-    if image_filename.endswith(".nii.gz"):  # Process only NIfTI files
-        input_image_path = os.path.join(input_images_folder, image_filename)
-
-        # Load the 3D image
-        img = nib.load(input_image_path)  # Load the NIfTI image
-        image_data = img.get_fdata().astype(int)  # Convert the image data to integers for processing
-        voxel_size = img.header.get_zooms()[:3]  # Get voxel size (x, y, z) in mm
-        voxel_volume = np.prod(voxel_size)  # Calculate voxel volume in mm³
-
-        # Step 3: Analyze the image and count voxels for each label
-        unique_labels, voxel_counts = np.unique(image_data, return_counts=True)
-
-        # Exclude label 0 from total volume calculation
-        total_volume_without_label_0 = sum(
-            count * voxel_volume
-            for label, count in zip(unique_labels, voxel_counts) if label != 0
-        )
-
-        # Prepare the output CSV file path
-        output_csv_path = os.path.join(output_folder, f"{os.path.splitext(image_filename)[0]}_description3D.csv")
-
-        # Step 4: Generate the output CSV with labels, voxel counts, voxel volumes, and volume ratio
-        with open(output_csv_path, mode="w", newline="") as csv_file:
-            csv_writer = csv.writer(csv_file)
-            # Write the header
-            csv_writer.writerow(["ID", "Label", "RGB", "Voxel Count", "Voxel Volume (mm³)", "Volume Ratio (%)"])
-
-            for label_id, count in zip(unique_labels, voxel_counts):
-                if label_id == 0:
-                    continue  # Skip label 0 entirely
-                if label_id in label_dict:
-                    label_name = label_dict[label_id]["label_name"]
-                    rgb = label_dict[label_id]["rgb"]
-                else:
-                    label_name = "Unknown"
-                    rgb = [0, 0, 0]
-
-                total_volume = count * voxel_volume  # Calculate total volume for the label
-                if total_volume < 0.01:
-                    total_volume_str = "{:.2e}".format(total_volume)  # Notation scientifique si trop petit
-                else:
-                    total_volume_str = "{:.6f}".format(total_volume)  # Plus de décimales
-
-                volume_ratio = (total_volume / total_volume_without_label_0) * 100 if total_volume_without_label_0 > 0 else 0
-                if volume_ratio < 0.01:
-                    volume_ratio_str = "{:.2e}".format(volume_ratio)
-                else:
-                    volume_ratio_str = "{:.2f}".format(volume_ratio)
-
-                csv_writer.writerow([label_id, label_name, rgb, count, total_volume_str, volume_ratio_str])
-
-        print(f"Processed {image_filename}, output saved to {output_csv_path}")
-
-print("Processing complete.")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from label_store import update_label_store, STORE_NAME
+from volume_cache import load_volume, open_volume
+from label_histogram import axis_histograms, label_regions, check_labels, REGION_COLUMNS, SLAB_SIZE
+
+# Number of voxels given to np.bincount at once (bounds the int64 temporaries)
+COUNT_CHUNK_SIZE = 1 << 22
+# Subfolder of the output folder for the _regions3D.csv files, so that the readers
+# taking every .csv of the descriptions folder never see them
+REGIONS_FOLDER = "regions"
+
+
+def load_label_dict(input_csv_path):
+    """Parse the label CSV (ID, Labels, RGB) into {label_id: {"label_name", "rgb"}}."""
+    label_dict = {}
+    with open(input_csv_path, mode="r") as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        for row in csv_reader:
+            label_id = int(row["ID"])
+            label_name = row["Labels"]
+            # Use regex to extract only numeric values from the RGB field
+            rgb = list(map(int, re.findall(r'\d+', row["RGB"])))
+            label_dict[label_id] = {"label_name": label_name, "rgb": rgb}
+    return label_dict
+
+
+def count_labels(image_data, chunk_size=COUNT_CHUNK_SIZE):
+    """
+    Count the voxels of each label with a linear-time histogram (np.bincount).
+    Returns (labels, counts) sorted by label, like np.unique(..., return_counts=True).
+    Float volumes are truncated to int, as get_fdata().astype(int) did. Negative
+    labels raise ValueError, as in label_histogram.axis_histograms.
+    """
+    flat = image_data.ravel(order="K")
+    return accumulate_counts(flat[start:start + chunk_size] for start in range(0, flat.size, chunk_size))
+
+
+def count_labels_streaming(volume, slab_size=SLAB_SIZE):
+    """
+    Same as count_labels, but reads the volume (nibabel array proxy or memmap) slab
+    by slab along the last axis: the peak memory depends on the slab size only.
+    """
+    depth = volume.shape[2]
+    return accumulate_counts(
+        np.asarray(volume[:, :, k0:k0 + slab_size]).ravel(order="K") for k0 in range(0, depth, slab_size)
+    )
+
+
+def accumulate_counts(chunks):
+    """Add up the label histograms of successive chunks of voxels (see count_labels)."""
+    counts = np.zeros(0, dtype=np.int64)
+
+    for chunk in chunks:
+        if chunk.size == 0:
+            continue
+        if chunk.dtype.kind not in "iu":
+            chunk = chunk.astype(np.int64)
+        check_labels(chunk)
+        chunk_counts = np.bincount(chunk)
+        if chunk_counts.size > counts.size:
+            counts = np.pad(counts, (0, chunk_counts.size - counts.size))
+        counts[:chunk_counts.size] += chunk_counts
+
+    labels = np.flatnonzero(counts)
+    counts = counts[labels]
+    return labels, counts
+
+
+def format_vector(values, decimals=None):
+    """[x, y, z] cell, in the style of the RGB column."""
+    if decimals is not None:
+        values = [round(float(v), decimals) for v in values]
+    return "[" + ", ".join(str(v) for v in values) + "]"
+
+
+def write_regions_csv(regions, label_dict, output_path):
+    """Write the bounding box, extent and centroid of every label (except 0)."""
+    # Same encoding as the descriptions (ISO-8859-1)
+    with open(output_path, mode="w", newline="", encoding="ISO-8859-1") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(REGION_COLUMNS)
+        for label_id, region in regions.items():
+            if label_id == 0:
+                continue
+            label_name = label_dict[label_id]["label_name"] if label_id in label_dict else "Unknown"
+            csv_writer.writerow([
+                label_id, label_name, region["count"],
+                format_vector(region["bbox_min"]), format_vector(region["bbox_max"]), format_vector(region["extent"]),
+                format_vector(region["centroid"], 3),
+                format_vector(region["bbox_min_mm"], 3), format_vector(region["bbox_max_mm"], 3),
+                format_vector(region["centroid_mm"], 3),
+            ])
+
+
+def describe_image(input_image_path, label_dict, output_folder, simple=None, regions=False, slab_size=None):
+    """
+    Count the labels of one image and write its _description3D.csv.
+    With simple=(groupings, simple_output_folder), the same counts also give the
+    _simple.csv of simple_descriptions.py, without re-reading the description.
+    With regions=True, the same pass also gives the bounding box, extent and
+    centroid of each label (voxel and world coordinates) in a _regions3D.csv of the
+    regions subfolder.
+    With slab_size, the volume is streamed slab_size slices at a time instead of
+    being decoded in memory.
+    Returns the list of (written file, rows for the label store).
+    """
+    image_filename = os.path.basename(input_image_path)
+
+    # Load the 3D image
+    img = nib.load(input_image_path)  # Load the NIfTI image (header only, voxels are read lazily)
+    if slab_size:
+        # Array proxy (or cache memmap): only one slab is in memory at a time
+        image_data = open_volume(input_image_path)
+    else:
+        # Voxels in their on-disk integer dtype (no float64 copy), memory-mapped from
+        # the shared volume cache when $SIR_VOLUME_CACHE is set
+        image_data = load_volume(input_image_path)
+    voxel_size = img.header.get_zooms()[:3]  # Get voxel size (x, y, z) in mm
+    voxel_volume = np.prod(voxel_size)  # Calculate voxel volume in mm³
+
+    # Analyze the image and count voxels for each label
+    region_table = None
+    if regions:
+        # Per-axis histograms: voxel counts, bounding boxes and centroids in one pass
+        histograms = axis_histograms(image_data, slab_size or SLAB_SIZE)
+        region_table = label_regions(histograms, img.affine)
+        unique_labels = np.array(list(region_table), dtype=np.int64)
+        voxel_counts = np.array([r["count"] for r in region_table.values()], dtype=np.int64)
+    elif slab_size:
+        unique_labels, voxel_counts = count_labels_streaming(image_data, slab_size)
+    else:
+        unique_labels, voxel_counts = count_labels(image_data)
+    del image_data
+
+    # Exclude label 0 from total volume calculation
+    total_volume_without_label_0 = sum(
+        count * voxel_volume
+        for label, count in zip(unique_labels, voxel_counts) if label != 0
+    )
+
+    # Prepare the output CSV file path
+    output_csv_path = os.path.join(output_folder, f"{os.path.splitext(image_filename)[0]}_description3D.csv")
+
+    # Voxel counts and volumes per ID, for the simplified description and the label store
+    volume_dict = {}
+    store_rows = []
+
+    # Generate the output CSV with labels, voxel counts, voxel volumes, and volume ratio
+    # Written in ISO-8859-1, the encoding every reader of the descriptions uses: the
+    # platform default (UTF-8 on Linux) breaks the 'Voxel Volume (mm³)' column for them
+    with open(output_csv_path, mode="w", newline="", encoding="ISO-8859-1") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        # Write the header
+        csv_writer.writerow(["ID", "Label", "RGB", "Voxel Count", "Voxel Volume (mm³)", "Volume Ratio (%)"])
+
+        for label_id, count in zip(unique_labels, voxel_counts):
+            if label_id == 0:
+                continue  # Skip label 0 entirely
+            if label_id in label_dict:
+                label_name = label_dict[label_id]["label_name"]
+                rgb = label_dict[label_id]["rgb"]
+            else:
+                label_name = "Unknown"
+                rgb = [0, 0, 0]
+
+            total_volume = count * voxel_volume  # Calculate total volume for the label
+            if total_volume < 0.01:
+                total_volume_str = "{:.2e}".format(total_volume)  # Notation scientifique si trop petit
+            else:
+                total_volume_str = "{:.6f}".format(total_volume)  # Plus de décimales
+
+            volume_ratio = (total_volume / total_volume_without_label_0) * 100 if total_volume_without_label_0 > 0 else 0
+            if volume_ratio < 0.01:
+                volume_ratio_str = "{:.2e}".format(volume_ratio)
+            else:
+                volume_ratio_str = "{:.2f}".format(volume_ratio)
+
+            csv_writer.writerow([label_id, label_name, rgb, count, total_volume_str, volume_ratio_str])
+            volume_dict[int(label_id)] = (int(count), float(total_volume))
+            # The store holds the values as written, so that its readers get the ones of the CSV
+            store_rows.append((int(label_id), label_name, int(count), float(total_volume_str), float(volume_ratio_str)))
+
+    outputs = [(output_csv_path, store_rows)]
+    if region_table is not None:
+        regions_folder = os.path.join(output_folder, REGIONS_FOLDER)
+        os.makedirs(regions_folder, exist_ok=True)
+        regions_csv_path = os.path.join(regions_folder, f"{os.path.splitext(image_filename)[0]}_regions3D.csv")
+        write_regions_csv(region_table, label_dict, regions_csv_path)
+        outputs.append((regions_csv_path, None))
+
+    if simple is None:
+        return outputs
+
+    # Same rows as simple_descriptions.py, computed from the counts of this pass
+    groupings, simple_output_folder = simple
+    simple_data, _ = aggregate_groups(volume_dict, groupings, float(total_volume_without_label_0))
+    simple_csv_path = os.path.join(simple_output_folder, f"{os.path.basename(output_csv_path)}_simple.csv")
+    write_simple_csv(simple_data, simple_csv_path)
+    return outputs + [(simple_csv_path, simple_store_rows(simple_data))]
+
+
+def estimate_task_memory(input_image_path, slab_size=None):
+    """Estimate the peak memory (bytes) of describe_image from the NIfTI header only."""
+    img = nib.load(input_image_path)
+    itemsize = np.dtype(img.get_data_dtype()).itemsize
+    if not img.dataobj.is_proxy or img.dataobj.slope != 1 or img.dataobj.inter != 0:
+        itemsize = 8  # Scaled data is returned as float64
+    if slab_size:
+        # One slab + its int64 copy and bincount index temporaries
+        shape = img.shape[:3]
+        return int(np.prod(shape[:2])) * min(slab_size, shape[2]) * (itemsize + 2 * 8)
+    # Decoded volume + the int64 temporaries of one bincount chunk
+    return int(np.prod(img.shape)) * itemsize + 2 * COUNT_CHUNK_SIZE * 8
+
+
+def run_batch(image_paths, label_dict, output_folder, workers=1, max_memory_bytes=None, simple=None, regions=False,
+              slab_size=None):
+    """
+    Describe every image, each one as an isolated task: a corrupt file is reported
+    as a failure without stopping the batch. With workers > 1 the images are spread
+    over a process pool, and no new task is started while the estimated memory of
+    the running tasks would exceed max_memory_bytes.
+    Returns (successes, failures) as lists of (image_path, describe_image result or error message).
+    """
+    successes, failures = [], []
+
+    if workers <= 1:
+        for input_image_path in image_paths:
+            try:
+                outputs = describe_image(input_image_path, label_dict, output_folder, simple, regions, slab_size)
+            except Exception as exc:
+                failures.append((input_image_path, f"{type(exc).__name__}: {exc}"))
+                print(f"FAILED {os.path.basename(input_image_path)}: {exc}")
+                continue
+            successes.append((input_image_path, outputs))
+            print(f"Processed {os.path.basename(input_image_path)}, output saved to {', '.join(p for p, _ in outputs)}")
+        return successes, failures
+
+    pending = list(reversed(image_paths))
+    while pending:
+        running = {}  # future -> (image path, estimated bytes)
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                while pending or running:
+                    # Start as many tasks as the worker count and the memory cap allow
+                    while pending and len(running) < workers:
+                        input_image_path = pending[-1]
+                        try:
+                            task_memory = estimate_task_memory(input_image_path, slab_size)
+                        except Exception as exc:
+                            pending.pop()
+                            failures.append((input_image_path, f"{type(exc).__name__}: {exc}"))
+                            print(f"FAILED {os.path.basename(input_image_path)}: {exc}")
+                            continue
+                        used_memory = sum(m for _, m in running.values())
+                        if running and max_memory_bytes and used_memory + task_memory > max_memory_bytes:
+                            break  # Wait for a running task to free memory
+                        pending.pop()
+                        future = executor.submit(describe_image, input_image_path, label_dict, output_folder,
+                                                 simple, regions, slab_size)
+                        running[future] = (input_image_path, task_memory)
+
+                    if not running:
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        input_image_path, _ = running.pop(future)
+                        try:
+                            outputs = future.result()
+                        except BrokenProcessPool:
+                            failures.append((input_image_path, "worker process terminated abruptly"))
+                            print(f"FAILED {os.path.basename(input_image_path)}: worker process terminated abruptly")
+                            raise
+                        except Exception as exc:
+                            failures.append((input_image_path, f"{type(exc).__name__}: {exc}"))
+                            print(f"FAILED {os.path.basename(input_image_path)}: {exc}")
+                            continue
+                        successes.append((input_image_path, outputs))
+                        print(f"Processed {os.path.basename(input_image_path)}, output saved to {', '.join(p for p, _ in outputs)}")
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for lack of memory): the running tasks are lost,
+            # record them as failures and restart a fresh pool for the remaining images.
+            for input_image_path, _ in running.values():
+                failures.append((input_image_path, "worker process terminated abruptly"))
+                print(f"FAILED {os.path.basename(input_image_path)}: worker process terminated abruptly")
+
+    return successes, failures
+
+
+def print_summary(successes, failures):
+    """Print the end-of-run summary of the batch."""
+    print(f"Processing complete: {len(successes)} succeeded, {len(failures)} failed.")
+    for input_image_path, error in failures:
+        print(f"  - {os.path.basename(input_image_path)}: {error}")
+
+
+if __name__ == "__main__":
+    # Configure argument parser
+    parser = argparse.ArgumentParser(description="3D Image Description Generator")
+    parser.add_argument("input_csv_path", type=str, help="Path to the input CSV file")
+    parser.add_argument("input_images_folder", type=str, help="Folder containing 3D image files")
+    parser.add_argument("output_folder", type=str, help="Folder where CSV files will be saved")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (default: 1, sequential)")
+    parser.add_argument("--max-memory-gb", type=float, default=None,
+                        help="Cap on the estimated memory of the images processed at the same time")
+    parser.add_argument("--force", action="store_true",
+                        help="Ignore the manifest and recompute every image")
+    parser.add_argument("--simple-groupings", type=str, default=None,
+                        help="Groupings CSV (simplified_IBSR.csv): also write the simplified descriptions in the same pass")
+    parser.add_argument("--simple-output-folder", type=str, default=None,
+                        help="Folder of the simplified descriptions (default: <output_folder>_simple)")
+    parser.add_argument("--regions", action="store_true",
+                        help="Also write the bounding box, extent and centroid of each label (regions/*_regions3D.csv)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the volumes slab by slab instead of decoding them in memory (bounded memory)")
+    parser.add_argument("--slab-size", type=int, default=SLAB_SIZE,
+                        help=f"Number of slices per slab with --stream (default: {SLAB_SIZE})")
+    args = parser.parse_args()
+
+    # Get arguments from the command line
+    input_csv_path = args.input_csv_path
+    input_images_folder = args.input_images_folder
+    output_folder = args.output_folder
+
+    # Create the results folder if it doesn't exist
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Step 1: Parse the input CSV file to create a dictionary
+    label_dict = load_label_dict(input_csv_path)
+    reference_paths = [input_csv_path]
+
+    # Optional simplified descriptions, written from the same label counts
+    simple = None
+    if args.simple_groupings:
+        simple_output_folder = args.simple_output_folder or os.path.normpath(output_folder) + "_simple"
+        os.makedirs(simple_output_folder, exist_ok=True)
+        simple = (load_groupings(args.simple_groupings), simple_output_folder)
+        reference_paths.append(args.simple_groupings)
+
+    # Step 2: Process each image in the input folder
+    image_paths = [
+        os.path.join(input_images_folder, image_filename)
+        for image_filename in sorted(os.listdir(input_images_folder))
+        if image_filename.endswith(".nii.gz")  # Process only NIfTI files
+    ]
+
+    # Only recompute new or modified images, and remove the outputs of deleted ones
+    manifest = load_manifest(output_folder, reference_paths, force=args.force, options={"regions": args.regions})
+    removed = remove_orphans(manifest, image_paths, output_folder)
+    to_process, up_to_date = plan_run(manifest, image_paths, output_folder)
+    print(f"{len(up_to_date)} image(s) up to date, {len(to_process)} to process, "
+          f"{len(removed)} orphaned output(s) removed.")
+
+    max_memory_bytes = int(args.max_memory_gb * 1024 ** 3) if args.max_memory_gb else None
+    slab_size = args.slab_size if args.stream else None
+    successes, failures = run_batch(to_process, label_dict, output_folder, args.workers, max_memory_bytes,
+                                    simple, args.regions, slab_size)
+
+    for input_image_path, outputs in successes:
+        record_outputs(manifest, input_image_path, [path for path, _ in outputs], output_folder)
+    stale = remove_stale_outputs(manifest, output_folder)
+    if stale:
+        print(f"{len(stale)} output(s) of the previous options removed.")
+    save_manifest(manifest, output_folder)
+
+    # Consolidated table of every subject (label_volumes.npz) in each output folder
+    subject_of = lambda image_path: os.path.splitext(os.path.basename(image_path))[0]
+    rows_by_folder = {output_folder: {}}
+    if simple is not None:
+        rows_by_folder[simple[1]] = {}
+    for input_image_path, outputs in successes:
+        # The _regions3D.csv (rows None) is not part of the label store
+        store_outputs = [(path, rows) for path, rows in outputs if rows is not None]
+        for (output_path, rows), folder in zip(store_outputs, rows_by_folder):
+            rows_by_folder[folder][subject_of(input_image_path)] = rows
+    up_to_date_subjects = [subject_of(p) for p in up_to_date]
+    for folder, new_rows in rows_by_folder.items():
+        update_label_store(folder, new_rows, up_to_date_subjects)
+    print(f"Label store updated: {', '.join(os.path.join(f, STORE_NAME) for f in rows_by_folder)}")
+
+    print_summary(successes, failures)
+    if failures:
+        sys.exit(1)
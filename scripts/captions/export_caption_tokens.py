@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_tokens import export_tokens
+
+# Export des légendes des dossiers captions_3d*/captions_* en corpus pré-tokenisé pour
+# l'entraînement : un tableau plat des IDs de tokens et un tableau des positions de début
+# des légendes (fichiers .npy lus en mémoire mappée), plus index.json (sujet et variante
+# de chaque légende) et le vocabulaire. Une nouvelle exécution ne retokenise que les
+# fichiers de légendes ajoutés ou modifiés depuis l'export précédent.
+#exemple : python export_caption_tokens.py E:\SIR\FL\Kirby_OASIS E:\SIR\FL\Kirby_OASIS\tokens
+#python export_caption_tokens.py E:\SIR\FL\IXI E:\SIR\FL\IXI\tokens --vocabulary E:\SIR\FL\Kirby_OASIS\tokens\vocabulary.json
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the generated captions as memory-mapped token arrays.")
+    parser.add_argument("root", help="Folder containing the captions_3d*/captions_* folders")
+    parser.add_argument("output", help="Output folder (tokens, offsets, index.json, vocabulary.json)")
+    parser.add_argument("--vocabulary", default=None,
+                        help="Existing vocabulary to use as is, unknown tokens becoming <unk> "
+                             "(default: the vocabulary of the output folder, extended with the new tokens)")
+    parser.add_argument("--force", action="store_true", help="Tokenize every caption again")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    summary = export_tokens(args.root, args.output, vocabulary_path=args.vocabulary, force=args.force)
+    if not summary["sources"]:
+        sys.exit(f"Aucun dossier captions_3d*/captions_* dans {args.root}")
+    print(f"{summary['sources']} fichiers de légendes : {summary['tokenized']} tokenisés, {summary['reused']} repris de l'export précédent")
+    print(f"{summary['captions']} légendes, {summary['tokens']} tokens, vocabulaire de {summary['vocabulary_size']} tokens")
+    if not summary["written"]:
+        print("Aucun changement : export inchangé")
+    print(f"Terminé en {time.perf_counter() - start:.1f} s")
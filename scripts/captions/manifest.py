@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+
+# Manifest of the description stage, written in each output folder.
+# It records, for every input file, its size, mtime and SHA-256 and the outputs
+# generated from it, plus the hash of the label CSV(s) used. A rerun then only
+# recomputes new or modified inputs and removes the outputs of deleted inputs.
+# When the references or the options change, everything is recomputed and the
+# previous outputs that the new run did not write again are removed.
+MANIFEST_NAME = "description_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path, block_size=1 << 20):
+    """SHA-256 of a file, read by blocks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_manifest(output_folder, reference_paths, force=False, options=None):
+    """
+    Load the manifest of output_folder. reference_paths is the label CSV (or a list of
+    reference files), options a dict of the settings that change the outputs. The
+    entries are dropped (everything will be recomputed) when a reference file or an
+    option changed, or when force is set.
+    """
+    if isinstance(reference_paths, str):
+        reference_paths = [reference_paths]
+    references = [{"path": os.path.abspath(p), "sha256": file_sha256(p)} for p in reference_paths]
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    manifest = None
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            print(f"Unreadable manifest, everything will be recomputed: {manifest_path}")
+            manifest = None
+
+    previous_hashes = [r.get("sha256") for r in manifest.get("references", [])] if manifest else None
+    options = options or {}
+    if (force or manifest is None or manifest.get("version") != MANIFEST_VERSION
+            or previous_hashes != [r["sha256"] for r in references]
+            or manifest.get("options", {}) != options):
+        old_entries = manifest.get("entries", {}) if manifest else {}
+        manifest = {"version": MANIFEST_VERSION, "entries": {}}
+        # Keep track of the previous outputs so that orphans can still be removed
+        manifest["stale_entries"] = old_entries
+    manifest["references"] = references
+    manifest["options"] = options
+    return manifest
+
+
+def save_manifest(manifest, output_folder):
+    """Write the manifest atomically (temporary file then rename)."""
+    manifest = {k: v for k, v in manifest.items() if k != "stale_entries"}
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _outputs_exist(entry, output_folder):
+    return all(os.path.exists(os.path.join(output_folder, name)) for name in entry.get("outputs", []))
+
+
+def plan_run(manifest, input_paths, output_folder):
+    """
+    Split input_paths into (to_process, up_to_date). An input is up to date when its
+    size and mtime match the manifest (no read at all), or when only the mtime changed
+    but its content hash is the same.
+    """
+    entries = manifest["entries"]
+    to_process, up_to_date = [], []
+    for input_path in input_paths:
+        entry = entries.get(os.path.basename(input_path))
+        if entry is None or not _outputs_exist(entry, output_folder):
+            to_process.append(input_path)
+            continue
+        stat = os.stat(input_path)
+        if stat.st_size != entry["size"]:
+            to_process.append(input_path)
+        elif stat.st_mtime_ns == entry["mtime_ns"]:
+            up_to_date.append(input_path)
+        elif file_sha256(input_path) == entry["sha256"]:
+            entry["mtime_ns"] = stat.st_mtime_ns  # Touched but not modified
+            up_to_date.append(input_path)
+        else:
+            to_process.append(input_path)
+    return to_process, up_to_date
+
+
+def remove_output(output_folder, output_name):
+    """
+    Delete one recorded output, then its subfolders of output_folder left empty (the
+    regions/ folder once its last table is gone). Returns False if it did not exist.
+    """
+    output_path = os.path.join(output_folder, output_name)
+    if not os.path.exists(output_path):
+        return False
+    os.remove(output_path)
+    folder = os.path.dirname(os.path.normpath(output_name))
+    while folder and not folder.startswith(os.pardir):
+        folder_path = os.path.join(output_folder, folder)
+        if not os.path.isdir(folder_path) or os.listdir(folder_path):
+            break
+        os.rmdir(folder_path)
+        folder = os.path.dirname(folder)
+    return True
+
+
+def remove_orphans(manifest, input_paths, output_folder):
+    """Delete the outputs whose input no longer exists. Returns the removed file names."""
+    input_names = {os.path.basename(p) for p in input_paths}
+    removed = []
+    for entries in (manifest["entries"], manifest.get("stale_entries", {})):
+        for name in [n for n in entries if n not in input_names]:
+            for output_name in entries.pop(name).get("outputs", []):
+                if remove_output(output_folder, output_name):
+                    removed.append(output_name)
+    return removed
+
+
+def remove_stale_outputs(manifest, output_folder):
+    """
+    After a run that recomputed everything (references or options changed): delete
+    the previous outputs that were not written again, for example the _regions3D.csv
+    files once --regions is off. Returns the removed file names.
+    """
+    current = {name for entry in manifest["entries"].values() for name in entry.get("outputs", [])}
+    removed = []
+    for entry in manifest.pop("stale_entries", {}).values():
+        for output_name in entry.get("outputs", []):
+            if output_name not in current and remove_output(output_folder, output_name):
+                removed.append(output_name)
+    return removed
+
+
+def record_outputs(manifest, input_path, output_paths, output_folder):
+    """
+    Record a successfully processed input and the outputs generated from it.
+    Outputs are stored relative to output_folder, so they may live in another folder.
+    """
+    stat = os.stat(input_path)
+    manifest["entries"][os.path.basename(input_path)] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(input_path),
+        "outputs": sorted(os.path.relpath(p, output_folder) for p in output_paths),
+    }
@@ -1,22 +1,24 @@
+# Correction après coup des légendes déjà générées. Les générateurs écrivent désormais
+# la modalité de chaque dataset (option --modality, constante MODALITIES de caption_generator_speed.py).
 import os
-import json
+import sys
+import argparse
 
-def replace_none_in_json(directory):
-    for filename in os.listdir(directory):
-        if filename.endswith(".json"):  # Vérifie si le fichier est un JSON
-            file_path = os.path.join(directory, filename)
-            
-            with open(file_path, "r", encoding="utf-8") as file:
-                data = json.load(file)
-            
-            if "captions" in data and isinstance(data["captions"], list):
-                data["captions"] = [caption.replace("None", "T1") for caption in data["captions"]]
-            
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(data, file, ensure_ascii=False, indent=4)
-            
-            print(f"Modifié : {filename}")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_rewrite import LiteralRule, rewrite_folders
 
-# Remplacez par le chemin du dossier contenant vos fichiers JSON
-dossier_json = r"D:\SIR\T1\IBSR_OASIS\captions_3d_simple\captions_var_10"
-replace_none_in_json(dossier_json)
+def replace_none_in_json(directory, dry_run=False, max_samples=0):
+    # Légendes modifiées en mémoire ; seuls les fichiers qui changent sont réécrits
+    return rewrite_folders([directory], [LiteralRule("None", "T1")], dry_run=dry_run, max_samples=max_samples)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remplace None par T1 dans les légendes (chemin défini dans le code)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="N'écrit rien : fichiers qui changeraient, correspondances et exemples de différences")
+    parser.add_argument("--samples", type=int, default=10, help="Nombre d'exemples de différences affichés")
+    args = parser.parse_args()
+
+    # Remplacez par le chemin du dossier contenant vos fichiers JSON
+    dossier_json = r"D:\SIR\T1\IBSR_OASIS\captions_3d_simple\captions_var_10"
+    report = replace_none_in_json(dossier_json, dry_run=args.dry_run, max_samples=args.samples)
+    print("\n".join(report.lines(args.dry_run)))
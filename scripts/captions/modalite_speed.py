@@ -1,47 +1,38 @@
+# Correction après coup des légendes déjà générées. Les générateurs écrivent désormais
+# la modalité de chaque dataset (option --modality, constante MODALITIES de caption_generator_speed.py).
 import os
-import json
-import threading
+import sys
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from caption_rewrite import LiteralRule, rewrite_folders
 
 # Définir des variables globales
 wrong_info = "T1"
 right_info = "FLAIR"
 
-def replace_none_in_json(directory, wrong_info, right_info):
-    for filename in os.listdir(directory):
-        if filename.endswith(".json"):  # Vérifie si le fichier est un JSON
-            file_path = os.path.join(directory, filename)
-            
-            with open(file_path, "r", encoding="utf-8") as file:
-                data = json.load(file)
-            
-            if "captions" in data and isinstance(data["captions"], list):
-                 data["captions"] = [caption.replace(wrong_info, right_info) for caption in data["captions"]]
-            
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(data, file, ensure_ascii=False, indent=4)
-            
-            print(f"Modifié : {filename}")
-
-def process_directory(directory, wrong_info, right_info):
-    # Traiter chaque sous-dossier (A, B, C, D)
-    for subfolder in ['captions_exhaustive', 'captions_selection', 'captions_size_10', 'captions_var_10']:
-        subfolder_path = os.path.join(directory, subfolder)
-        if os.path.isdir(subfolder_path):
-            replace_none_in_json(subfolder_path, wrong_info, right_info)
-
-# Remplacez par le chemin du dossier contenant vos dossiers A, B, C, D
-base_directory = r"E:\SIR\FL\Kirby_OASIS\captions_3d"
-
-# Créer 4 threads pour traiter les 4 sous-dossiers
-threads = []
-for _ in range(4):
-    thread = threading.Thread(target=process_directory, args=(base_directory, wrong_info, right_info))
-    threads.append(thread)
-    thread.start()
-
-# Attendre que tous les threads se terminent
-for thread in threads:
-    thread.join()
-
-print("Tous les fichiers ont été modifiés.")
-
+# Sous-dossiers des variantes (A, B, C, D)
+SUBFOLDERS = ['captions_exhaustive', 'captions_selection', 'captions_size_10', 'captions_var_10']
+# Processus de réécriture (None : un par CPU) ; les fichiers des 4 sous-dossiers sont
+# répartis entre eux, chaque fichier n'étant lu qu'une fois et écrit seulement s'il change
+WORKERS = None
+
+def process_directory(directory, wrong_info, right_info, workers=WORKERS, dry_run=False, max_samples=0):
+    # Traiter chaque sous-dossier (A, B, C, D) en une seule passe répartie entre les processus
+    folders = [os.path.join(directory, subfolder) for subfolder in SUBFOLDERS
+               if os.path.isdir(os.path.join(directory, subfolder))]
+    return rewrite_folders(folders, [LiteralRule(wrong_info, right_info)], workers=workers,
+                           dry_run=dry_run, max_samples=max_samples)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remplace la modalité erronée des légendes (chemins définis dans le code)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="N'écrit rien : fichiers qui changeraient, correspondances et exemples de différences")
+    parser.add_argument("--samples", type=int, default=10, help="Nombre d'exemples de différences affichés")
+    args = parser.parse_args()
+
+    # Remplacez par le chemin du dossier contenant vos dossiers A, B, C, D
+    base_directory = r"E:\SIR\FL\Kirby_OASIS\captions_3d"
+
+    report = process_directory(base_directory, wrong_info, right_info, dry_run=args.dry_run, max_samples=args.samples)
+    print("\n".join(report.lines(args.dry_run)))
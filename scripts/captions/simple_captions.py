@@ -1,9 +1,24 @@
 import pandas as pd
-import re
+import numpy as np
 import json
 import nibabel as nib  # To read NIfTI files
 import os
+import sys
 import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from variance_ranking import top_variance_structures
+from subject_index import parse_subject
+from description_index import description_index, report_missing
+from metadata_table import load_metadata_table, lookup_subject
+from structure_table import known_structures, structure_table, sort_by_volume, filter_structures, caption_structures
+from caption_augmentation import CaptionAugmenter, caption_seed
+from caption_options import modality_map, parse_modality_overrides, add_caption_options, CONNECTORS
+from caption_shards import remove_shards
+
+# Dataset des légendes -> base de l'index des sujets (tags des noms de fichiers)
+DATASET_DATABASES = {"Kirby": "Kirby", "Oasis": "OASIS", "IBSR": "IBSR", "IXI": "IXI"}
+
 #exemple : 
 #python simple_captions.py image_data simple_descriptions ./metafolder/ dossier_output
 
@@ -22,36 +37,8 @@ relevant_structures = [
 ###############################################
 def calculate_top_variance_structures(csv_folder, n):
     """Calculate the top n structures with the highest variance across all CSV files in the folder, and return their IDs."""
-    structure_variances = {}
-
-    # Dictionnaire pour associer chaque label à un ID
-    label_to_id = {}
-
-    # Récupération des volumes pour chaque structure et de l'ID
-    for csv_file in os.listdir(csv_folder):
-        if csv_file.endswith(".csv"):
-            file_path = os.path.join(csv_folder, csv_file)
-            df = pd.read_csv(file_path, encoding='latin1')
-            
-            for _, row in df.iterrows():
-                label = row['Description']
-                if label == "Unknown":
-                    continue
-                volume = row['Voxel Volume 3']
-                structure_id = row['ID']  # Assumons qu'il y a une colonne 'ID' pour l'ID de la structure
-                if label not in structure_variances:
-                    structure_variances[label] = []
-                    label_to_id[label] = structure_id  # Associe l'ID au label
-                structure_variances[label].append(volume)
-
-    # Calcul de la variance pour chaque structure
-    variance_results = {label: pd.Series(volumes).var() for label, volumes in structure_variances.items()}
-
-    # Tri par variance décroissante et sélection des n premiers
-    top_structures = sorted(variance_results.items(), key=lambda x: x[1], reverse=True)[:n]
-
-    # Retourner les ID des structures correspondantes sous forme d'entiers
-    top_ids = [int(label_to_id[label]) for label, _ in top_structures]  # Conversion en entier
+    # Ranking cached in the folder (variance_ranking.json) and computed once per process
+    top_ids = top_variance_structures(csv_folder, n)
     print(top_ids)
     return top_ids
 
@@ -59,105 +46,54 @@ def calculate_top_variance_structures(csv_folder, n):
 import random
 import pandas as pd
 import nibabel as nib
-import re
 import json
 import random
 
-def generate_human_like_caption(image_filename, csv_folder,structures_file, metadata_file, output_file, a, image_type, selection=None, size=None, var=None):
-    # Extract ID and type from image filename using regex
-    match = None
-    if image_type == "Kirby":
-        match = re.search(r'KKI2009-(\d+)-([A-Z]+)', image_filename)
-        scan_type = "FLAIR"
-    elif image_type == "Oasis":
-        match = re.search(r'OAS1_(\d+)_([A-Za-z0-9\-]+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IBSR":
-        match = re.search(r'IBSR_(\d+)_([A-Za-z0-9\-]+)', image_filename)
-        scan_type = "T1"
-    elif image_type == "IXI":
-        match = re.search(r'IXI(\d+)-IOP-\d+-[A-Za-z0-9\-]+', image_filename)
-        scan_type = "T2"
-    scan_type = a    
-
-    if not match:
+def generate_human_like_caption(image_filename, csv_folder,structures_file, metadata_file, output_file, a, image_type, selection=None, size=None, var=None, n_captions=None, seed=None, use_connectors=True):
+    # Extract ID (and, for Kirby, the scan type) from the subject tag of the image filename
+    tag = parse_subject(image_filename, DATASET_DATABASES[image_type]) if image_type in DATASET_DATABASES else None
+    scan_type = a
+
+    if tag is None:
         raise ValueError(f"Invalid image filename format for file: {image_filename}")
 
-    image_id = int(match.group(1))
+    image_id = tag.subject_id
     if image_type == "Kirby":
-        image_type = match.group(2)  # For Kirby, use the second match group as the type
+        image_type = tag.modality  # For Kirby, use the modality of the tag as the type
     
     # Load CSV files
     structures_df = pd.read_csv(structures_file, encoding='latin1')
-    metadata_df = pd.read_csv(metadata_file, encoding='latin1')
-
-    # Find metadata based on image ID
-    metadata = metadata_df[metadata_df['ID'] == image_id]
 
-# Si aucune métadonnée n'est trouvée, utiliser les valeurs par défaut
-    if metadata.empty:
-        age = "unknown"
-        gender = "human"
-    else:
-        # Extraire l'âge et gérer les valeurs manquantes
-        if image_type == "IXI":
-            age = metadata.iloc[0]['AGE']
-            age = int(float(age.replace(",", "."))) if pd.notna(age) else "unknown"
-        else:
-            age = metadata.iloc[0]['AGE']
-            age = age if pd.notna(age) else "unknown"
-
-        # Extraire le genre et gérer les valeurs manquantes
-        gender = metadata.iloc[0]['GENDER']
-        gender = gender if pd.notna(gender) else "human"
+    # Find metadata based on image ID: ID-indexed table, parsed once per run
+    # (unknown subjects get "unknown" / "human")
+    age, gender = lookup_subject(load_metadata_table(metadata_file), image_id)
 
-    # Load the 3D image to get dimensions
+    # Load the NIfTI header to get dimensions (the voxels are not read)
     img = nib.load(image_filename)  # Load the NIfTI image
-    image_data = img.get_fdata().astype(int)  # Convert the image data to integers for processing
-    total_voxels = image_data.size  # Total number of voxels in the image
+    total_voxels = int(np.prod(img.shape))  # Total number of voxels in the image
 
     # Filter structures to include only those relevant for brain volume calculation
-    filtered_structures = structures_df[structures_df['Labels'] != "Unknown"]
+    filtered_structures = known_structures(structures_df, label_column='Labels')
 
     # Calculate brain volume
     brain_volume = round(filtered_structures['Voxel Volume 3'].sum() / 1000)
 
-    # Generate list of structures with volumes and percentages
-    structures_with_volumes = []
-    for _, row in filtered_structures.iterrows():
-        structure_id = row['ID']
-        labels = row['Labels'].split(",")  # Handle multiple labels in the 'Labels' column
-        structure_volume = row['Voxel Volume 3'] / 1000
-        if structure_volume <= 0:  # Ignore structures with zero volume
-            continue
-        percentage = round((row['Voxel Count'] / total_voxels) * 100, 2)
-        for label in labels:
-            structures_with_volumes.append({
-                "id": structure_id,
-                "description": row['Description'],  # Replace 'label' with 'description'
-                "volume": structure_volume,
-                "percentage": percentage
-            })
-
-    # Sort structures by volume (descending order)
-    sorted_structures = sorted(structures_with_volumes, key=lambda x: x['volume'], reverse=True)
-    sorted_structures = sorted_structures[:22]
+    # Table of the structures (one row per label of the 'Labels' column, without the
+    # zero volumes), by decreasing volume, 22 largest
+    structures = structure_table(filtered_structures, total_voxels, volume_column='Voxel Volume 3',
+                                 description_column='Description', labels_column='Labels')
+    structures = sort_by_volume(structures).head(22)
 
     # Handle the size argument
-    if size is not None:
-        sorted_structures = sorted_structures[:size]
+    structures = filter_structures(structures, size=size)
 
-    # Handle selection argument
+    # Handle selection argument (positions in the sorted structures, starting at 1)
     if selection is not None:
-        selected_structures = []
         selection = [int(s) for s in selection.split()]
-        for index in selection:
-            if 1 <= index <= len(sorted_structures):
-                selected_structures.append(sorted_structures[index - 1])
-        sorted_structures = selected_structures
+        structures = structures.iloc[[index - 1 for index in selection if 1 <= index <= len(structures)]]
     if var is not None:
-        selected_structures = [s for s in sorted_structures if int(s['id']) in calculate_top_variance_structures(csv_folder, var)]
-        sorted_structures = selected_structures    
+        # Variance computed once, not per structure
+        structures = filter_structures(structures, variance_ids=calculate_top_variance_structures(csv_folder, var))
 
     # Define sentence templates
     templates = [
@@ -172,24 +108,13 @@ def generate_human_like_caption(image_filename, csv_folder,structures_file, meta
         "This is a {scan_type} scan of a {age}-year-old {gender}, with dimensions {dimensions}. The brain volume is {brain_volume} cm3, displaying structures like {structures}",
     ]
     
-    # Prepare structures text based on selected or all structures
-    unique_structures = {}
-    print(sorted_structures)
-    for struct in sorted_structures:
-        key = struct["description"].lower()  # Convertir en minuscule
-        if key not in unique_structures or struct["volume"] > unique_structures[key]["volume"]:
-            unique_structures[key] = {**struct, "description": key}  # Remplacer par la version minuscule
-
-    # Convert dictionary back to a sorted list
-    sorted_structures = sorted(unique_structures.values(), key=lambda x: x['volume'], reverse=True)
-    sorted_structures = [s for s in sorted_structures if s["volume"] > 1]
-
-    # List of connectors
-    # Connectors
-    connectors = [
-        "and", "additionally", "furthermore", "also", "moreover", "next", 
-        "in addition", "besides", "as well as", "then", "subsequently", "in particular", 
-        "alternatively", "on the other hand"]
+    # Prepare structures text based on selected or all structures:
+    # one per lowercase description (the largest), by decreasing volume
+    print(structures.to_dict("records"))
+    sorted_structures = caption_structures(structures)
+
+    # Connectors (the list of caption_options, also used to remove them)
+    connectors = CONNECTORS
 
     structures_sentences = []
     
@@ -204,16 +129,32 @@ def generate_human_like_caption(image_filename, csv_folder,structures_file, meta
     "features a volume of", "includes a volume of"
 ]
 
-    # Build the structure sentences with connectors
+    # Augmentation: n_captions distinct captions, drawn with the seed of the image
+    if n_captions is not None:
+        fields = {
+            "scan_type": scan_type,
+            "gender": "male" if gender == "M" else "female",
+            "age": age,
+            "dimensions": f"{img.shape[0]} x {img.shape[1]} x {img.shape[2]}",
+            "brain_volume": brain_volume,
+        }
+        captions = CaptionAugmenter(templates, volume_phrases, connectors if use_connectors else []).generate(fields, sorted_structures, n_captions, seed)
+        with open(output_file, 'w', encoding='utf-8') as json_file:
+            json.dump({"captions": captions}, json_file, ensure_ascii=False, indent=4)
+        return captions
+
+    # Build the structure sentences with connectors, drawn with the seed of the image
+    # (process_folder passes caption_seed(--seed, image)), never with the global generator
+    rng = random.Random(caption_seed(0, os.path.basename(image_filename)) if seed is None else seed)
     for i, s in enumerate(sorted_structures):
         volume = round(s["volume"] * 1000) if s["volume"] < 100 else round(s["volume"])
         unit = "mm3" if s["volume"] < 100 else "cm3"
-        volume_phrase = random.choice(volume_phrases)
+        volume_phrase = rng.choice(volume_phrases)
         sentence = f"the {s['description']} {volume_phrase} {volume} {unit}"
         
-        # add connector if not the first structure
-        if i > 0:
-            sentence = random.choice(connectors) + " " + sentence
+        # add connector if not the first structure (unless rendering without connectors)
+        if i > 0 and use_connectors:
+            sentence = rng.choice(connectors) + " " + sentence
         
         structures_sentences.append(sentence)
 
@@ -253,25 +194,26 @@ def generate_human_like_caption(image_filename, csv_folder,structures_file, meta
 import os
 
 
-def process_folder(folder_path, csv_folder, metadata_folder, output_folder, selection=None, size=None, var=None):
+def process_folder(folder_path, csv_folder, metadata_folder, output_folder, selection=None, size=None, var=None, n_captions=None, seed=0,
+                   modalities=None, use_connectors=True):
     # Créer le dossier de sortie si nécessaire
     os.makedirs(output_folder, exist_ok=True)
+    # Légendes découpées en JSON Lines d'une exécution précédente : remplacées par les fichiers JSON
+    remove_shards(output_folder)
 
     dataset_keywords = {
-        "KKI2009": "Kirby",
-        "OAS1": "Oasis",
+        "Kirby": "Kirby",
+        "OASIS": "Oasis",
         "IBSR": "IBSR",
         "IXI": "IXI"
     }
 
-    dataset_keywords_modalite = {
-        "KKI2009": "FLAIR",
-        "OAS1": "T1",
-        "IBSR": "T1",
-        "IXI": "T2"
-    }
+    # Modalité écrite dans les légendes, par dataset (Kirby : FLAIR, Oasis : T1, ...)
+    dataset_keywords_modalite = modality_map(modalities)
 
-    a = None  # Initialisation de 'a'
+    # Dossier des descriptions indexé une seule fois ; les images sans description sont signalées avant le traitement
+    descriptions = description_index(csv_folder)
+    report_missing(descriptions, [f for f in os.listdir(folder_path) if f.endswith(".nii.gz")])
 
     # Boucle à travers tous les fichiers dans le dossier
     for file_name in os.listdir(folder_path):
@@ -279,39 +221,29 @@ def process_folder(folder_path, csv_folder, metadata_folder, output_folder, sele
             image_path = os.path.join(folder_path, file_name)
 
             # Détecter le type de dataset
-            last_dataset = None
-            last_index = -1
-
-            for keyword, dataset in dataset_keywords.items():
-                index = file_name.rfind(keyword)
-                if index != -1 and index > last_index:
-                    last_dataset = dataset
-                    last_index = index
+            tag = parse_subject(file_name)
+            last_dataset = dataset_keywords.get(tag.database) if tag else None
 
             if not last_dataset:
                 print(f"Unknown dataset type for image: {file_name}")
                 continue
 
-            # Set 'a' à la première modalité détectée
-            if a is None and last_dataset in dataset_keywords_modalite:
-                a = dataset_keywords_modalite[last_dataset]
+            # Modalité du dataset de l'image
+            a = dataset_keywords_modalite[last_dataset]
 
             metadata_file = os.path.join(metadata_folder, f"{last_dataset}_info.csv")
 
             # Trouver le fichier CSV correspondant
             base_name = os.path.splitext(file_name)[0]
-            corresponding_csv = None
-            for csv_file in os.listdir(csv_folder):
-                if csv_file.startswith(base_name):
-                    corresponding_csv = os.path.join(csv_folder, csv_file)
-                    break
+            corresponding_csv = descriptions.find(base_name)
 
             if not corresponding_csv:
-                print(f"No corresponding CSV found for image: {file_name}")
+                # Déjà signalée par report_missing
                 continue
 
             output_file = os.path.join(output_folder, f"{base_name}_captions.json")
-            generate_human_like_caption(image_path,csv_folder ,corresponding_csv, metadata_file, output_file, a, last_dataset, selection, size, var)
+            generate_human_like_caption(image_path,csv_folder ,corresponding_csv, metadata_file, output_file, a, last_dataset, selection, size, var,
+                                        n_captions=n_captions, seed=caption_seed(seed, base_name), use_connectors=use_connectors)
             print(f"Processed: {file_name} with {os.path.basename(corresponding_csv)} (Dataset: {last_dataset}, Modality: {a})")
 
 # Code principal pour les arguments de ligne de commande
@@ -326,9 +258,14 @@ if __name__ == "__main__":
     parser.add_argument("--selection", type=int, nargs="+", help="Selection of structure IDs (e.g., 4 56 14 8 9)", default=None)
     parser.add_argument("--size", type=int, help="Number of top structures to display", default=None)
     parser.add_argument("--var", type=int, help="Number of structures with the highest variance to display", default=None)
+    parser.add_argument("--captions-per-image", type=int, default=None,
+                        help="Number of distinct captions per image, sampled over the templates and phrases (default: one per template)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the captions of every image (default: 0)")
+    add_caption_options(parser)
 
     # Parse les arguments
     args = parser.parse_args()
     
     # Appeler la fonction pour générer les légendes avec les arguments
-    process_folder(args.input_folder, args.csv_folder, args.metadata_folder, args.output_folder, args.selection, args.size, args.var)
\ No newline at end of file
+    process_folder(args.input_folder, args.csv_folder, args.metadata_folder, args.output_folder, args.selection, args.size, args.var,
+                   args.captions_per_image, args.seed, parse_modality_overrides(args.modality), args.connectors)
\ No newline at end of file
@@ -1,44 +1,46 @@
 import os
+import sys
 import pandas as pd
+from manifest import load_manifest, save_manifest, plan_run, remove_orphans, remove_stale_outputs, record_outputs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from label_store import update_label_store, subject_from_csv_name, STORE_NAME
 
 # Dossier contenant les fichiers CSV des volumes
 volumes_folder = 'description_3d_oasis'  # Remplacer par le chemin réel du dossier contenant les fichiers CSV
 # Dossier où sauvegarder les fichiers de sortie
 output_folder = 'oasis_simple_descriptions'  # Remplacer par le chemin réel du dossier de sortie
+# Fichier de regroupements
+groupings_file = 'simplified_IBSR.csv'
 
-# Créer le dossier de sortie s'il n'existe pas
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-
-# Charger le fichier de regroupements
-groupings_df = pd.read_csv('simplified_IBSR.csv', encoding='ISO-8859-1')  # Le deuxième fichier CSV avec les regroupements
-
-# Fonction pour traiter chaque fichier CSV des volumes
-def process_volume_file(volume_file):
-    # Charger le fichier CSV des volumes
-    volumes_df = pd.read_csv(volume_file, encoding='ISO-8859-1')
-
-    # Créer un dictionnaire avec les Voxel Count et Voxel Volume par ID
-    volume_dict = dict(zip(volumes_df['ID'], zip(volumes_df['Voxel Count'], volumes_df['Voxel Volume (mm³)'])))
-
-    # Créer une nouvelle liste pour stocker les résultats
-    new_data = []
-
-    # Parcourir chaque ligne du fichier de regroupements
-    for _, row in groupings_df.iterrows():
-        labels = row['Labels']
+SIMPLE_COLUMNS = ['ID', 'Labels', 'Description', 'RGB', 'Voxel Count', 'Voxel Volume 3', 'Volume Ratio (%)']
 
+# Charger le fichier de regroupements une seule fois, sous forme de liste
+def load_groupings(groupings_file):
+    """Retourne une liste de (ids, labels, description, rgb) pour chaque regroupement."""
+    groupings_df = pd.read_csv(groupings_file, encoding='ISO-8859-1')
+    groupings = []
+    for labels, description, rgb in zip(groupings_df['Labels'], groupings_df['Description'], groupings_df['RGB']):
         # Extraire les IDs en s'assurant qu'ils sont des entiers et en ignorant les valeurs non valides
         ids = []
-        for label in labels.split(', '):
+        for label in str(labels).split(', '):
             try:
                 ids.append(int(label))  # Essayer de convertir chaque ID en entier
             except ValueError:
                 continue  # Si la conversion échoue, ignorer cette valeur (par exemple 'Unknown')
+        groupings.append((ids, labels, description, rgb))
+    return groupings
 
-        description = row['Description']
-        rgb = row['RGB']
-
+# Agréger les volumes par regroupement
+def aggregate_groups(volume_dict, groupings, total_volume):
+    """
+    volume_dict : {ID: (Voxel Count, Voxel Volume)} d'une image.
+    total_volume : volume total (sans le label 0) utilisé pour le Volume Ratio (%).
+    Retourne (lignes du CSV simplifié, IDs absents de volume_dict).
+    """
+    new_data = []
+    missing_ids = []
+    for ids, labels, description, rgb in groupings:
         # Calculer la somme des Voxel Count et Voxel Volume pour les IDs de ce regroupement
         total_voxel_count = 0
         total_voxel_volume = 0
@@ -47,21 +49,82 @@ def process_volume_file(volume_file):
                 total_voxel_count += volume_dict[i][0]
                 total_voxel_volume += volume_dict[i][1]
             else:
-                print(f"ID {i} non trouvé dans le fichier des volumes.")  # Avertir sur les IDs manquants
+                missing_ids.append(i)
+        volume_ratio = (total_voxel_volume / total_volume) * 100 if total_volume > 0 else 0.0
 
         # Ajouter les données agrégées à la liste
-        new_data.append([ids[0] if ids else 'Unknown', labels, description, rgb, total_voxel_count, total_voxel_volume])
+        new_data.append([ids[0] if ids else 'Unknown', labels, description, rgb,
+                         total_voxel_count, total_voxel_volume, volume_ratio])
+    return new_data, missing_ids
 
-    # Créer un DataFrame avec les résultats
-    new_df = pd.DataFrame(new_data, columns=['ID', 'Labels', 'Description', 'RGB', 'Voxel Count', 'Voxel Volume 3'])
+# Lignes de la table consolidée (label_volumes.npz) d'un CSV simplifié
+def simple_store_rows(new_data):
+    """(ID, Description, Voxel Count, Voxel Volume, Volume Ratio) des regroupements ayant un ID."""
+    return [
+        (int(group_id), description, int(count), float(volume), float(ratio))
+        for group_id, _, description, _, count, volume, ratio in new_data if group_id != 'Unknown'
+    ]
+
+# Écrire le CSV simplifié d'une image
+def write_simple_csv(new_data, output_file):
+    new_df = pd.DataFrame(new_data, columns=SIMPLE_COLUMNS)
+    new_df.to_csv(output_file, index=False)
+
+# Fonction pour traiter chaque fichier CSV des volumes
+def process_volume_file(volume_file, groupings, output_folder):
+    # Charger le fichier CSV des volumes
+    volumes_df = pd.read_csv(volume_file, encoding='ISO-8859-1')
+
+    # Créer un dictionnaire avec les Voxel Count et Voxel Volume par ID
+    volume_dict = dict(zip(volumes_df['ID'], zip(volumes_df['Voxel Count'], volumes_df['Voxel Volume (mm³)'])))
+    total_volume = volumes_df['Voxel Volume (mm³)'].sum()
+
+    new_data, missing_ids = aggregate_groups(volume_dict, groupings, total_volume)
+    for i in missing_ids:
+        print(f"ID {i} non trouvé dans le fichier des volumes.")  # Avertir sur les IDs manquants
 
     # Sauvegarder les résultats dans un nouveau fichier CSV
     output_file = os.path.join(output_folder, f"{os.path.basename(volume_file)}_simple.csv")
-    new_df.to_csv(output_file, index=False)
+    write_simple_csv(new_data, output_file)
     print(f"Le fichier CSV simplifié pour {volume_file} a été créé avec succès.")
+    return output_file, simple_store_rows(new_data)
+
+if __name__ == "__main__":
+    # Option --force : ignorer le manifest et tout recalculer
+    force = "--force" in sys.argv[1:]
+
+    # Créer le dossier de sortie s'il n'existe pas
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    # Charger le fichier de regroupements
+    groupings = load_groupings(groupings_file)  # Le deuxième fichier CSV avec les regroupements
+
+    # Parcourir tous les fichiers CSV dans le dossier des volumes
+    volume_files = [
+        os.path.join(volumes_folder, file_name)
+        for file_name in sorted(os.listdir(volumes_folder))
+        if file_name.endswith('.csv')
+    ]
+
+    # Ne recalculer que les fichiers nouveaux ou modifiés, et supprimer les sorties orphelines
+    manifest = load_manifest(output_folder, groupings_file, force=force)
+    removed = remove_orphans(manifest, volume_files, output_folder)
+    to_process, up_to_date = plan_run(manifest, volume_files, output_folder)
+    print(f"{len(up_to_date)} fichier(s) à jour, {len(to_process)} à traiter, {len(removed)} sortie(s) orpheline(s) supprimée(s).")
+
+    new_rows = {}
+    for volume_file_path in to_process:
+        output_file, rows = process_volume_file(volume_file_path, groupings, output_folder)
+        record_outputs(manifest, volume_file_path, [output_file], output_folder)
+        new_rows[subject_from_csv_name(os.path.basename(volume_file_path))] = rows
+    stale = remove_stale_outputs(manifest, output_folder)
+    if stale:
+        print(f"{len(stale)} sortie(s) de l'ancien fichier de regroupements supprimée(s).")
+    save_manifest(manifest, output_folder)
 
-# Parcourir tous les fichiers CSV dans le dossier des volumes
-for file_name in os.listdir(volumes_folder):
-    if file_name.endswith('.csv'):
-        volume_file_path = os.path.join(volumes_folder, file_name)
-        process_volume_file(volume_file_path)
+    # Table consolidée (label_volumes.npz) : les lecteurs la préfèrent aux CSV, elle doit
+    # donc suivre les CSV réécrits ou supprimés
+    up_to_date_subjects = [subject_from_csv_name(os.path.basename(path)) for path in up_to_date]
+    update_label_store(output_folder, new_rows, up_to_date_subjects)
+    print(f"Table consolidée mise à jour : {os.path.join(output_folder, STORE_NAME)}")
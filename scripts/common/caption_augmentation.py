@@ -0,0 +1,69 @@
+import hashlib
+import numpy as np
+
+# Caption augmentation: any number of distinct captions for one image, sampled over
+# the templates, the volume phrases and the connectors of a caption generator.
+# The random generator of an image is seeded from (seed, image, variant), so the
+# captions of an image do not depend on the process or on the order of the images
+# (multiprocessing.Pool), and a run can be reproduced. The structure sentences are
+# prepared once per image; a caption only draws indices and joins strings. With no
+# connectors (rendering without connectors) the sentences are only joined by commas.
+MAX_ATTEMPTS_PER_CAPTION = 20
+
+
+def caption_seed(seed, *keys):
+    """Seed of an image and variant: stable across runs and processes (unlike hash())."""
+    text = "\0".join(str(part) for part in (seed,) + keys)
+    return int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+
+
+def volume_text(volume):
+    """ 'volume unit' of a structure volume in cm3 (mm3 below 100 cm3), as the generators write it."""
+    if volume < 100:
+        return f"{round(volume * 1000)} mm3"
+    return f"{round(volume)} cm3"
+
+
+class CaptionAugmenter:
+    """Distinct captions of an image from the templates, volume phrases and connectors of a generator."""
+
+    def __init__(self, templates, volume_phrases, connectors):
+        self.templates = list(templates)
+        self.volume_phrases = list(volume_phrases)
+        self.connectors = list(connectors)
+
+    def structures_text(self, heads, tails, phrases, connectors):
+        if not heads:
+            return ""
+        sentences = [heads[0] + self.volume_phrases[phrases[0]] + tails[0]]
+        sentences += [
+            (self.connectors[c] + " " if self.connectors else "") + head + self.volume_phrases[p] + tail
+            for head, tail, p, c in zip(heads[1:], tails[1:], phrases[1:], connectors)
+        ]
+        return ", ".join(sentences) + "."
+
+    def generate(self, fields, structures, n, seed):
+        """
+        n distinct captions (fewer when the templates and phrases cannot give n).
+        fields: template fields except "structures" (scan_type, gender, age, ...);
+        structures: dicts with "description" and "volume" (cm3), in caption order.
+        """
+        heads = [f"the {s['description']} " for s in structures]
+        tails = [" " + volume_text(s["volume"]) for s in structures]
+        k = len(structures)
+        rng = np.random.default_rng(seed)
+        captions, seen = [], set()
+        attempts = 0
+        while len(captions) < n and attempts < n * MAX_ATTEMPTS_PER_CAPTION:
+            batch = n - len(captions)
+            templates = rng.integers(len(self.templates), size=batch)
+            phrases = rng.integers(len(self.volume_phrases), size=(batch, k))
+            connectors = rng.integers(max(len(self.connectors), 1), size=(batch, max(k - 1, 0)))
+            for i in range(batch):
+                text = self.structures_text(heads, tails, phrases[i], connectors[i])
+                caption = self.templates[templates[i]].format(structures=text, **fields)
+                if caption not in seen:
+                    seen.add(caption)
+                    captions.append(caption)
+            attempts += batch
+        return captions
@@ -0,0 +1,283 @@
+import os
+import json
+import concurrent.futures
+from collections import namedtuple, deque
+import numpy as np
+
+from subject_index import parse_subject, folder_index
+from volume_cache import get_cache_dir, load_volume, open_volume, compact_dtype
+from caption_shards import is_sharded, load_index, read_captions
+from caption_tokens import TokenCorpus
+
+try:
+    import torch.utils.data as torch_data  # DataLoader support (optional)
+    DatasetBase = torch_data.IterableDataset
+except ImportError:
+    torch_data = None
+    DatasetBase = object
+
+# Streaming dataset of (volume, caption) pairs for the training jobs.
+# The items are found in the SIR/<modality>/<db>/{seg,brain,captions_3d} layout: one
+# item per segmentation having captions, with the brain image of the same subject
+# (SubjectIndex) and the caption sources of the selected captions_3d variants. Only
+# the paths are kept in memory; the volumes and captions of the next items are read
+# by a pool of prefetch threads (NIfTI decompression and JSON reads release the GIL)
+# and yielded in order, with at most max_in_flight items loaded at a time. A crop and
+# a downsampling stride are applied while reading. With the volume cache
+# (SIR_VOLUME_CACHE), the first epoch fills it and the next ones slice memory-mapped
+# entries instead of decompressing the .nii.gz again; without it, the nibabel proxy is
+# sliced, so the whole volume is never materialized.
+#
+# The order is a permutation of the items drawn from (seed, epoch), identical in every
+# process, and each process keeps every count-th item from its rank: the shards of
+# the distributed ranks and of the DataLoader workers are disjoint and together cover
+# the epoch. The caption of an item is drawn from (seed, epoch, item), so a run is
+# reproducible whatever the number of threads or workers.
+#
+# Memory and thread budget: PREFETCH_THREADS threads per machine, shared between the
+# DataLoader workers (each worker gets PREFETCH_THREADS // num_workers threads, at
+# least one), and at most 2 items per thread loaded at a time. A whole loader thus
+# holds about 2 x PREFETCH_THREADS items, whatever the number of workers. Distributed
+# ranks on the same machine should pass threads explicitly.
+VOLUME_ROLES = ("brain", "seg")
+CAPTION_CHOICES = ("random", "first", "all")
+PREFETCH_THREADS = os.cpu_count() or 4
+ITEMS_PER_THREAD = 2
+
+PairedItem = namedtuple("PairedItem", ["key", "database", "subject_id", "folder", "volumes", "captions"])
+
+
+def caption_images(folder):
+    """Images (names without _captions.json) of a caption folder, per-file or sharded."""
+    if is_sharded(folder):
+        return set(load_index(folder))
+    return {name[:-len("_captions.json")] for name in os.listdir(folder) if name.endswith("_captions.json")}
+
+
+def scan_database(folder, volumes=("brain",), variants=None, captions_folder="captions_3d", key_prefix=""):
+    """
+    Items of one database folder (SIR/FL/Kirby): every seg/*.nii.gz with captions in one
+    of the variants (subfolders of captions_folder, all by default) and, for the
+    requested volumes, a file in each volume folder. volumes: roles among
+    VOLUME_ROLES. A brain image is matched to the segmentation by subject and session
+    (the modality part of the tag: MR1/MR2 for OASIS); a segmentation with several
+    candidate brain images is skipped as ambiguous.
+    """
+    if any(role not in VOLUME_ROLES for role in volumes):
+        raise ValueError(f"Unknown volume role in {volumes} (expected: {', '.join(VOLUME_ROLES)})")
+    seg_folder = os.path.join(folder, "seg")
+    caption_root = os.path.join(folder, captions_folder)
+    if not os.path.isdir(seg_folder) or not os.path.isdir(caption_root):
+        return []
+    variant_folders = [os.path.join(caption_root, name) for name in sorted(os.listdir(caption_root))
+                       if os.path.isdir(os.path.join(caption_root, name)) and (variants is None or name in variants)]
+    available = [(variant_folder, caption_images(variant_folder)) for variant_folder in variant_folders]
+    brain_folder = os.path.join(folder, "brain")
+    brain_index = folder_index(brain_folder) if "brain" in volumes and os.path.isdir(brain_folder) else None
+
+    items, skipped = [], {"captions": 0, "volume": 0, "ambiguous": 0}
+    for name in sorted(os.listdir(seg_folder)):
+        if not name.endswith(".nii.gz"):
+            continue
+        # Captions are named after the segmentation without .gz (caption_generator_speed.py)
+        image = name[:-len(".gz")]
+        tag = parse_subject(name)
+        sources = [(variant_folder, image) for variant_folder, images in available if image in images]
+        if not sources:
+            skipped["captions"] += 1
+            continue
+        paths = {"seg": os.path.join(seg_folder, name)}
+        if "brain" in volumes:
+            candidates = brain_candidates(brain_index, tag) if brain_index and tag else []
+            if len(candidates) > 1:
+                skipped["ambiguous"] += 1
+                continue
+            paths["brain"] = candidates[0] if candidates else None
+        if any(paths[role] is None for role in volumes):
+            skipped["volume"] += 1
+            continue
+        items.append(PairedItem(f"{key_prefix}{image}", tag.database if tag else None, tag.subject_id if tag else None,
+                                folder, tuple((role, paths[role]) for role in volumes), tuple(sources)))
+    if any(skipped.values()):
+        print(f"{folder}: segmentations skipped: {skipped['captions']} without captions, "
+              f"{skipped['volume']} without {'/'.join(volumes)} volume, {skipped['ambiguous']} with several brain images")
+    return items
+
+
+def brain_candidates(brain_index, tag):
+    """Brain images of the subject of a segmentation tag, of the same session when the names give one."""
+    entries = brain_index.find(tag.database, tag.subject_id)
+    if tag.modality is not None:
+        entries = [e for e in entries if e.modality is None or e.modality == tag.modality]
+    return sorted({e.path for e in entries})
+
+
+def scan_corpus(root, modalities=None, databases=None, **options):
+    """Items of every SIR/<modality>/<db> folder of root (optionally restricted), see scan_database."""
+    items = []
+    for modality in sorted(os.listdir(root)):
+        if not os.path.isdir(os.path.join(root, modality)) or (modalities is not None and modality not in modalities):
+            continue
+        for database in sorted(os.listdir(os.path.join(root, modality))):
+            folder = os.path.join(root, modality, database)
+            if os.path.isdir(folder) and (databases is None or database in databases):
+                items.extend(scan_database(folder, key_prefix=f"{modality}/{database}/", **options))
+    return items
+
+
+def worker_info():
+    """(worker id, number of workers) of this DataLoader worker, (0, 1) outside of a DataLoader."""
+    info = torch_data.get_worker_info() if torch_data is not None else None
+    return (0, 1) if info is None else (info.id, info.num_workers)
+
+
+def worker_shard(rank=0, count=1, worker=None):
+    """Shard (index, count) of this process: the given rank, split again between the DataLoader workers."""
+    worker_id, num_workers = worker or worker_info()
+    return rank * num_workers + worker_id, count * num_workers
+
+
+def crop_slices(shape, crop=None, downsample=1):
+    """Slices of a centered crop (crop larger than the volume: whole axis) with a downsampling stride."""
+    crop = crop or shape[:3]
+    slices = []
+    for size, target in zip(shape[:3], crop):
+        target = min(size, target)
+        start = (size - target) // 2
+        slices.append(slice(start, start + target, downsample))
+    return tuple(slices)
+
+
+def read_volume_region(path, integer=False, crop=None, downsample=1):
+    """Cropped and downsampled voxels of a NIfTI file, read from the cache entry or the file."""
+    source = load_volume(path, integer) if get_cache_dir() else open_volume(path, integer)
+    region = source[crop_slices(source.shape, crop, downsample)]
+    # A cache entry is copied here, by the prefetch thread, instead of being paged in by the training loop
+    data = np.array(region) if isinstance(source, np.memmap) else np.asarray(region)
+    return compact_dtype(data, integer=True) if integer else data
+
+
+class PairedCaptionDataset(DatasetBase):
+    """
+    Iterable of (volume, caption) pairs over items (scan_database / scan_corpus).
+    volume is an array, or a tuple of arrays when the items have several volumes.
+    caption: "random" (one caption of the image, drawn per epoch), "first" or "all"
+    (list). tokens: name of the token export of each database folder
+    (export_caption_tokens.py); captions are then arrays of token IDs.
+    shard: (rank, count) of a distributed job, split again between the DataLoader workers.
+    threads, max_in_flight: prefetch threads and items loaded at a time of each process
+    (default: the budget of the module comment). With torch, this is an IterableDataset
+    to give to a DataLoader with batch_size=None or a collate function.
+    """
+
+    def __init__(self, items, caption="random", crop=None, downsample=1, shuffle=True, seed=0, shard=(0, 1),
+                 threads=None, max_in_flight=None, tokens=None, with_keys=False):
+        if caption not in CAPTION_CHOICES:
+            raise ValueError(f"Unknown caption choice: {caption} (expected: {', '.join(CAPTION_CHOICES)})")
+        self.items = list(items)
+        self.caption = caption
+        self.crop = crop
+        self.downsample = downsample
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shard = shard
+        self.threads = threads
+        self.max_in_flight = max_in_flight
+        self.tokens = tokens
+        self.with_keys = with_keys
+        self.epoch = 0
+        self._corpora = {}
+
+    def __getstate__(self):
+        # Sent to the DataLoader workers without the opened token corpora
+        state = dict(self.__dict__)
+        state["_corpora"] = {}
+        return state
+
+    def set_epoch(self, epoch):
+        """Epoch of the next iterations (order and captions), to be set by the training loop."""
+        self.epoch = epoch
+
+    def indices(self, worker=None):
+        """Items of this process (or of worker=(id, number of workers)) for the current epoch, in order."""
+        order = np.arange(len(self.items))
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.items))
+        index, count = worker_shard(*self.shard, worker=worker)
+        return order[index::count]
+
+    def __len__(self):
+        # Items of the rank: called by the main process, outside of the workers
+        return len(self.indices())
+
+    def prefetch_budget(self):
+        """(threads, max_in_flight) of this process."""
+        threads = self.threads or max(1, PREFETCH_THREADS // worker_info()[1])
+        return threads, self.max_in_flight or ITEMS_PER_THREAD * threads
+
+    def token_corpus(self, folder):
+        # One TokenCorpus per database folder and process (memory-mapped arrays)
+        corpus = self._corpora.get(folder)
+        if corpus is None:
+            corpus = self._corpora[folder] = TokenCorpus(os.path.join(folder, self.tokens))
+        return corpus
+
+    def read_captions(self, item):
+        captions = []
+        for variant_folder, image in item.captions:
+            if self.tokens is not None:
+                variant = os.path.relpath(variant_folder, item.folder).replace(os.sep, "/")
+                captions.extend(self.token_corpus(item.folder).captions(variant, image))
+            elif is_sharded(variant_folder):
+                captions.extend(read_captions(variant_folder, image) or [])
+            else:
+                with open(os.path.join(variant_folder, f"{image}_captions.json"), mode="r", encoding="utf-8") as file:
+                    captions.extend(json.load(file)["captions"])
+        return captions
+
+    def load(self, index):
+        """(volume, caption) of item index for the current epoch (read by the prefetch threads)."""
+        item = self.items[index]
+        # Segmentations as labels in the smallest integer dtype, images in their stored dtype
+        volumes = tuple(read_volume_region(path, integer=role == "seg", crop=self.crop, downsample=self.downsample)
+                        for role, path in item.volumes)
+        volume = volumes[0] if len(volumes) == 1 else volumes
+        captions = self.read_captions(item)
+        if self.caption == "all":
+            caption = captions
+        elif self.caption == "first" or not captions:
+            caption = captions[0] if captions else None
+        else:
+            caption = captions[np.random.default_rng([self.seed, self.epoch, index]).integers(len(captions))]
+        return (item.key, volume, caption) if self.with_keys else (volume, caption)
+
+    def __iter__(self):
+        indices = self.indices()
+        threads, max_in_flight = self.prefetch_budget()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            try:
+                for index in indices:
+                    if len(pending) >= max_in_flight:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(self.load, index))
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Iteration stopped early: the queued reads are not needed any more
+                for future in pending:
+                    future.cancel()
+
+
+def check_worker_shards(dataset, num_workers):
+    """
+    Check that the shards of num_workers DataLoader workers are disjoint and together
+    give the items of the rank, for the current epoch. Raises ValueError otherwise.
+    """
+    expected = dataset.indices(worker=(0, 1))
+    shards = [dataset.indices(worker=(worker_id, num_workers)) for worker_id in range(num_workers)]
+    merged = np.concatenate(shards)
+    if len(np.unique(merged)) != len(merged):
+        raise ValueError(f"The shards of {num_workers} workers overlap")
+    if not np.array_equal(np.sort(merged), np.sort(expected)):
+        raise ValueError(f"The shards of {num_workers} workers do not cover the epoch")
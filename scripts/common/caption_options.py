@@ -0,0 +1,44 @@
+# Options applied while rendering the captions, instead of the passes that rewrote
+# every caption JSON afterwards (modalite.py, modalite_speed.py, delete_connectors.py):
+# the modality written for each dataset and the rendering without connectors.
+
+# Connectors between the structure sentences, the single list of the generators and of
+# the connector removal (--no-connectors, delete_connectors.py, caption_rewrite.ConnectorRule)
+CONNECTORS = [
+    "and", "additionally", "furthermore", "also", "moreover", "next",
+    "in addition", "besides", "as well as", "then", "subsequently", "in particular",
+    "alternatively", "on the other hand"
+]
+
+# Modality of the images of each caption dataset (the folders SIR/FL/Kirby, SIR/T1/OASIS, ...)
+DATASET_MODALITIES = {"Kirby": "FLAIR", "Oasis": "T1", "IBSR": "T1", "IXI": "T2"}
+
+
+def modality_map(overrides=None):
+    """Modality of every dataset, with the given {dataset: modality} overrides."""
+    modalities = dict(DATASET_MODALITIES)
+    for dataset, modality in (overrides or {}).items():
+        if dataset not in DATASET_MODALITIES:
+            raise ValueError(f"Unknown dataset: {dataset} (known: {', '.join(DATASET_MODALITIES)})")
+        modalities[dataset] = modality
+    return modalities
+
+
+def parse_modality_overrides(values):
+    """["Kirby=T1", ...] (command line) -> {"Kirby": "T1", ...}"""
+    overrides = {}
+    for value in values or []:
+        dataset, separator, modality = value.partition("=")
+        if not separator or not dataset or not modality:
+            raise ValueError(f"Invalid modality '{value}', expected DATASET=MODALITY (e.g. Kirby=FLAIR)")
+        overrides[dataset] = modality
+    return overrides
+
+
+def add_caption_options(parser):
+    """--modality and --no-connectors options of the caption generators."""
+    parser.add_argument("--modality", action="append", metavar="DATASET=MODALITY", default=[],
+                        help="Modality written in the captions of a dataset, repeatable "
+                             f"(default: {', '.join(f'{d}={m}' for d, m in DATASET_MODALITIES.items())})")
+    parser.add_argument("--no-connectors", dest="connectors", action="store_false",
+                        help="Join the structure sentences without connectors (and, furthermore, ...)")
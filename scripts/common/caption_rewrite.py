@@ -0,0 +1,439 @@
+import os
+import re
+import json
+import difflib
+from collections import Counter
+from multiprocessing import Pool
+
+from caption_options import CONNECTORS
+
+# Fixes of already generated captions (<image>_captions.json files).
+# An ordered list of rules (literal replacement, regular expression, connector
+# removal) is applied to every caption, with one read and one write per file. The
+# files are split into batches over the processes of a Pool: every file belongs to
+# a single batch, so it is written by a single process. Writes go to a temporary
+# file that is then renamed (os.replace): an interrupted run never leaves a
+# truncated JSON behind.
+#
+# By default, the runs of consecutive literal rules (LiteralRule, ConnectorRule) are
+# compiled into a single multi-pattern matcher (compile_rules), so a caption is
+# scanned once from left to right whatever the number of rules, instead of once per
+# rule. The matcher is one alternation of the literals, grouped by first character
+# and without capture groups, with the case folding written as character classes
+# and a lookahead on the possible first characters: re then jumps to the candidate
+# positions (groups, IGNORECASE and a leading lookbehind all defeat that
+# optimisation). The rule of a match is found from the matched text. At a given
+# position, the first rule (in the given order) that matches wins, and the replaced
+# text is not scanned again. That is only the result of the sequential passes for
+# independent rules, so a run is cut before a rule whose text can overlap the text
+# of an earlier rule of the run ("38" and "1381") or the text written by one (None ->
+# T1 then T1 -> FLAIR), or whose word boundaries an earlier replacement can change
+# (rules_interact): the compiled rules always give the sequential result.
+# sequential=True keeps one pass per rule.
+#
+# A file is only written when one of its captions changed, and a dry run writes
+# nothing: both report the files that would change, the hits of every rule and a
+# few word-level diffs of changed captions (RewriteReport).
+FILES_PER_BATCH = 256
+DIFF_CONTEXT_WORDS = 4
+
+
+def literal_pattern(text, whole_word=False, ignore_case=False):
+    """Regex of a literal text; the case is folded with character classes ([aA]) rather than IGNORECASE."""
+    if ignore_case:
+        pattern = "".join(
+            f"[{re.escape(c.lower())}{re.escape(c.upper())}]"
+            if c.lower() != c.upper() and len(c.lower()) == len(c.upper()) == 1 else re.escape(c)
+            for c in text)
+    else:
+        pattern = re.escape(text)
+    return rf"(?<!\w){pattern}(?!\w)" if whole_word else pattern
+
+
+class LiteralRule:
+    """Replaces every occurrence of old with new (optionally whole words only, or ignoring case)."""
+
+    def __init__(self, old, new, whole_word=False, ignore_case=False):
+        self.old = old
+        self.new = new
+        self.whole_word = whole_word
+        self.ignore_case = ignore_case
+        self.pattern = None
+        if whole_word or ignore_case:
+            self.pattern = re.compile(literal_pattern(old, whole_word, ignore_case))
+
+    def literals(self):
+        """(text, replacement, whole_word, ignore_case) of the rule, for the single scan."""
+        return [(self.old, self.new, self.whole_word, self.ignore_case)] if self.old else []
+
+    def apply(self, caption, hits=None):
+        if self.pattern is None:
+            if hits is not None:
+                hits[repr(self)] += caption.count(self.old)
+            return caption.replace(self.old, self.new)
+        caption, count = self.pattern.subn(lambda match: self.new, caption)
+        if hits is not None:
+            hits[repr(self)] += count
+        return caption
+
+    def __repr__(self):
+        options = "".join([", whole_word=True" if self.whole_word else "", ", ignore_case=True" if self.ignore_case else ""])
+        return f"LiteralRule({self.old!r}, {self.new!r}{options})"
+
+
+class RegexRule:
+    """Replaces the matches of a regular expression (re.sub)."""
+
+    def __init__(self, pattern, replacement, ignore_case=False):
+        self.pattern = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        self.replacement = replacement
+
+    def literals(self):
+        return []  # Applied on its own
+
+    def apply(self, caption, hits=None):
+        caption, count = self.pattern.subn(self.replacement, caption)
+        if hits is not None:
+            hits[repr(self)] += count
+        return caption
+
+    def __repr__(self):
+        return f"RegexRule({self.pattern.pattern!r}, {self.replacement!r})"
+
+
+class ConnectorRule(RegexRule):
+    """Removes the connectors (whole words, any case), as delete_connectors.py does."""
+
+    def __init__(self, connectors=None):
+        self.connectors = list(dict.fromkeys(CONNECTORS if connectors is None else connectors))
+        super().__init__(r'\b(?:' + '|'.join(re.escape(connector) for connector in self.connectors) + r')\b', "", ignore_case=True)
+
+    def literals(self):
+        return [(connector, "", True, True) for connector in self.connectors if connector]
+
+    def apply(self, caption, hits=None):
+        return super().apply(caption, hits).strip()
+
+    def __repr__(self):
+        return "ConnectorRule()"
+
+
+def first_chars(text, ignore_case=False):
+    """Characters that can start a match of the literal."""
+    c = text[0]
+    if ignore_case and c.lower() != c.upper() and len(c.lower()) == len(c.upper()) == 1:
+        return {c.lower(), c.upper()}
+    return {c}
+
+
+def char_class(chars):
+    chars = sorted(chars)
+    return re.escape(chars[0]) if len(chars) == 1 else "[" + "".join(re.escape(c) for c in chars) + "]"
+
+
+class CaptionReplacements(dict):
+    """Replacement of a matched text: exact texts, then case-folded texts (cached per spelling)."""
+
+    def __init__(self, exact, folded):
+        super().__init__(exact)
+        self.folded = folded
+
+    def __missing__(self, text):
+        replacement = self[text] = self.folded[text.lower()]
+        return replacement
+
+
+class MultiPatternRule:
+    """Literal rules applied in a single left-to-right scan of the caption."""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        exact, folded, exact_rules, folded_rules = {}, {}, {}, {}
+        # Literals grouped by first character (case folded), in the order of the rules
+        groups = {}
+        for rule in self.rules:
+            for text, replacement, whole_word, ignore_case in rule.literals():
+                if ignore_case:
+                    folded[text.lower()] = replacement
+                    folded_rules[text.lower()] = repr(rule)
+                else:
+                    exact[text] = replacement
+                    exact_rules[text] = repr(rule)
+                groups.setdefault(text[0].lower(), []).append((text, whole_word, ignore_case))
+        self.replacements = CaptionReplacements(exact, folded)
+        # Rule of a matched text, to count the hits of every rule
+        self.owners = CaptionReplacements(exact_rules, folded_rules)
+
+        # One branch per first character: the character is matched once, then the rest of
+        # each literal (preceded by its own first character when the branch accepts more cases)
+        branches, starts = [], set()
+        for literals in groups.values():
+            heads = set().union(*(first_chars(text, ignore_case) for text, _, ignore_case in literals))
+            starts |= heads
+            alternatives = []
+            for text, whole_word, ignore_case in literals:
+                head = first_chars(text, ignore_case)
+                alternative = "" if head == heads else f"(?<={char_class(head)})"
+                if whole_word:
+                    alternative += r"(?<!\w.)"
+                alternative += literal_pattern(text[1:], ignore_case=ignore_case)
+                if whole_word:
+                    alternative += r"(?!\w)"
+                alternatives.append(alternative)
+            branches.append(f"{char_class(heads)}(?:{'|'.join(alternatives)})")
+        # The lookahead on the possible first characters lets re skip to the candidate positions
+        self.pattern = re.compile(f"(?={char_class(starts)})(?:{'|'.join(branches)})")
+        # The connector removal strips the caption once its connectors are removed
+        self.strip = any(isinstance(rule, ConnectorRule) for rule in self.rules)
+
+    def _replace(self, match):
+        return self.replacements[match.group()]
+
+    def apply(self, caption, hits=None):
+        if hits is None:
+            caption = self.pattern.sub(self._replace, caption)
+        else:
+            def replace(match):
+                text = match.group()
+                hits[self.owners[text]] += 1
+                return self.replacements[text]
+            caption = self.pattern.sub(replace, caption)
+        return caption.strip() if self.strip else caption
+
+    def __repr__(self):
+        return f"MultiPatternRule({self.rules!r})"
+
+
+def is_word_char(c):
+    return re.match(r"\w", c) is not None
+
+
+def texts_overlap(a, b, a_whole_word=False, b_whole_word=False, ignore_case=False):
+    """
+    Whether an occurrence of b can share characters with an occurrence of a: one
+    contains the other, or an end of one is the start of the other. A whole-word text
+    needs a non-word character (or the end of the other text) on each side.
+    """
+    if ignore_case:
+        a, b = a.lower(), b.lower()
+    for start in range(1 - len(b), len(a)):  # Position of b relative to a
+        lo, hi = max(0, start), min(len(a), start + len(b))
+        if a[lo:hi] != b[lo - start:hi - start]:
+            continue
+        # Characters next to b that belong to a, and next to a that belong to b
+        if b_whole_word and any(0 <= i < len(a) and is_word_char(a[i]) for i in (start - 1, start + len(b))):
+            continue
+        if a_whole_word and any(0 <= i < len(b) and is_word_char(b[i]) for i in (-1 - start, len(a) - start)):
+            continue
+        return True
+    return False
+
+
+def literals_interact(earlier, later, strips=False):
+    """
+    Whether the literal later, applied after earlier, can give another result in a
+    single scan than in a second pass. Both are (text, replacement, whole_word,
+    ignore_case); strips: the earlier rule strips the caption (ConnectorRule).
+    """
+    text, replacement, whole_word, ignore_case = earlier
+    later_text, later_replacement, later_whole_word, later_ignore_case = later
+    # Overlapping texts: the scan takes the match that starts first
+    if texts_overlap(text, later_text, whole_word, later_whole_word, ignore_case or later_ignore_case):
+        return True
+    if replacement:
+        # The later rule matches (part of) the written text
+        if texts_overlap(replacement, later_text, False, later_whole_word, later_ignore_case):
+            return True
+        # The replacement changes the word boundaries seen by a whole-word match next to it
+        edges = ((text[0], replacement[0]), (text[-1], replacement[-1]))
+        if later_whole_word and any(is_word_char(old) != is_word_char(new) for old, new in edges):
+            return True
+    elif whole_word:
+        # A removed word leaves its two non-word neighbours side by side
+        word_edges = is_word_char(later_text[0]) and is_word_char(later_text[-1])
+        if re.search(r"\W\W", later_text) or (later_whole_word and not word_edges):
+            return True
+    elif len(later_text) > 1 or later_whole_word:
+        # Removed text: any neighbours end up side by side
+        return True
+    # The sequential passes strip the caption before the later rule, the scan only at the end
+    if strips and (not later_replacement or later_text != later_text.strip()
+                   or later_replacement != later_replacement.strip()):
+        return True
+    return False
+
+
+def rules_interact(earlier, later):
+    """Whether the literal rule later may not see what a pass of the literal rule earlier leaves."""
+    strips = isinstance(earlier, ConnectorRule)
+    return any(literals_interact(a, b, strips) for a in earlier.literals() for b in later.literals())
+
+
+def compile_rules(rules):
+    """
+    Rules -> rules to apply: every run of consecutive literal rules becomes one
+    MultiPatternRule (the regular expressions are applied on their own). A rule that
+    interacts with a rule of the run (rules_interact: overlapping texts, a text
+    written by an earlier rule, changed word boundaries) starts a new run, so that the
+    result is always the one of the sequential passes.
+    """
+    compiled, run = [], []
+
+    def flush():
+        compiled.append(MultiPatternRule(run) if len(run) > 1 else run[0])
+        run.clear()
+
+    for rule in rules:
+        if not rule.literals():
+            if run:
+                flush()
+            compiled.append(rule)
+            continue
+        if any(rules_interact(earlier, rule) for earlier in run):
+            flush()
+        run.append(rule)
+    if run:
+        flush()
+    return compiled
+
+
+def apply_rules(caption, rules, hits=None):
+    for rule in rules:
+        caption = rule.apply(caption, hits)
+    return caption
+
+
+def caption_diff(old, new, context=DIFF_CONTEXT_WORDS):
+    """Word-level diff of a caption: [-removed-] {+added+}, with a few words of context around each change."""
+    old_words, new_words = old.split(" "), new.split(" ")
+    parts = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_words, new_words, autojunk=False).get_opcodes():
+        if tag == "equal":
+            words = old_words[i1:i2]
+            if len(words) > 2 * context:
+                words = ([] if i1 == 0 else words[:context]) + ["..."] + ([] if i2 == len(old_words) else words[-context:])
+            parts.extend(words)
+            continue
+        removed, added = " ".join(old_words[i1:i2]).strip(), " ".join(new_words[j1:j2]).strip()
+        if removed:
+            parts.append("[-" + removed + "-]")
+        if added:
+            parts.append("{+" + added + "+}")
+    return " ".join(parts)
+
+
+class RewriteReport:
+    """Files changed, unchanged and skipped, hits of every rule, sample diffs and errors of a rewrite."""
+
+    def __init__(self, max_samples=0):
+        self.changed = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.hits = Counter()
+        self.samples = []
+        self.max_samples = max_samples
+        self.errors = []
+
+    def add_sample(self, path, old, new):
+        if len(self.samples) < self.max_samples:
+            self.samples.append((path, caption_diff(old, new)))
+
+    def merge(self, other):
+        self.changed += other.changed
+        self.unchanged += other.unchanged
+        self.skipped += other.skipped
+        self.hits.update(other.hits)
+        for sample in other.samples:
+            if len(self.samples) < self.max_samples:
+                self.samples.append(sample)
+        self.errors.extend(other.errors)
+
+    def lines(self, dry_run=False):
+        lines = [f"{os.path.basename(path)}: {diff}" for path, diff in self.samples]
+        lines += [f"Error: {path}: {error}" for path, error in self.errors]
+        lines += [f"{hits:>9} hit(s)  {rule}" for rule, hits in self.hits.most_common()]
+        verb = "would change" if dry_run else "changed"
+        lines.append(f"{self.changed} file(s) {verb}, {self.unchanged} unchanged, {self.skipped} without captions, "
+                     f"{len(self.errors)} error(s)" + (" (dry run, nothing written)" if dry_run else ""))
+        return lines
+
+
+def write_json_atomic(path, data):
+    """Writes the JSON to a temporary file of the same folder, then renames it."""
+    temporary = path + ".tmp"
+    try:
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False, indent=4)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def rewrite_file(path, rules, report, dry_run=False):
+    """
+    Applies the rules to the captions of a file, in memory, and writes it only when a
+    caption changed (never in a dry run). The outcome is counted in report.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    if not isinstance(data, dict) or not isinstance(data.get("captions"), list):
+        report.skipped += 1
+        return
+    captions = data["captions"]
+    new_captions = [apply_rules(caption, rules, report.hits) for caption in captions]
+    if new_captions == captions:
+        report.unchanged += 1
+        return
+    # One sample per file: its first changed caption
+    report.add_sample(path, *next((old, new) for old, new in zip(captions, new_captions) if old != new))
+    if not dry_run:
+        data["captions"] = new_captions
+        write_json_atomic(path, data)
+    report.changed += 1
+
+
+def rewrite_batch(batch):
+    """Batch of files of one Pool process -> its RewriteReport."""
+    paths, rules, dry_run, max_samples = batch
+    report = RewriteReport(max_samples)
+    for path in paths:
+        try:
+            rewrite_file(path, rules, report, dry_run)
+        except (OSError, ValueError) as exc:
+            report.errors.append((path, str(exc)))
+    return report
+
+
+def caption_files(folders):
+    """The .json files of the folders, each listed once (even when a folder is given twice)."""
+    files = set()
+    for folder in folders:
+        for name in os.listdir(folder):
+            if name.endswith(".json"):
+                files.add(os.path.realpath(os.path.join(folder, name)))
+    return sorted(files)
+
+
+def rewrite_folders(folders, rules, workers=None, files_per_batch=FILES_PER_BATCH, sequential=False,
+                    dry_run=False, max_samples=0):
+    """
+    Applies the rules to every caption file of the folders, split into batches
+    over workers processes, in a single scan per caption unless sequential. Only
+    the files whose captions change are written, none in a dry run. Returns the
+    RewriteReport, with at most max_samples diffs (the first ones, in file order).
+    """
+    if not sequential:
+        rules = compile_rules(rules)
+    files = caption_files(folders)
+    batches = [(files[i:i + files_per_batch], rules, dry_run, max_samples)
+               for i in range(0, len(files), files_per_batch)]
+    report = RewriteReport(max_samples)
+    if not batches:
+        return report
+    with Pool(processes=min(workers or os.cpu_count() or 1, len(batches))) as pool:
+        # In the order of the files, so that the samples are the same from one run to the next
+        for batch_report in pool.imap(rewrite_batch, batches):
+            report.merge(batch_report)
+    return report
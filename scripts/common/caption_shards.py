@@ -0,0 +1,148 @@
+import os
+import re
+import gzip
+import json
+import functools
+
+# Sharded JSON Lines output of the caption generators.
+# Instead of one small <image>_captions.json file per image and variant, the captions
+# of a variant folder (captions_exhaustive/, captions_selection/, ...) are appended to
+# a few large shards, captions-00000.jsonl, captions-00001.jsonl, ... with one
+# {"image": ..., "captions": [...]} record per line. index.json gives the shard, byte
+# offset and length of every record, so the captions of one image are read with a
+# single seek. With compression, every record is its own gzip member: a .jsonl.gz
+# shard can still be read whole with gzip (zcat) and a record decompressed alone.
+OUTPUT_FORMATS = ("json", "jsonl", "jsonl.gz")
+INDEX_NAME = "index.json"
+SHARD_PATTERN = re.compile(r"^captions-\d{5}\.jsonl(\.gz)?$")
+RECORDS_PER_SHARD = 5000
+
+
+class CaptionShardWriter:
+    """Writes the caption records of one variant folder into shards, then its index on close."""
+
+    def __init__(self, folder, compress=False, records_per_shard=RECORDS_PER_SHARD):
+        self.folder = folder
+        self.compress = compress
+        self.records_per_shard = records_per_shard
+        self.index = {}
+        self._file = None
+        self._shard_name = None
+        self._shard_records = 0
+        self._shard_number = 0
+        os.makedirs(folder, exist_ok=True)
+        # Shards of a previous run would not be in the new index
+        for name in os.listdir(folder):
+            if SHARD_PATTERN.match(name):
+                os.remove(os.path.join(folder, name))
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        extension = ".jsonl.gz" if self.compress else ".jsonl"
+        self._shard_name = f"captions-{self._shard_number:05d}{extension}"
+        self._shard_number += 1
+        self._shard_records = 0
+        self._file = open(os.path.join(self.folder, self._shard_name), mode="wb")
+
+    def write(self, image, captions):
+        if self._file is None or self._shard_records >= self.records_per_shard:
+            self._next_shard()
+        line = (json.dumps({"image": image, "captions": captions}, ensure_ascii=False) + "\n").encode("utf-8")
+        data = gzip.compress(line) if self.compress else line
+        offset = self._file.tell()
+        self._file.write(data)
+        self._shard_records += 1
+        self.index[image] = [self._shard_name, offset, len(data)]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index_path = os.path.join(self.folder, INDEX_NAME)
+        with open(index_path + ".tmp", mode="w", encoding="utf-8") as file:
+            json.dump(self.index, file, ensure_ascii=False)
+        os.replace(index_path + ".tmp", index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def remove_shards(folder):
+    """
+    Delete the index and the shards of a folder, before per-file captions are written
+    into it: the readers prefer index.json and would keep serving the old shards.
+    """
+    for name in [INDEX_NAME] + shard_names(folder):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def is_sharded(folder):
+    return os.path.exists(os.path.join(folder, INDEX_NAME))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_index(index_path, mtime_ns):
+    with open(index_path, mode="r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def load_index(folder):
+    """{image: [shard, offset, length]} of a sharded folder (read again when it changes)."""
+    index_path = os.path.join(folder, INDEX_NAME)
+    return _load_index(index_path, os.stat(index_path).st_mtime_ns)
+
+
+def decode_record(data, shard_name):
+    if shard_name.endswith(".gz"):
+        data = gzip.decompress(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def read_captions(folder, image):
+    """Captions of one image (name without _captions.json) of a sharded folder, None if absent."""
+    entry = load_index(folder).get(image)
+    if entry is None:
+        return None
+    shard_name, offset, length = entry
+    with open(os.path.join(folder, shard_name), mode="rb") as file:
+        file.seek(offset)
+        return decode_record(file.read(length), shard_name)["captions"]
+
+
+def shard_names(folder):
+    return sorted(name for name in os.listdir(folder) if SHARD_PATTERN.match(name))
+
+
+def iter_shard(path):
+    """(image, captions) of every record of one shard."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, mode="rt", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            yield record["image"], record["captions"]
+
+
+def iter_records(folder):
+    """(image, captions) of every record of a sharded folder, shard by shard."""
+    for shard_name in shard_names(folder):
+        yield from iter_shard(os.path.join(folder, shard_name))
+
+
+def iter_caption_folder(folder):
+    """
+    (image, captions) of a caption folder, sharded or in the per-file layout
+    (<image>_captions.json files), so readers accept both.
+    """
+    if is_sharded(folder):
+        yield from iter_records(folder)
+        return
+    for name in sorted(os.listdir(folder)):
+        if name.endswith("_captions.json"):
+            with open(os.path.join(folder, name), mode="r", encoding="utf-8") as file:
+                yield name[:-len("_captions.json")], json.load(file)["captions"]
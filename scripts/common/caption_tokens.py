@@ -0,0 +1,290 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import numpy as np
+
+from caption_shards import INDEX_NAME as SHARD_INDEX_NAME, shard_names, iter_shard
+
+# Pre-tokenized caption corpus for the training jobs.
+# The captions of the captions_3d*/captions_* folders of a root folder are tokenized
+# once with a word-level vocabulary and written as two memory-mapped .npy arrays:
+# tokens (all the token IDs, one caption after the other) and offsets (caption i is
+# tokens[offsets[i]:offsets[i + 1]]). index.json gives, for every record (one image of
+# one variant folder), its first caption and its number of captions, so a loader
+# slices captions without parsing any JSON or text.
+#
+# The export is incremental: every source (a _captions.json file, or a shard of a
+# sharded folder) is recorded with its size and mtime, and the token IDs of unchanged
+# sources are copied from the previous arrays instead of being parsed and tokenized
+# again. The vocabulary only grows (new tokens get new IDs), so the previous IDs stay
+# valid; with a frozen vocabulary, unknown tokens become <unk>. The arrays of a new
+# export get new file names and index.json, which names them, is replaced last: a
+# loader always sees a complete export.
+VOCABULARY_NAME = "vocabulary.json"
+INDEX_NAME = "index.json"
+INDEX_VERSION = 1
+SPECIAL_TOKENS = ["<pad>", "<unk>", "<bos>", "<eos>"]
+PAD_ID, UNK_ID, BOS_ID, EOS_ID = range(len(SPECIAL_TOKENS))
+# Words, single digits (volumes are spelled digit by digit, which keeps the
+# vocabulary small) and punctuation
+TOKEN_PATTERN = r"[^\W\d_]+|\d|[^\w\s]|_"
+TOKEN_DTYPE = np.int32
+CAPTION_FOLDERS = os.path.join("captions_3d*", "captions_*")
+ARRAY_PATTERN = re.compile(r"^(tokens|offsets)_\d{5}\.npy$")
+
+
+class Vocabulary:
+    """Word-level vocabulary: token -> ID, with the special tokens first."""
+
+    def __init__(self, tokens=None, lowercase=True, frozen=False):
+        self.tokens = list(tokens) if tokens else list(SPECIAL_TOKENS)
+        self.ids = {token: i for i, token in enumerate(self.tokens)}
+        self.lowercase = lowercase
+        self.frozen = frozen
+        self.pattern = re.compile(TOKEN_PATTERN)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def encode(self, caption):
+        """Token IDs of a caption, between <bos> and <eos> (new tokens are added unless frozen)."""
+        if self.lowercase:
+            caption = caption.lower()
+        ids = [BOS_ID]
+        for token in self.pattern.findall(caption):
+            token_id = self.ids.get(token)
+            if token_id is None:
+                if self.frozen:
+                    token_id = UNK_ID
+                else:
+                    token_id = self.ids[token] = len(self.tokens)
+                    self.tokens.append(token)
+            ids.append(token_id)
+        ids.append(EOS_ID)
+        return ids
+
+    def decode(self, ids):
+        return " ".join(self.tokens[i] for i in ids if i not in (PAD_ID, BOS_ID, EOS_ID))
+
+    def digest(self, size=None):
+        """SHA-256 of the first size tokens: the IDs of a previous export are valid while it is unchanged."""
+        tokens = self.tokens if size is None else self.tokens[:size]
+        return hashlib.sha256("\n".join(tokens).encode("utf-8")).hexdigest()
+
+    def save(self, path):
+        data = {"lowercase": self.lowercase, "pattern": TOKEN_PATTERN, "tokens": self.tokens}
+        with open(path + ".tmp", mode="w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False, indent=0)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, frozen=False):
+        with open(path, mode="r", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("pattern", TOKEN_PATTERN) != TOKEN_PATTERN:
+            raise ValueError(f"{path} was built with another tokenization pattern")
+        return cls(data["tokens"], lowercase=data.get("lowercase", True), frozen=frozen)
+
+
+def caption_sources(root):
+    """
+    Sources of the captions_3d*/captions_* folders of root: (key, path, variant), key
+    being the path relative to root and variant the relative folder (captions_3d/captions_var_10).
+    """
+    sources = []
+    for folder in sorted(glob.glob(os.path.join(root, CAPTION_FOLDERS))):
+        if not os.path.isdir(folder):
+            continue
+        variant = os.path.relpath(folder, root).replace(os.sep, "/")
+        if os.path.exists(os.path.join(folder, SHARD_INDEX_NAME)):
+            names = shard_names(folder)
+        else:
+            names = sorted(name for name in os.listdir(folder) if name.endswith("_captions.json"))
+        sources.extend((f"{variant}/{name}", os.path.join(folder, name), variant) for name in names)
+    return sources
+
+
+def read_source(path):
+    """(image, captions) of a source: a _captions.json file or a shard."""
+    if path.endswith("_captions.json"):
+        with open(path, mode="r", encoding="utf-8") as file:
+            return [(os.path.basename(path)[:-len("_captions.json")], json.load(file)["captions"])]
+    return list(iter_shard(path))
+
+
+def load_export(folder):
+    """index.json of an export, or None."""
+    index_path = os.path.join(folder, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, mode="r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_old_arrays(folder, keep):
+    """Arrays of the previous exports (still open by a loader on Windows: kept for the next run)."""
+    for name in os.listdir(folder):
+        if ARRAY_PATTERN.match(name) and name not in keep:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+
+def export_tokens(root, output_folder, vocabulary_path=None, force=False):
+    """
+    Export the captions of root into output_folder (tokens, offsets, index.json and the
+    vocabulary). vocabulary_path: existing vocabulary used frozen (unknown tokens ->
+    <unk>); by default the vocabulary of output_folder is reused and extended.
+    Returns a summary dict (captions, tokens, reused and tokenized sources).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if vocabulary_path is None:
+        vocabulary_path = os.path.join(output_folder, VOCABULARY_NAME)
+        vocabulary = Vocabulary.load(vocabulary_path) if os.path.exists(vocabulary_path) else Vocabulary()
+    else:
+        vocabulary_path = os.path.abspath(vocabulary_path)
+        vocabulary = Vocabulary.load(vocabulary_path, frozen=True)
+
+    previous = load_export(output_folder)
+    generation = previous.get("generation", 0) + 1 if previous else 1
+    # The previous token IDs are only reused if they still mean the same tokens
+    if (force or previous is None or previous.get("version") != INDEX_VERSION
+            or previous.get("frozen") != vocabulary.frozen or len(vocabulary) < previous["vocabulary_size"]
+            or vocabulary.digest(previous["vocabulary_size"]) != previous["vocabulary_sha256"]):
+        previous = None
+    if previous is not None:
+        previous_tokens = np.load(os.path.join(output_folder, previous["tokens"]), mmap_mode="r")
+        previous_offsets = np.load(os.path.join(output_folder, previous["offsets"]), mmap_mode="r")
+
+    # Records of every source; token IDs of the new or modified sources only (the
+    # captions of the others are a range of the previous arrays)
+    variants, records, sources, plan = [], [], {}, []
+    n_captions, reused, tokenized = 0, 0, 0
+    for key, path, variant in caption_sources(root):
+        stat = os.stat(path)
+        if variant not in variants:
+            variants.append(variant)
+        variant_id = variants.index(variant)
+        first_record = len(records)
+        old = previous["sources"].get(key) if previous is not None else None
+        if old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            old_records = previous["records"][old["records"][0]:old["records"][1]]
+            start = old_records[0][2] if old_records else 0
+            for _, image, _, count in old_records:
+                records.append([variant_id, image, n_captions, count])
+                n_captions += count
+            plan.append((start, start + sum(record[3] for record in old_records)))
+            reused += 1
+        else:
+            encoded = []
+            for image, captions in read_source(path):
+                records.append([variant_id, image, n_captions, len(captions)])
+                n_captions += len(captions)
+                encoded.extend(vocabulary.encode(caption) for caption in captions)
+            plan.append(encoded)
+            tokenized += 1
+        sources[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "records": [first_record, len(records)]}
+
+    summary = {"captions": n_captions, "sources": len(sources), "reused": reused, "tokenized": tokenized,
+               "vocabulary_size": len(vocabulary)}
+    if previous is not None and tokenized == 0 and sources.keys() == previous["sources"].keys():
+        summary.update(tokens=int(previous_offsets[-1]), written=False)
+        return summary
+
+    # Offsets of the captions, then the token array filled source by source
+    offsets = np.zeros(n_captions + 1, dtype=np.int64)
+    caption = 0
+    for step in plan:
+        if isinstance(step, tuple):
+            lengths = np.diff(np.asarray(previous_offsets[step[0]:step[1] + 1]))
+        else:
+            lengths = np.fromiter((len(ids) for ids in step), dtype=np.int64, count=len(step))
+        offsets[caption + 1:caption + 1 + len(lengths)] = offsets[caption] + np.cumsum(lengths)
+        caption += len(lengths)
+
+    tokens_name, offsets_name = f"tokens_{generation:05d}.npy", f"offsets_{generation:05d}.npy"
+    tokens = np.lib.format.open_memmap(os.path.join(output_folder, tokens_name), mode="w+",
+                                       dtype=TOKEN_DTYPE, shape=(int(offsets[-1]),))
+    caption = 0
+    for step in plan:
+        if isinstance(step, tuple):
+            count = step[1] - step[0]
+            start, stop = int(previous_offsets[step[0]]), int(previous_offsets[step[1]])
+            tokens[offsets[caption]:offsets[caption] + stop - start] = previous_tokens[start:stop]
+        else:
+            count = len(step)
+            size = int(offsets[caption + count] - offsets[caption])
+            tokens[offsets[caption]:offsets[caption + count]] = np.fromiter(
+                (token for ids in step for token in ids), dtype=TOKEN_DTYPE, count=size)
+        caption += count
+    tokens.flush()
+    del tokens
+    np.save(os.path.join(output_folder, offsets_name), offsets)
+    if previous is not None:
+        del previous_tokens, previous_offsets
+
+    if not vocabulary.frozen:
+        vocabulary.save(vocabulary_path)
+    index = {
+        "version": INDEX_VERSION,
+        "generation": generation,
+        "root": os.path.abspath(root),
+        "tokens": tokens_name,
+        "offsets": offsets_name,
+        "vocabulary": VOCABULARY_NAME if not vocabulary.frozen else vocabulary_path,
+        "vocabulary_size": len(vocabulary),
+        "vocabulary_sha256": vocabulary.digest(),
+        "frozen": vocabulary.frozen,
+        "variants": variants,
+        # [variant, image, first caption, number of captions]
+        "records": records,
+        "sources": sources,
+    }
+    index_path = os.path.join(output_folder, INDEX_NAME)
+    with open(index_path + ".tmp", mode="w", encoding="utf-8") as file:
+        json.dump(index, file, ensure_ascii=False)
+    os.replace(index_path + ".tmp", index_path)
+    remove_old_arrays(output_folder, {tokens_name, offsets_name})
+    summary.update(tokens=int(offsets[-1]), written=True)
+    return summary
+
+
+class TokenCorpus:
+    """An export, read side: captions as slices of the memory-mapped token array."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = load_export(folder)
+        if self.index is None:
+            raise FileNotFoundError(f"No token export in {folder}")
+        self.tokens = np.load(os.path.join(folder, self.index["tokens"]), mmap_mode="r")
+        self.offsets = np.load(os.path.join(folder, self.index["offsets"]), mmap_mode="r")
+        self.variants = self.index["variants"]
+        self.records = self.index["records"]
+        self._records = {(self.variants[v], image): (first, count) for v, image, first, count in self.records}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def caption(self, i):
+        """Token IDs of caption i (a view of the memory-mapped array)."""
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def captions(self, variant, image):
+        """Token IDs of the captions of an image in a variant (captions_3d/captions_var_10)."""
+        first, count = self._records[(variant, image)]
+        return [self.caption(i) for i in range(first, first + count)]
+
+    def caption_records(self):
+        """Record (index in records) of every caption, for sampling by image or variant."""
+        counts = np.array([record[3] for record in self.records], dtype=np.int64)
+        return np.repeat(np.arange(len(self.records)), counts)
+
+    def vocabulary(self):
+        return Vocabulary.load(os.path.join(self.folder, self.index["vocabulary"]))
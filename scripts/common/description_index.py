@@ -0,0 +1,58 @@
+import os
+import bisect
+import functools
+
+# Index of a description folder (the _description3D.csv files of description_generator.py).
+# The description of an image is the first file whose name starts with the image name
+# without its last extension (IBSR_01_seg_ana.nii -> IBSR_01_seg_ana.nii_description3D.csv).
+# The folder is listed once and its sorted names are searched by bisection, instead of
+# an os.listdir and a startswith test over the whole folder for every image.
+DESCRIPTION_SUFFIXES = (".csv",)
+
+
+class DescriptionIndex:
+    """Sorted file names of a description folder, with prefix lookups."""
+
+    def __init__(self, folder, names):
+        self.folder = folder
+        self.names = sorted(names)
+        self._by_prefix = {}
+
+    @classmethod
+    def scan(cls, folder, suffixes=DESCRIPTION_SUFFIXES):
+        return cls(folder, [name for name in os.listdir(folder) if name.endswith(suffixes)])
+
+    def find(self, prefix):
+        """Path of the first description (in name order) starting with prefix, or None."""
+        if prefix not in self._by_prefix:
+            position = bisect.bisect_left(self.names, prefix)
+            found = position < len(self.names) and self.names[position].startswith(prefix)
+            self._by_prefix[prefix] = os.path.join(self.folder, self.names[position]) if found else None
+        return self._by_prefix[prefix]
+
+    def find_image(self, image_filename):
+        """Description of an image file (IBSR_01_seg_ana.nii.gz -> prefix IBSR_01_seg_ana.nii)."""
+        return self.find(os.path.splitext(os.path.basename(image_filename))[0])
+
+    def missing(self, image_filenames):
+        """Images of the list without a description."""
+        return [name for name in image_filenames if self.find_image(name) is None]
+
+    def __len__(self):
+        return len(self.names)
+
+
+@functools.lru_cache(maxsize=None)
+def description_index(folder):
+    """DescriptionIndex of a folder, built once per process."""
+    return DescriptionIndex.scan(folder)
+
+
+def report_missing(index, image_filenames):
+    """Print the images without a description (once, before the processing) and return them."""
+    missing = index.missing(image_filenames)
+    if missing:
+        print(f"{len(missing)} image(s) without a description in {index.folder}:")
+        for name in missing:
+            print(f"  - {name}")
+    return missing
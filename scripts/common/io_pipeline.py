@@ -0,0 +1,131 @@
+import time
+import queue
+import threading
+import functools
+import concurrent.futures
+from collections import deque
+
+# Three-stage pipeline: read (threads of the main process, ahead of the rendering),
+# render (processes of a multiprocessing.Pool) and write (one background thread fed
+# by a bounded queue). The reads of the next images, the rendering and the writes of
+# the previous results overlap, instead of every worker waiting in turn on its reads
+# and on its writes. At most max_in_flight items are between the start of their read
+# and the end of their write, which bounds the memory and slows the reads down when
+# the writes fall behind. Every stage reports its count, throughput and busy time.
+# When the rendering or a write fails, the run is aborted: the read stage (run by the
+# task thread of the Pool) stops waiting for slots that will never be freed, so the
+# error reaches the caller instead of pool.terminate() joining a blocked thread.
+_END = object()
+ABORT_POLL_SECONDS = 0.1
+
+
+class StageStats:
+    """Items and busy time (summed over the threads or processes) of one stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, items=1):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def report(self, elapsed):
+        rate = self.items / elapsed if elapsed > 0 else 0.0
+        return f"{self.name:<8} {self.items:>7} items  {rate:8.1f} items/s  busy {self.busy:8.2f} s"
+
+
+def _timed_call(function, item):
+    start = time.perf_counter()
+    result = function(item)
+    return result, time.perf_counter() - start
+
+
+def run_pipeline(items, read, render, write, pool, readers=4, max_in_flight=64, queue_size=16, chunksize=1):
+    """
+    Run read(item) -> render(task) -> write(result) over items.
+    read and write run in the main process (threads) and may return/receive any
+    object; render runs in pool and must be a picklable top-level function. read
+    or render returning None skips the item. Returns the stats of the three stages.
+    """
+    stats = {name: StageStats(name) for name in ("read", "render", "write")}
+    slots = threading.BoundedSemaphore(max_in_flight)
+    results = queue.Queue(maxsize=queue_size)
+    errors = []
+    abort = threading.Event()
+
+    def finish_read(future):
+        task, seconds = future.result()
+        stats["read"].add(seconds)
+        if task is None:
+            slots.release()
+            return
+        yield task
+
+    def wait_slot():
+        """Wait for the consumer to free a slot; False once the run is aborted."""
+        while not abort.is_set():
+            if slots.acquire(timeout=ABORT_POLL_SECONDS):
+                return True
+        return False
+
+    def read_stage():
+        with concurrent.futures.ThreadPoolExecutor(max_workers=readers) as executor:
+            pending = deque()
+            for item in items:
+                if abort.is_set():
+                    return
+                # Without a free slot, hand over the oldest read instead of waiting
+                while not slots.acquire(blocking=False):
+                    if not pending:
+                        if not wait_slot():
+                            return
+                        break
+                    yield from finish_read(pending.popleft())
+                pending.append(executor.submit(_timed_call, read, item))
+                while pending and pending[0].done():
+                    yield from finish_read(pending.popleft())
+            while pending:
+                yield from finish_read(pending.popleft())
+
+    def write_stage():
+        while True:
+            result = results.get()
+            if result is _END:
+                return
+            try:
+                if not errors:
+                    _, seconds = _timed_call(write, result)
+                    stats["write"].add(seconds)
+            except Exception as exc:
+                # Kept for the main thread; the queue is still drained so that it never blocks
+                errors.append(exc)
+                abort.set()
+            finally:
+                slots.release()
+
+    start = time.perf_counter()
+    writer = threading.Thread(target=write_stage, name="pipeline-writer", daemon=True)
+    writer.start()
+    try:
+        for result, seconds in pool.imap(functools.partial(_timed_call, render), read_stage(), chunksize):
+            stats["render"].add(seconds)
+            if result is None:
+                slots.release()
+                continue
+            results.put(result)
+    finally:
+        # Normal end or failure of the rendering: a read stage still waiting gives up
+        abort.set()
+        results.put(_END)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    for stage in stats.values():
+        print(stage.report(elapsed))
+    return stats
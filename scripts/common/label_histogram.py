@@ -0,0 +1,91 @@
+import itertools
+import numpy as np
+
+# Number of slices (along the last axis) processed at once: bounds the int64
+# temporaries of np.bincount, whatever the size of the volume.
+SLAB_SIZE = 16
+
+
+def check_labels(values):
+    """
+    Raise ValueError on negative labels. Label IDs are non-negative: they index the
+    histogram rows here and the np.bincount of description_generator.count_labels.
+    """
+    if values.size and values.dtype.kind == "i" and values.min() < 0:
+        raise ValueError("Negative label values are not supported")
+
+
+def _label_slab(slab):
+    """Slab as non-negative int64 labels (float volumes are truncated like astype(int))."""
+    slab = np.asarray(slab).astype(np.int64, copy=False)
+    check_labels(slab)
+    return slab
+
+
+def axis_histograms(image_data, slab_size=SLAB_SIZE):
+    """
+    Per-axis label histograms of a 3D label volume, in a single pass over slabs
+    of the last axis. Returns [h0, h1, h2] where h_a[label, index] is the number
+    of voxels of the label at that index along axis a (summing h_a over its
+    second axis gives the voxel count of each label).
+    """
+    shape = image_data.shape[:3]
+    n_labels = 1
+    histograms = [np.zeros((n_labels, n), dtype=np.int64) for n in shape]
+    grid_i = np.arange(shape[0], dtype=np.int64)[:, None, None]
+    grid_j = np.arange(shape[1], dtype=np.int64)[None, :, None]
+
+    for k0 in range(0, shape[2], slab_size):
+        slab = _label_slab(image_data[:, :, k0:k0 + slab_size])
+        if slab.size == 0:
+            continue
+        slab_labels = int(slab.max()) + 1
+        if slab_labels > n_labels:
+            histograms = [np.pad(h, ((0, slab_labels - n_labels), (0, 0))) for h in histograms]
+            n_labels = slab_labels
+        grid_k = np.arange(k0, k0 + slab.shape[2], dtype=np.int64)[None, None, :]
+        for axis, grid in enumerate((grid_i, grid_j, grid_k)):
+            n = shape[axis]
+            index = (slab * n + grid).ravel()
+            histograms[axis] += np.bincount(index, minlength=n_labels * n).reshape(n_labels, n)
+
+    return histograms
+
+
+def label_regions(histograms, affine=None):
+    """
+    Bounding box, extent and centroid of every label present in the volume, from
+    the axis histograms. Voxel coordinates are indices; with an affine, the
+    centroid and the bounding box (of the voxel centres) are also given in world
+    coordinates (mm). Returns {label: {...}} sorted by label.
+    """
+    counts = histograms[0].sum(axis=1)
+    regions = {}
+    for label in np.flatnonzero(counts):
+        count = int(counts[label])
+        bbox_min, bbox_max, centroid = [], [], []
+        for h in histograms:
+            present = np.flatnonzero(h[label])
+            bbox_min.append(int(present[0]))
+            bbox_max.append(int(present[-1]))
+            centroid.append(float(h[label] @ np.arange(h.shape[1])) / count)
+        region = {
+            "count": count,
+            "bbox_min": bbox_min,
+            "bbox_max": bbox_max,
+            "extent": [hi - lo + 1 for lo, hi in zip(bbox_min, bbox_max)],
+            "centroid": centroid,
+        }
+        if affine is not None:
+            corners = np.array(list(itertools.product(*zip(bbox_min, bbox_max))), dtype=np.float64)
+            world_corners = corners @ affine[:3, :3].T + affine[:3, 3]
+            region["bbox_min_mm"] = world_corners.min(axis=0).tolist()
+            region["bbox_max_mm"] = world_corners.max(axis=0).tolist()
+            region["centroid_mm"] = (affine[:3, :3] @ np.array(centroid) + affine[:3, 3]).tolist()
+        regions[int(label)] = region
+    return regions
+
+
+REGION_COLUMNS = ["ID", "Label", "Voxel Count", "BBox Min (voxel)", "BBox Max (voxel)", "Extent (voxel)",
+                  "Centroid (voxel)", "BBox Min (mm)", "BBox Max (mm)", "Centroid (mm)"]
+
@@ -0,0 +1,158 @@
+import os
+import csv
+import numpy as np
+import pandas as pd
+
+# Consolidated table of the label volumes of a whole database, written by the
+# description stage next to the per-subject CSVs (descriptions/, descriptions_simple/).
+# One compressed NumPy archive replaces thousands of small CSV reads downstream.
+STORE_NAME = "label_volumes.npz"
+COLUMNS = ["subject", "label_id", "label", "voxel_count", "volume_mm3", "volume_ratio"]
+
+
+def empty_table():
+    return {
+        "subject": np.array([], dtype=str),
+        "label_id": np.array([], dtype=np.int64),
+        "label": np.array([], dtype=str),
+        "voxel_count": np.array([], dtype=np.int64),
+        "volume_mm3": np.array([], dtype=np.float64),
+        "volume_ratio": np.array([], dtype=np.float64),
+    }
+
+
+def table_from_rows(rows_by_subject):
+    """
+    rows_by_subject : {subject: [(label_id, label, voxel_count, volume_mm3, volume_ratio), ...]}
+    Returns the columnar table (dict of NumPy arrays).
+    """
+    subjects, rows = [], []
+    for subject, subject_rows in rows_by_subject.items():
+        subjects.extend([subject] * len(subject_rows))
+        rows.extend(subject_rows)
+    if not rows:
+        return empty_table()
+    label_ids, labels, counts, volumes, ratios = zip(*rows)
+    return {
+        "subject": np.array(subjects, dtype=str),
+        "label_id": np.array(label_ids, dtype=np.int64),
+        "label": np.array(labels, dtype=str),
+        "voxel_count": np.array(counts, dtype=np.int64),
+        "volume_mm3": np.array(volumes, dtype=np.float64),
+        "volume_ratio": np.array(ratios, dtype=np.float64),
+    }
+
+
+def save_label_store(folder, table):
+    """Write the table as a compressed NumPy archive (temporary file then rename)."""
+    store_path = os.path.join(folder, STORE_NAME)
+    tmp_path = store_path + ".tmp.npz"
+    np.savez_compressed(tmp_path, **table)
+    os.replace(tmp_path, store_path)
+
+
+def load_label_store(folder):
+    """Load the table of a folder, or None if the folder has no store."""
+    store_path = os.path.join(folder, STORE_NAME)
+    if not os.path.exists(store_path):
+        return None
+    with np.load(store_path, allow_pickle=False) as archive:
+        return {column: archive[column] for column in COLUMNS}
+
+
+def update_label_store(folder, new_rows_by_subject, keep_subjects):
+    """
+    Merge the rows of the recomputed subjects into the store of folder.
+    Only the subjects of keep_subjects are kept from the previous store (removed images
+    disappear); kept subjects missing from it are read back from their CSV.
+    """
+    table = load_label_store(folder) or empty_table()
+    keep_subjects = set(keep_subjects) - set(new_rows_by_subject)
+    mask = np.isin(table["subject"], list(keep_subjects))
+    kept = {column: values[mask] for column, values in table.items()}
+
+    missing = keep_subjects - set(kept["subject"].tolist())
+    if missing:
+        csv_files = {subject_from_csv_name(f): f for f in os.listdir(folder) if f.endswith(".csv")}
+        recovered = {
+            subject: read_description_csv_rows(os.path.join(folder, csv_files[subject]))
+            for subject in missing if subject in csv_files
+        }
+        new_rows_by_subject = {**recovered, **new_rows_by_subject}
+
+    added = table_from_rows(new_rows_by_subject)
+    merged = {column: np.concatenate([kept[column], added[column]]) for column in COLUMNS}
+    save_label_store(folder, merged)
+    return merged
+
+
+def subject_from_csv_name(csv_name):
+    """'X.nii_description3D.csv' or 'X.nii_description3D.csv_simple.csv' -> 'X.nii'"""
+    return csv_name.split("_description3D.csv")[0] if "_description3D.csv" in csv_name else os.path.splitext(csv_name)[0]
+
+
+def read_description_csv_rows(csv_path):
+    """Read the rows of a full or simplified description CSV in the store format."""
+    rows = []
+    with open(csv_path, mode="r", encoding="ISO-8859-1") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            try:
+                label_id = int(row["ID"])
+            except ValueError:
+                continue  # Regroupement sans ID ('Unknown')
+            label = row.get("Label", row.get("Description", ""))
+            volume = row.get("Voxel Volume (mm³)", row.get("Voxel Volume 3", "0"))
+            rows.append((label_id, label, int(row["Voxel Count"]), float(volume), float(row.get("Volume Ratio (%)", "nan"))))
+    return rows
+
+
+def load_label_table(folder):
+    """
+    Load all the label volumes of a description folder as a DataFrame (one row per
+    subject and label), from the store in one read when it exists, else from the CSVs.
+    """
+    table = load_label_store(folder)
+    if table is None:
+        table = table_from_rows({
+            subject_from_csv_name(f): read_description_csv_rows(os.path.join(folder, f))
+            for f in sorted(os.listdir(folder)) if f.endswith(".csv")
+        })
+    return pd.DataFrame(table, columns=COLUMNS)
+
+
+def subject_row(label_id, label, voxel_count, volume_mm3, volume_ratio):
+    """Row of iter_subject_rows: the columns of a full description CSV, as strings."""
+    return {"ID": str(int(label_id)), "Label": str(label), "Voxel Count": str(int(voxel_count)),
+            "Voxel Volume (mm³)": str(float(volume_mm3)), "Volume Ratio (%)": str(float(volume_ratio))}
+
+
+def iter_subject_rows(folder):
+    """
+    Yield (subject name, rows) for every subject of a description folder, sorted by
+    subject name ('X.nii', see subject_from_csv_name). The rows are dicts with the
+    keys "ID", "Label", "Voxel Count", "Voxel Volume (mm³)" and "Volume Ratio (%)"
+    (simplified CSVs: "Label" is the Description of the grouping, groupings without
+    ID are left out), read from the store when it exists, else from the CSVs.
+    """
+    table = load_label_store(folder)
+    if table is None:
+        csv_files = {subject_from_csv_name(f): f for f in os.listdir(folder) if f.endswith(".csv")}
+        for subject in sorted(csv_files):
+            rows = read_description_csv_rows(os.path.join(folder, csv_files[subject]))
+            yield subject, [subject_row(*row) for row in rows]
+        return
+
+    order = np.argsort(table["subject"], kind="stable")
+    subjects = table["subject"][order]
+    boundaries = np.flatnonzero(subjects[1:] != subjects[:-1]) + 1
+    for group in np.split(order, boundaries):
+        if group.size == 0:
+            continue
+        rows = [
+            subject_row(*row)
+            for row in zip(table["label_id"][group], table["label"][group], table["voxel_count"][group],
+                           table["volume_mm3"][group], table["volume_ratio"][group])
+        ]
+        yield str(table["subject"][group[0]]), rows
+
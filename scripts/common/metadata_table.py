@@ -0,0 +1,60 @@
+import os
+import csv
+import functools
+
+# Subject metadata (<database>_info.csv files of the Keywords/metafolder folder),
+# loaded once and indexed by subject ID instead of being parsed again, and filtered
+# with a pandas mask, for every image and every caption variant.
+UNKNOWN_AGE = "unknown"
+UNKNOWN_GENDER = "human"
+
+
+def normalize_age(value):
+    """
+    Age of a subject: an int (ages with a decimal comma, as in IXI_info.csv, are
+    truncated like int(float(age.replace(",", ".")))), the text itself when it is
+    not a number (e.g. "JUV"), or "unknown" when missing.
+    """
+    value = (value or "").strip()
+    if not value:
+        return UNKNOWN_AGE
+    try:
+        return int(float(value.replace(",", ".")))
+    except ValueError:
+        return value
+
+
+def normalize_gender(value):
+    value = (value or "").strip()
+    return value if value else UNKNOWN_GENDER
+
+
+@functools.lru_cache(maxsize=None)
+def load_metadata_table(metadata_file):
+    """{subject ID (int): {"age": ..., "gender": ...}} of one _info.csv file, parsed once per process."""
+    table = {}
+    with open(metadata_file, mode="r", encoding="latin1") as file:
+        for row in csv.DictReader(file):
+            try:
+                subject_id = int(float(row["ID"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            table.setdefault(subject_id, {"age": normalize_age(row.get("AGE")),
+                                          "gender": normalize_gender(row.get("GENDER"))})
+    return table
+
+
+def load_metadata_tables(metadata_folder):
+    """Every *_info.csv of the folder: {file path: table}, to hand to worker processes."""
+    return {
+        os.path.join(metadata_folder, name): load_metadata_table(os.path.join(metadata_folder, name))
+        for name in sorted(os.listdir(metadata_folder)) if name.endswith("_info.csv")
+    }
+
+
+def lookup_subject(table, subject_id):
+    """(age, gender) of a subject, ("unknown", "human") when it is not in the table."""
+    entry = table.get(int(subject_id))
+    if entry is None:
+        return UNKNOWN_AGE, UNKNOWN_GENDER
+    return entry["age"], entry["gender"]
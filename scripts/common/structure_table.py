@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+# Structure tables of the caption generators.
+# The structures of a description CSV are handled as a single DataFrame
+# (id, description, volume in cm3, percentage of the image voxels): sorting,
+# size / selection / variance filters and deduplication by lowercase name are
+# column operations, instead of a dict per row built with iterrows().
+
+
+def known_structures(structures_df, label_column="Label"):
+    """Rows of a description CSV without the "Unknown" label."""
+    return structures_df[structures_df[label_column] != "Unknown"]
+
+
+def structure_table(known_df, total_voxels, volume_column="Voxel Volume (mm³)",
+                    description_column="Label", labels_column=None):
+    """
+    Table of the known structures: id, description, volume (cm3) and percentage of
+    the image voxels. With labels_column (the "2, 41" Labels column of the simplified
+    descriptions), a structure is repeated once per label of the column, structures
+    without volume are dropped, as in simple_captions.py.
+    """
+    if labels_column is not None:
+        known_df = known_df[~(known_df[volume_column] <= 0)]
+        known_df = known_df.loc[known_df.index.repeat(known_df[labels_column].str.count(",") + 1)]
+    return pd.DataFrame({
+        "id": known_df["ID"].to_numpy(),
+        "description": known_df[description_column].to_numpy(),
+        "volume": known_df[volume_column].to_numpy() / 1000,
+        "percentage": np.round(known_df["Voxel Count"].to_numpy() / total_voxels * 100, 2),
+    })
+
+
+def sort_by_volume(table):
+    """Structures by decreasing volume (stable: equal volumes keep their order)."""
+    return table.sort_values("volume", ascending=False, kind="stable")
+
+
+def filter_structures(table, size=None, selection=None, variance_ids=None):
+    """Keep the size first structures, then those whose ID is in selection and in variance_ids."""
+    if size is not None:
+        table = table.head(size)
+    if selection is not None:
+        table = table[table["id"].astype(int).isin(selection)]
+    if variance_ids is not None:
+        table = table[table["id"].astype(int).isin(variance_ids)]
+    return table
+
+
+def caption_structures(table, min_volume=1):
+    """
+    Structures of the caption text, as a list of dicts: one per lowercase description
+    (the largest, the first one on ties), by decreasing volume (ties in order of first
+    appearance of the description), larger than min_volume cm3.
+    """
+    descriptions = table["description"].str.lower()
+    table = table.assign(description=descriptions, first_seen=pd.factorize(descriptions)[0])
+    table = sort_by_volume(table).drop_duplicates("description")
+    table = table.sort_values(["volume", "first_seen"], ascending=[False, True], kind="stable")
+    table = table[table["volume"] > min_volume]
+    return table.drop(columns="first_seen").to_dict("records")
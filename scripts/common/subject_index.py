@@ -0,0 +1,95 @@
+import os
+import re
+import functools
+from collections import namedtuple, defaultdict
+
+# Subject index of the databases.
+# The file names carry one or more database tags (KKI2009-05-FLAIR, OAS1_0001_MR1,
+# IBSR_01, IXI002-Guys-0828-T2, ...); a registered file carries two, for example
+# IBSR_01_ana_reg_KKI2009-05-FLAIR.nii.gz. All the tags of a name are found by a
+# single regex scan, and the subject of a file is its last tag (optionally of a
+# given database). SubjectIndex walks a folder once and answers (database,
+# subject ID) lookups with a dictionary, instead of matching every pair of files.
+
+# Database name (as in the folder names: SIR/FL/Kirby, SIR/T1/OASIS, ...) -> tag regex.
+# Each regex has a subject ID group and an optional modality group.
+DATABASE_PATTERNS = {
+    "Kirby": r"KKI2009-(?P<Kirby_id>\d+)(?:-(?P<Kirby_modality>[A-Za-z0-9]+))?",
+    "OASIS": r"OAS1_(?P<OASIS_id>\d+)(?:_(?P<OASIS_modality>MR\d+))?",
+    "IBSR": r"IBSR_(?P<IBSR_id>\d+)",
+    "IXI": r"IXI(?P<IXI_id>\d+)(?:-[A-Za-z]+-\d+-(?P<IXI_modality>[A-Za-z0-9]+))?",
+}
+TAG_REGEX = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in DATABASE_PATTERNS.items()))
+
+SubjectTag = namedtuple("SubjectTag", ["database", "subject_id", "raw_id", "modality", "start"])
+SubjectEntry = namedtuple("SubjectEntry", ["database", "subject_id", "modality", "role", "path"])
+
+
+def parse_tags(filename):
+    """Every database tag of a file name, in order of appearance."""
+    name = os.path.basename(filename)
+    tags = []
+    for match in TAG_REGEX.finditer(name):
+        database = match.lastgroup
+        groups = match.groupdict()
+        raw_id = groups[f"{database}_id"]
+        tags.append(SubjectTag(database, int(raw_id), raw_id, groups.get(f"{database}_modality"), match.start()))
+    return tags
+
+
+def parse_subject(filename, database=None):
+    """Subject tag of a file: its last tag (of the given database if any), or None."""
+    for tag in reversed(parse_tags(filename)):
+        if database is None or tag.database == database:
+            return tag
+    return None
+
+
+class SubjectIndex:
+    """Files of a folder tree indexed by (database, subject ID), scanned once."""
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self._by_subject = defaultdict(list)
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self._by_subject[(entry.database, entry.subject_id)].append(entry)
+
+    @classmethod
+    def scan(cls, root, suffixes=(".nii.gz", ".csv"), recursive=True, name_filter=None):
+        """
+        Index the files of root ending with one of suffixes. The role of a file is
+        the name of the folder that contains it (seg, reg, descriptions, ...).
+        """
+        index = cls()
+        walk = os.walk(root) if recursive else [(root, None, os.listdir(root))]
+        for folder, _, files in walk:
+            role = os.path.basename(os.path.normpath(folder))
+            for name in sorted(files):
+                if not name.endswith(suffixes) or (name_filter is not None and not name_filter(name)):
+                    continue
+                tag = parse_subject(name)
+                if tag is not None:
+                    index.add(SubjectEntry(tag.database, tag.subject_id, tag.modality, role, os.path.join(folder, name)))
+        return index
+
+    def find(self, database, subject_id, role=None):
+        """Entries of a subject (subject_id as int or as in the file name), optionally of a role."""
+        entries = self._by_subject.get((database, int(subject_id)), [])
+        return [e for e in entries if role is None or e.role == role]
+
+    def first_path(self, database, subject_id, role=None):
+        entries = self.find(database, subject_id, role)
+        return entries[0].path if entries else None
+
+    def __len__(self):
+        return len(self.entries)
+
+
+@functools.lru_cache(maxsize=None)
+def folder_index(folder, suffixes=(".nii.gz",)):
+    """SubjectIndex of a single folder, built once per process."""
+    return SubjectIndex.scan(folder, suffixes, recursive=False)
@@ -0,0 +1,175 @@
+import os
+import csv
+import json
+import math
+import hashlib
+import functools
+import concurrent.futures
+import pandas as pd
+
+from label_store import STORE_NAME, COLUMNS, load_label_store
+
+# Ranking of the structures of a description folder by variance of their volume
+# across the subjects (the "var" filter of the caption generators).
+# The CSVs are read in parallel, each into per-label running statistics (Welford),
+# merged in file order. The full ranking is cached in the folder (variance_ranking.json)
+# under a fingerprint of the folder (names, sizes and modification times of the
+# description files), so later runs and every process reuse it while the folder is
+# unchanged.
+CACHE_NAME = "variance_ranking.json"
+# (label column, volume column) of the full and of the simplified descriptions
+LABEL_COLUMNS = ("Label", "Description")
+VOLUME_COLUMNS = ("Voxel Volume (mm³)", "Voxel Volume 3")
+READ_WORKERS = 8
+
+
+class RunningVariance:
+    """Count, mean and sum of squared deviations of a label volume (Welford)."""
+
+    __slots__ = ("label_id", "count", "mean", "m2")
+
+    def __init__(self, label_id):
+        self.label_id = label_id
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Combine with the statistics of other values (Chan et al.)."""
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def variance(self):
+        """Sample variance (ddof=1, as pandas), nan with less than two values."""
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+
+def description_files(folder):
+    return sorted(f for f in os.listdir(folder) if f.endswith(".csv"))
+
+
+def folder_fingerprint(folder):
+    """Hash of the names, sizes and modification times of the description files (and label store)."""
+    digest = hashlib.sha1()
+    for name in description_files(folder) + [STORE_NAME]:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def file_statistics(csv_path):
+    """{label: RunningVariance} of one description CSV (labels in order of appearance)."""
+    stats = {}
+    with open(csv_path, mode="r", encoding="latin1") as file:
+        reader = csv.DictReader(file)
+        label_column = next((c for c in LABEL_COLUMNS if c in reader.fieldnames), None)
+        volume_column = next((c for c in VOLUME_COLUMNS if c in reader.fieldnames), None)
+        if label_column is None or volume_column is None:
+            return stats
+        for row in reader:
+            label = row[label_column]
+            if label == "Unknown":
+                continue
+            try:
+                volume = float(row[volume_column])
+            except (TypeError, ValueError):
+                volume = math.nan
+            if label not in stats:
+                stats[label] = RunningVariance(row["ID"])
+            if not math.isnan(volume):
+                stats[label].add(volume)
+    return stats
+
+
+def ranking_from_csvs(folder, workers=READ_WORKERS):
+    """Statistics of every CSV of folder, read by a thread pool and merged in file order."""
+    paths = [os.path.join(folder, name) for name in description_files(folder)]
+    totals = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for stats in executor.map(file_statistics, paths):
+            for label, partial in stats.items():
+                if label not in totals:
+                    totals[label] = RunningVariance(partial.label_id)
+                totals[label].merge(partial)
+    return [(label, int(float(s.label_id)), s.variance()) for label, s in totals.items()]
+
+
+def ranking_from_store(folder):
+    """Same statistics from the label_volumes.npz of the folder, None without a store."""
+    table = load_label_store(folder)
+    if table is None:
+        return None
+    df = pd.DataFrame(table, columns=COLUMNS)
+    df = df[df["label"] != "Unknown"]
+    grouped = df.groupby("label", sort=False)
+    variances = grouped["volume_mm3"].var()
+    label_ids = grouped["label_id"].first()
+    return [(label, int(label_ids[label]), float(variances[label])) for label in variances.index]
+
+
+def rank(entries):
+    """By decreasing variance (stable, labels without variance last)."""
+    return sorted(entries, key=lambda e: (math.isnan(e[2]), -e[2] if not math.isnan(e[2]) else 0.0))
+
+
+def load_cached_ranking(folder, fingerprint):
+    try:
+        with open(os.path.join(folder, CACHE_NAME), mode="r", encoding="utf-8") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("fingerprint") != fingerprint:
+        return None
+    return [(label, label_id, math.nan if variance is None else variance) for label, label_id, variance in cache["ranking"]]
+
+
+def save_cached_ranking(folder, fingerprint, ranking):
+    """Write the cache (temporary file then rename); a read-only folder is not an error."""
+    cache_path = os.path.join(folder, CACHE_NAME)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    cache = {
+        "fingerprint": fingerprint,
+        "ranking": [[label, label_id, None if math.isnan(variance) else variance] for label, label_id, variance in ranking],
+    }
+    try:
+        with open(tmp_path, mode="w", encoding="utf-8") as file:
+            json.dump(cache, file, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def variance_ranking(folder):
+    """
+    [(label, ID, variance)] of the structures of a description folder, by decreasing
+    variance: from the folder cache when its fingerprint matches, else from the label
+    store or the CSVs, and then cached. Computed once per process.
+    """
+    fingerprint = folder_fingerprint(folder)
+    ranking = load_cached_ranking(folder, fingerprint)
+    if ranking is None:
+        entries = ranking_from_store(folder)
+        if entries is None:
+            entries = ranking_from_csvs(folder)
+        ranking = rank(entries)
+        save_cached_ranking(folder, fingerprint, ranking)
+    return ranking
+
+
+def top_variance_structures(folder, n):
+    """IDs of the n structures whose volume varies the most across the subjects of folder."""
+    return [label_id for _, label_id, _ in variance_ranking(folder)[:n]]
@@ -0,0 +1,132 @@
+import os
+import hashlib
+import numpy as np
+import nibabel as nib
+
+# Shared on-disk cache of decompressed volumes.
+# Each .nii.gz is gunzipped once and stored as a .npy file in the smallest integer
+# dtype that holds its labels; the scripts then memory-map it instead of gunzipping
+# the same segmentation again on every run. Entries are keyed by the source path,
+# mtime and size, so a modified file is decoded again. The cache is enabled by
+# the SIR_VOLUME_CACHE environment variable (cache folder), and is limited to
+# SIR_VOLUME_CACHE_MAX_GB (default 20 GB) with least-recently-used eviction.
+CACHE_DIR_ENV = "SIR_VOLUME_CACHE"
+CACHE_MAX_GB_ENV = "SIR_VOLUME_CACHE_MAX_GB"
+DEFAULT_MAX_GB = 20.0
+
+
+def get_cache_dir(cache_dir=None):
+    """Cache folder to use: the argument, else $SIR_VOLUME_CACHE, else None (no cache)."""
+    return cache_dir or os.environ.get(CACHE_DIR_ENV) or None
+
+
+def get_max_bytes(max_bytes=None):
+    if max_bytes is not None:
+        return max_bytes
+    return int(float(os.environ.get(CACHE_MAX_GB_ENV, DEFAULT_MAX_GB)) * 1024 ** 3)
+
+
+def cache_key(path):
+    """Key of a source file: hash of its absolute path, mtime and size."""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def compact_dtype(data, integer=False):
+    """
+    Convert the volume to the smallest integer dtype holding its values.
+    With integer=True, float values are truncated like get_fdata().astype(int);
+    otherwise non-integral float volumes (intensity images) are kept as they are.
+    """
+    if data.dtype.kind == "f":
+        if not integer and not np.array_equal(data, np.trunc(data)):
+            return data
+        data = data.astype(np.int64)
+    if data.dtype.kind not in "iu" or data.size == 0:
+        return data
+    low, high = int(data.min()), int(data.max())
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return data.astype(dtype, copy=False)
+    return data
+
+
+def read_volume(path, integer=False):
+    """Decode a NIfTI file without cache (native dtype, or truncated to int with integer=True)."""
+    data = np.asanyarray(nib.load(path).dataobj)
+    if integer and data.dtype.kind == "f":
+        data = data.astype(np.int64)
+    return data
+
+
+def load_volume(path, integer=False, cache_dir=None, max_bytes=None):
+    """
+    Voxel array of a NIfTI file, memory-mapped (read-only) from the cache.
+    Without cache folder, the file is simply decoded (see read_volume).
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return read_volume(path, integer)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = "_int" if integer else ""
+    entry_path = os.path.join(cache_dir, f"{cache_key(path)}{suffix}.npy")
+    if os.path.exists(entry_path):
+        try:
+            os.utime(entry_path)  # Last access time, used by the LRU eviction
+            return np.load(entry_path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass  # Entry evicted or truncated meanwhile: decode again
+
+    data = compact_dtype(np.asanyarray(nib.load(path).dataobj), integer)
+    tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, data)
+    os.replace(tmp_path, entry_path)  # Atomic: other processes never see a partial entry
+    evict(cache_dir, get_max_bytes(max_bytes), keep=entry_path)
+    return np.load(entry_path, mmap_mode="r")
+
+
+def open_volume(path, integer=False, cache_dir=None):
+    """
+    Voxels of a NIfTI file that can be read slab by slab without decoding the whole
+    volume: the cache entry (memory-mapped) when it already exists, otherwise the
+    nibabel array proxy, kept open so that successive slabs of a .nii.gz are read
+    sequentially. The cache is not filled, since that would decode the whole volume.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is not None:
+        suffix = "_int" if integer else ""
+        entry_path = os.path.join(cache_dir, f"{cache_key(path)}{suffix}.npy")
+        try:
+            os.utime(entry_path)
+            return np.load(entry_path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass
+    return nib.load(path, keep_file_open=True).dataobj
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """Delete the least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy"):
+            entry_path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry_path == keep:
+            continue
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+        total -= size
@@ -1,5 +1,4 @@
 import os
-import re
 import json
 import sys
 import numpy as np
@@ -8,25 +7,23 @@ import threading
 import time
 from queue import Queue
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from volume_cache import open_volume
+from label_histogram import axis_histograms
+from subject_index import parse_tags, folder_index
+
+# Short database names used in the JSON file names
+SHORT_NAMES = {"Kirby": "KKI", "OASIS": "OAS", "IXI": "IXI", "IBSR": "IBSR"}
+
 # Function to extract metadata from the file name
 def getInfo(inputFile):
-    # Patterns for fixed and moving images
-    patterns = [
-        (r'reg_KKI2009-(\d+)', "KKI"),
-        (r'reg_OAS1_(\d+)', "OAS"),
-        (r'reg_IXI(\d+)', "IXI"),
-        (r'reg_IBSR_(\d+)', "IBSR")
-    ]
+    # The moving image is the tag at the start of the name, the fixed image the one after "reg_"
     Im_fix, ID_fix, Im_mov, ID_mov = "", "", "", ""
-
-    for pattern, prefix in patterns:
-        if match := re.search(pattern, inputFile):
-            ID_fix, Im_fix = match.group(1), prefix
-
-    for pattern, prefix in [(r'^KKI2009-(\d+)', "KKI"), (r'^OAS1_(\d+)', "OAS"),
-                            (r'^IXI(\d+)', "IXI"), (r'^IBSR_(\d+)', "IBSR")]:
-        if match := re.search(pattern, inputFile):
-            ID_mov, Im_mov = match.group(1), prefix
+    for tag in parse_tags(inputFile):
+        if tag.start == 0:
+            ID_mov, Im_mov = tag.raw_id, SHORT_NAMES[tag.database]
+        elif inputFile[:tag.start].endswith("reg_"):
+            ID_fix, Im_fix = tag.raw_id, SHORT_NAMES[tag.database]
 
     return Im_mov, ID_mov, Im_fix, ID_fix
 
@@ -40,11 +37,11 @@ def fixPath(Im_fix, ID):
         "KKI": "../data/FL/Kirby/seg"
     }
     pathFile = paths.get(Im_fix, "")
-    files = [f for f in os.listdir(pathFile) if f.endswith('.nii.gz')]
-    for file in files:
-        if f"{Im_fix}_{ID}" in file or f"{Im_fix}{ID}" in file:
-            return os.path.join(pathFile, file)
-    return ""
+    if not pathFile or not ID:
+        return ""
+    # Folder indexed once per process, then looked up by subject
+    database = next(name for name, short in SHORT_NAMES.items() if short == Im_fix)
+    return folder_index(pathFile).first_path(database, ID) or ""
 
 # Special handling for IBSR files
 def findSegIBSR(inputFile, ID_mov, Im_fix, ID_fix):
@@ -55,55 +52,38 @@ def findSegIBSR(inputFile, ID_mov, Im_fix, ID_fix):
         pathFile = "../data/T1/IBSR/seg"
     else:
         pathFile = os.path.join(os.path.sep.join(inputFolder.split(os.path.sep)[:-1]), "seg")
-    files = [f for f in os.listdir(pathFile) if f.endswith('.nii.gz')]
-    for file in files:
-        if f"IBSR_{ID_mov}" in file or f"IBSR_{ID_fix}" in file:
-            fixedPath = os.path.join(pathFile, file)
+    index = folder_index(pathFile)
+    for ID in (ID_mov, ID_fix):
+        if ID and (path := index.first_path("IBSR", ID)):
+            fixedPath = path
             break
     return fixedPath
 
 # Function to generate slice information for segmentation
 def getSlicesSeg(inputImage):
-    arrayImage = inputImage.get_fdata()
-
-    sagittal_len, coronal_len, axial_len = arrayImage.shape
+    # Read slab by slab (array proxy, or memmap from the shared volume cache when
+    # $SIR_VOLUME_CACHE is set): the per-slice histograms of the three planes are
+    # accumulated in one pass, without loading the whole volume in memory
+    arrayImage = open_volume(inputImage.get_filename())
+    histograms = axis_histograms(arrayImage)
+
+    shape = arrayImage.shape[:3]
+    voxel_size = [float(x) for x in inputImage.header.get_zooms()]
     sliceArray = []
 
-    # Process sagittal slices
-    for i in range(sagittal_len):
-        image_slice = arrayImage[i, :, :]
-        unique_values, counts = np.unique(image_slice, return_counts=True)
-        sliceArray.append({
-            "plane": "sagittal",
-            "index": i,
-            "dimensions": image_slice.shape,
-            "voxel_size": [float(x) for x in inputImage.header.get_zooms()],
-            "labels": [(int(label), int(count)) for label, count in zip(unique_values, counts)]
-        })
-
-    # Process coronal slices
-    for i in range(coronal_len):
-        image_slice = arrayImage[:, i, :]
-        unique_values, counts = np.unique(image_slice, return_counts=True)
-        sliceArray.append({
-            "plane": "coronal",
-            "index": i,
-            "dimensions": image_slice.shape,
-            "voxel_size": [float(x) for x in inputImage.header.get_zooms()],
-            "labels": [(int(label), int(count)) for label, count in zip(unique_values, counts)]
-        })
-
-    # Process axial slices
-    for i in range(axial_len):
-        image_slice = arrayImage[:, :, i]
-        unique_values, counts = np.unique(image_slice, return_counts=True)
-        sliceArray.append({
-            "plane": "axial",
-            "index": i,
-            "dimensions": image_slice.shape,
-            "voxel_size": [float(x) for x in inputImage.header.get_zooms()],
-            "labels": [(int(label), int(count)) for label, count in zip(unique_values, counts)]
-        })
+    # Process sagittal, coronal and axial slices
+    for axis, plane in enumerate(("sagittal", "coronal", "axial")):
+        dimensions = tuple(n for a, n in enumerate(shape) if a != axis)
+        for i in range(shape[axis]):
+            slice_counts = histograms[axis][:, i]
+            labels = np.flatnonzero(slice_counts)
+            sliceArray.append({
+                "plane": plane,
+                "index": i,
+                "dimensions": dimensions,
+                "voxel_size": voxel_size,
+                "labels": [(int(label), int(slice_counts[label])) for label in labels]
+            })
 
     return sliceArray
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts import their modules by adding scripts/common to sys.path; the tests do the same
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+for folder in ("common", "captions"):
+    sys.path.insert(0, os.path.join(SCRIPTS, folder))
@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from caption_rewrite import LiteralRule, ConnectorRule, MultiPatternRule, compile_rules, apply_rules
+
+CAPTIONS = [
+    "This is a None scan of a male subject. None image, T1 weighted: the cortex measures 1381 mm3.",
+    "In this None scan, the hippocampus and the amygdala measure 38 cm3, furthermore T1 is visible.",
+    "none scan; None and T1 and FLAIR, scanof",
+]
+
+
+def assert_same_as_sequential(rules, captions=CAPTIONS):
+    compiled = compile_rules(rules)
+    for caption in captions:
+        assert apply_rules(caption, compiled) == apply_rules(caption, rules), caption
+    return compiled
+
+
+def test_chained_rules_give_the_ordered_result():
+    rules = [LiteralRule("None", "T1"), LiteralRule("T1", "FLAIR")]
+    compiled = assert_same_as_sequential(rules)
+    assert apply_rules("None and T1", compiled) == "FLAIR and FLAIR"
+    assert not any(isinstance(rule, MultiPatternRule) for rule in compiled)
+
+
+@pytest.mark.parametrize("rules", [
+    [LiteralRule("38", "40"), LiteralRule("1381", "1400")],  # Overlapping texts
+    [LiteralRule("None scan", "T2 scan"), LiteralRule("T2", "T1", whole_word=True)],  # Written text matched
+    [LiteralRule("scan", "scan-"), LiteralRule("of", "with", whole_word=True)],  # Word boundaries changed
+    [LiteralRule("None", "t1"), LiteralRule("T1", "FLAIR", ignore_case=True)],  # Case folded match
+    [ConnectorRule(), LiteralRule("This", " This")],  # Stripped by the connector removal
+])
+def test_interacting_rules_give_the_ordered_result(rules):
+    assert_same_as_sequential(rules)
+
+
+def test_independent_rules_stay_in_one_scan():
+    rules = [LiteralRule("None scan", "T1 scan"), LiteralRule("None image", "T1 image"),
+             LiteralRule("mm3", "mm³", whole_word=True), LiteralRule("cm3", "cm³", whole_word=True), ConnectorRule()]
+    rules += [LiteralRule(f"structure{i}", f"region{i}", whole_word=True) for i in range(20)]
+    compiled = assert_same_as_sequential(rules)
+    assert len(compiled) == 1 and isinstance(compiled[0], MultiPatternRule)
+
+
+def test_random_rules_give_the_ordered_result():
+    rng = random.Random(0)
+    alphabet = "aAbB1 -.³"
+
+    def text(n):
+        return "".join(rng.choice(alphabet) for _ in range(n))
+
+    for _ in range(2000):
+        rules = []
+        for _ in range(rng.randint(2, 6)):
+            if rng.random() < 0.15:
+                rules.append(ConnectorRule([rng.choice(["a", "ab", "A1", "b a", "1"]) for _ in range(2)]))
+            else:
+                rules.append(LiteralRule(text(rng.randint(1, 3)), text(rng.randint(0, 3)),
+                                         whole_word=rng.random() < 0.4, ignore_case=rng.random() < 0.3))
+        assert_same_as_sequential(rules, [text(rng.randint(0, 20)) for _ in range(5)])
@@ -0,0 +1,58 @@
+import threading
+from multiprocessing import Pool
+
+import pytest
+
+from io_pipeline import run_pipeline
+
+TIMEOUT_SECONDS = 60
+
+
+def render_square(task):
+    return task * task
+
+
+def render_failing_first(task):
+    if task == 0:
+        raise RuntimeError("render failed on item 0")
+    return task
+
+
+def run_in_pool(render, items, write, **options):
+    """run_pipeline in a Pool, from a thread: returns the exception raised (None), or fails on a hang."""
+    outcome = {}
+
+    def target():
+        try:
+            with Pool(processes=2) as pool:
+                run_pipeline(items, lambda item: item, render, write, pool, readers=2, **options)
+            outcome["error"] = None
+        except Exception as exc:
+            outcome["error"] = exc
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT_SECONDS)
+    assert not thread.is_alive(), "run_pipeline did not return"
+    return outcome["error"]
+
+
+def test_every_item_written():
+    written = []
+    assert run_in_pool(render_square, range(50), written.append, max_in_flight=4) is None
+    assert sorted(written) == [i * i for i in range(50)]
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4, 64])
+def test_render_error_reaches_the_caller(max_in_flight):
+    error = run_in_pool(render_failing_first, range(500), lambda result: None, max_in_flight=max_in_flight)
+    assert isinstance(error, RuntimeError) and "item 0" in str(error)
+
+
+def test_write_error_reaches_the_caller():
+    def write(result):
+        if result == 9:
+            raise OSError("disk full")
+
+    error = run_in_pool(render_square, range(500), write, max_in_flight=4)
+    assert isinstance(error, OSError)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from label_histogram import axis_histograms, label_regions
+from description_generator import count_labels, count_labels_streaming
+
+
+def label_volume(seed=0, shape=(12, 10, 9)):
+    return np.random.default_rng(seed).integers(0, 6, size=shape).astype(np.int16)
+
+
+def test_counts_agree_between_paths():
+    volume = label_volume()
+    labels, counts = count_labels(volume)
+    expected_labels, expected_counts = np.unique(volume, return_counts=True)
+    assert labels.tolist() == expected_labels.tolist() and counts.tolist() == expected_counts.tolist()
+    streamed = count_labels_streaming(volume, slab_size=4)
+    assert [a.tolist() for a in streamed] == [labels.tolist(), counts.tolist()]
+    regions = label_regions(axis_histograms(volume, slab_size=4))
+    assert list(regions) == labels.tolist()
+    assert [region["count"] for region in regions.values()] == counts.tolist()
+
+
+@pytest.mark.parametrize("count", [
+    count_labels,
+    lambda volume: count_labels_streaming(volume, slab_size=4),
+    lambda volume: axis_histograms(volume, slab_size=4),
+])
+def test_negative_labels_rejected_by_every_path(count):
+    volume = label_volume()
+    volume[3, 4, 7] = -2
+    with pytest.raises(ValueError, match="Negative label"):
+        count(volume)
+
+
+def test_float_volumes_truncated_like_astype_int():
+    volume = label_volume().astype(np.float32) + 0.4
+    volume[0, 0, 0] = -0.6  # Truncated to 0, not negative
+    labels, counts = count_labels(volume)
+    expected_labels, expected_counts = np.unique(volume.astype(int), return_counts=True)
+    assert labels.tolist() == expected_labels.tolist() and counts.tolist() == expected_counts.tolist()
+    assert list(label_regions(axis_histograms(volume))) == labels.tolist()
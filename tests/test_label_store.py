@@ -0,0 +1,79 @@
+import os
+import csv
+
+from label_store import iter_subject_rows, update_label_store, STORE_NAME
+from simple_descriptions import aggregate_groups, write_simple_csv, simple_store_rows
+
+SUBJECTS = {
+    "KKI2009-01-FLAIR_majority.nii": {0: 5000, 2: 120, 3: 80, 41: 130},
+    "OAS1_0001_MR1_mpr_n4_anon_sbj_111_majority.nii": {0: 6000, 2: 110, 41: 0, 42: 95},
+}
+LABELS = {0: "Background", 2: "Left white matter", 3: "Left cortex", 41: "Right white matter", 42: "Right cortex"}
+GROUPINGS = [([2, 41], "2, 41", "White matter", "255 255 255"), ([3, 42], "3, 42", "Cortex", "200 70 50"),
+             ([], "Unknown", "Unknown", "0 0 0")]
+
+
+def write_descriptions(folder):
+    """Full description CSVs, as description_generator.py writes them."""
+    for subject, counts in SUBJECTS.items():
+        total = sum(count for label_id, count in counts.items() if label_id != 0)
+        with open(os.path.join(folder, f"{subject}_description3D.csv"), "w", newline="", encoding="ISO-8859-1") as file:
+            writer = csv.writer(file)
+            writer.writerow(["ID", "Label", "RGB", "Voxel Count", "Voxel Volume (mm³)", "Volume Ratio (%)"])
+            for label_id, count in counts.items():
+                writer.writerow([label_id, LABELS[label_id], "0 0 0", count, count * 1.5, count / total * 100])
+
+
+def csv_and_store_rows(folder, subjects):
+    from_csv = list(iter_subject_rows(folder))
+    update_label_store(folder, {}, subjects)
+    assert os.path.exists(os.path.join(folder, STORE_NAME))
+    return from_csv, list(iter_subject_rows(folder))
+
+
+def test_full_descriptions_same_rows_from_csv_and_store(tmp_path):
+    write_descriptions(tmp_path)
+    from_csv, from_store = csv_and_store_rows(tmp_path, SUBJECTS)
+    assert [subject for subject, _ in from_csv] == sorted(SUBJECTS)
+    assert from_csv == from_store
+    rows = dict(from_store)["KKI2009-01-FLAIR_majority.nii"]
+    assert set(rows[0]) == {"ID", "Label", "Voxel Count", "Voxel Volume (mm³)", "Volume Ratio (%)"}
+    assert rows[1]["Label"] == "Left white matter" and float(rows[1]["Voxel Volume (mm³)"]) == 180.0
+
+
+def test_simple_descriptions_same_rows_from_csv_and_store(tmp_path):
+    new_rows = {}
+    for subject, counts in SUBJECTS.items():
+        volumes = {label_id: (count, count * 1.5) for label_id, count in counts.items()}
+        total = sum(volume for label_id, (_, volume) in volumes.items() if label_id != 0)
+        data, _ = aggregate_groups(volumes, GROUPINGS, total)
+        write_simple_csv(data, os.path.join(tmp_path, f"{subject}_description3D.csv_simple.csv"))
+        new_rows[subject] = simple_store_rows(data)
+
+    from_csv = list(iter_subject_rows(tmp_path))
+    # The store written by simple_descriptions.py, from the aggregated rows
+    update_label_store(tmp_path, new_rows, [])
+    from_store = list(iter_subject_rows(tmp_path))
+    assert from_csv == from_store
+    assert [row["Label"] for row in dict(from_store)["KKI2009-01-FLAIR_majority.nii"]] == ["White matter", "Cortex"]
+
+
+def test_description_generator_store_rows_match_its_csvs(tmp_path):
+    import numpy as np
+    import nibabel as nib
+    from description_generator import describe_image
+
+    volume = np.zeros((8, 6, 5), dtype=np.int16)
+    volume[1:4, 1:3, 1:4], volume[4:7, 2:5, 0:3], volume[0, 0, 0] = 2, 41, 3
+    image_path = os.path.join(tmp_path, "KKI2009-01-FLAIR_majority.nii.gz")
+    nib.save(nib.Nifti1Image(volume, np.diag([1.0, 1.0, 1.2, 1.0])), image_path)
+    label_dict = {label_id: {"label_name": name, "rgb": [0, 0, 0]} for label_id, name in LABELS.items()}
+    full_folder, simple_folder = tmp_path / "descriptions", tmp_path / "descriptions_simple"
+    full_folder.mkdir()
+    simple_folder.mkdir()
+
+    outputs = describe_image(image_path, label_dict, full_folder, simple=(GROUPINGS, simple_folder))
+    for (_, rows), folder in zip(outputs, (full_folder, simple_folder)):
+        from_csv = list(iter_subject_rows(folder))
+        update_label_store(folder, {"KKI2009-01-FLAIR_majority.nii": rows}, [])
+        assert from_csv == list(iter_subject_rows(folder))
@@ -0,0 +1,63 @@
+import os
+
+from manifest import load_manifest, save_manifest, plan_run, remove_orphans, remove_stale_outputs, record_outputs
+
+
+def run(folder, inputs, reference, regions):
+    """One description run: an output per input, plus a table in regions/ with regions."""
+    manifest = load_manifest(folder, reference, options={"regions": regions})
+    remove_orphans(manifest, inputs, folder)
+    to_process, _ = plan_run(manifest, inputs, folder)
+    for path in to_process:
+        name = os.path.basename(path)
+        outputs = [os.path.join(folder, f"{name}_description3D.csv")]
+        if regions:
+            os.makedirs(os.path.join(folder, "regions"), exist_ok=True)
+            outputs.append(os.path.join(folder, "regions", f"{name}_regions3D.csv"))
+        for output in outputs:
+            open(output, "w").close()
+        record_outputs(manifest, path, outputs, folder)
+    removed = remove_stale_outputs(manifest, folder)
+    save_manifest(manifest, folder)
+    return removed
+
+
+def make_inputs(folder, names):
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for name in names:
+        path = os.path.join(folder, name)
+        with open(path, "w") as file:
+            file.write(name)
+        paths.append(path)
+    return paths
+
+
+def test_regions_folder_removed_with_its_last_table(tmp_path):
+    inputs = make_inputs(tmp_path / "seg", ["a.nii.gz", "b.nii.gz"])
+    reference = make_inputs(tmp_path, ["labels.csv"])[0]
+    output = tmp_path / "descriptions"
+    output.mkdir()
+
+    assert run(output, inputs, reference, regions=True) == []
+    assert sorted(os.listdir(output / "regions")) == ["a.nii.gz_regions3D.csv", "b.nii.gz_regions3D.csv"]
+
+    removed = run(output, inputs, reference, regions=False)
+    assert sorted(removed) == [os.path.join("regions", f"{n}_regions3D.csv") for n in ("a.nii.gz", "b.nii.gz")]
+    assert not (output / "regions").exists()
+    assert (output / "a.nii.gz_description3D.csv").exists()
+
+
+def test_orphan_removal_keeps_a_non_empty_regions_folder(tmp_path):
+    inputs = make_inputs(tmp_path / "seg", ["a.nii.gz", "b.nii.gz"])
+    reference = make_inputs(tmp_path, ["labels.csv"])[0]
+    output = tmp_path / "descriptions"
+    output.mkdir()
+    run(output, inputs, reference, regions=True)
+
+    os.remove(inputs[1])
+    run(output, inputs[:1], reference, regions=True)
+    assert os.listdir(output / "regions") == ["a.nii.gz_regions3D.csv"]
+    os.remove(inputs[0])
+    run(output, [], reference, regions=True)
+    assert not (output / "regions").exists()